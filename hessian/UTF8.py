@@ -1,8 +1,8 @@
 # -*- coding: UTF-8 -*-
 #
 # This file contains UTF8 manipulation code.
-# (It would be nice to use standard encoders, but they do not 
-# allow reading symbol by symbol.)
+# (Standard decoder does not allow reading symbol by symbol, 
+# so strings are decoded at once after their octets are found.)
 #
 # !!!NOTE!!! Only unicode symbols in 0..65536 are supported
 #
@@ -26,6 +26,8 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 #
+import re
+
 __revision__ = "$Rev: 44 $"
 
 
@@ -38,6 +40,12 @@ BYTE_RANGES = [0x0000007F, 0x000007FF, 0x0000FFFF, 0x001FFFFF]
 # bit-marks for first byte in UTF8 code point sequence that declare length of sequence
 FIRST_MARKS = [0, 0xc0, 0xe0, 0xf0]
 
+# Trailing octets of multi-byte sequences (10xxxxxx). 
+# All other octets start a symbol.
+TRAILING_OCTETS = "".join([chr(b) for b in range(0x80, 0xc0)])
+
+NON_ASCII = re.compile("[\x80-\xff]")
+
 
 class UTF8Exception(Exception):
     pass
@@ -109,8 +117,83 @@ def symbolToUTF8Py(codePoint):
     result[0] = chr(FIRST_MARKS[byteLen - 1] | c)
     return result
 
+def sequenceLength(first):
+    "Length of UTF-8 sequence that starts with octet 'first'"
+    if first < 0x80:
+        return 1
+    for byteLen in (2, 3, 4):
+        if (first & ~BYTE_MASKS[byteLen - 1] & 0xff) == FIRST_MARKS[byteLen - 1]:
+            return byteLen
+    raise UTF8Exception("Incorrect UTF-8 encoding"
+                         + " (first octet of symbol = 0x%x)" % first)
+
+
 readSymbol = readSymbolPy
 symbolToUTF8 = symbolToUTF8Py
  
-def readString(source, size):
+def readStringPy(source, size):
+    "Symbol by symbol decoder. It is kept as a reference implementation."
     return u"".join([unichr(readSymbol(source.read)) for _ in range(size)])
+
+
+def readStringBulk(source, size):
+    """Reads octets of 'size' symbols with few bulk reads and 
+    decodes them at once with standard codec. 
+    Never reads octets past the string."""
+    chunks = []
+    needed = size # number of symbols which first octet is not read yet
+    while needed > 0:
+        data = source.read(needed)
+        if len(data) == 0:
+            raise UTF8Exception("Incorrect UTF-8 encoding"
+                            + " (premature stream end)")
+        chunks.append(data)
+        # each octet that is not trailing one starts a symbol
+        needed -= len(data.translate(None, TRAILING_OCTETS))
+    if size > 0:
+        # last symbol may be incomplete yet
+        last = len(data) - 1
+        while last > 0 and data[last] in TRAILING_OCTETS:
+            last -= 1
+        missing = sequenceLength(ord(data[last])) - (len(data) - last) 
+        if missing > 0:
+            data = source.read(missing)
+            if len(data) != missing:
+                raise UTF8Exception("Incorrect UTF-8 encoding"
+                                + " (premature stream end)")
+            chunks.append(data)
+    try:
+        return "".join(chunks).decode("UTF-8")
+    except UnicodeDecodeError as e:
+        raise UTF8Exception("Incorrect UTF-8 encoding (%s)" % e)
+
+
+readString = readStringBulk
+
+
+def symbolsEnd(data, start, end, count):
+    """Offset that follows 'count' symbols starting at offset 'start' 
+    of data (a string or bytearray). Returns -1 if data ends (at offset 
+    'end') earlier."""
+    pos = start + count
+    if pos <= end and NON_ASCII.search(data, start, pos) is None:
+        return pos # ASCII only
+    pos = start
+    while count > 0:
+        chunk = data[pos : min(pos + count, end)]
+        if len(chunk) == 0:
+            return -1
+        pos += len(chunk)
+        count -= len(chunk.translate(None, TRAILING_OCTETS))
+    if pos > start:
+        # last symbol may be incomplete yet
+        last = pos - 1
+        while last > start and len(data[last : last + 1].translate(None, TRAILING_OCTETS)) == 0:
+            last -= 1
+        first = data[last]
+        if not isinstance(first, int):
+            first = ord(first)
+        pos = last + sequenceLength(first)
+        if pos > end:
+            return -1
+    return pos
@@ -22,8 +22,11 @@
 #   limitations under the License.
 #
 import hessian
+import hessian2
+import lazy
 import transports
 import urlparse
+from common import HessianError
 from StringIO import StringIO
 
 
@@ -31,15 +34,24 @@ __revision__ = "$Rev$"
 
 
 
-def deref(obj, auth):
+def deref(obj, auth, registry=None):
     "Replace hessian.RemoteReference with live proxy"
     if hasattr(obj, "__class__") \
            and obj.__class__ == hessian.RemoteReference:
-        return HessianProxy(obj.url, auth)
+        return HessianProxy(obj.url, auth, registry)
     else:
        return obj
 
                                                    
+def remoteError(fault):
+    "Exception that represents fault of remote call"
+    # fault is a description of remote call
+    assert type(fault) == dict            
+    e = Exception()
+    e.__dict__.update(fault)
+    return e
+
+
 def drain(obj):
     "Replace Hessian proxy with hessian.RemoteReference"
     if hasattr(obj, "__class__") \
@@ -51,12 +63,25 @@ def drain(obj):
 
 class Method:
     "Encapsulates the method to be called"
-    def __init__(self, invoker, method):
+    def __init__(self, invoker, method, iterator=None):
         self.invoker = invoker
+        self.iterator = iterator
         self.method = method
 
     def __call__(self, *args):
         return self.invoker(self.method, args)
+    
+    def lazy(self, *args):
+        """Call the method. Lists and maps in result are decoded 
+        only when accessed, objects of registered classes are decoded 
+        at once (see lazy.py)"""
+        return self.invoker(self.method, args, lazy.readReply)
+
+    def iter(self, *args):
+        """Call the method which result is a list. Returns iterator 
+        of list's elements that are decoded as they arrive. 
+        Null result is an empty list."""
+        return self.iterator(self.method, args)
 
 
 class HessianProxy:
@@ -66,8 +91,27 @@ class HessianProxy:
     
     def __init__(self, url, authdata = {                       
                         "username": "", 
-                        "password": "" }):
+                        "password": "" }, registry=None):
+        """registry - hessian.TypeRegistry used to (de)serialize values,
+        default is hessian.REGISTRY"""
         self.url = url
+        self._registry = registry
+        # options of hessian.BufferedParseContext for replies
+        self.parseOptions = {}
+        # options of hessian.WriteContext for calls
+        self.writeOptions = {}
+        # Hessian protocol version of calls: 1 (1.0) or 2 (2.0). 
+        # Replies of both versions are accepted.
+        self.protocolVersion = 1
+        # (version, method name) to encoded start of call
+        self._templates = {}
+        # Collect hessian.Statistics of calls and replies (see lastStats)
+        self.collectStats = False
+        # {"call" : hessian.Statistics, "reply" : hessian.Statistics} 
+        # of last call if collectStats is set. Reply statistics of lazy 
+        # calls are None, ones of iterated calls are updated while 
+        # elements are read.
+        self.lastStats = None
         url_tuple  = urlparse.urlparse(url)
         protocol = url_tuple[0]
         
@@ -75,30 +119,89 @@ class HessianProxy:
         transport_class = transports.getTransportForProtocol(protocol)
         self._transport = transport_class(url, authdata)
         
-    def __invoke(self, method, params):        
+    def __request(self, method, params):
         request = StringIO()        
-        hessian.writeObject(
-                            hessian.WriteContext(request, drain), 
-                            (method, [], params), 
-                            hessian.Call())
+        ctx = hessian.BufferedWriteContext(request, drain, self._registry)
+        if self.protocolVersion == 2:
+            hessian2.attach(ctx, self._registry)
+            streamer = hessian2.Call()
+        else:
+            streamer = hessian.Call()
+        hessian.setOptions(ctx, self.writeOptions)
+        if self.collectStats:
+            self.lastStats = {"call" : hessian.instrument(ctx), "reply" : None}
+        key = (self.protocolVersion, method)
+        try:
+            template = self._templates[key]
+        except KeyError:
+            template = self._templates[key] = streamer.template(method)
+        ctx.write(template)
+        streamer.writeParams(ctx, params)
+        ctx.flush()
         
         # print "request.value (" + `len(request.getvalue())` + ") =", `request.getvalue()` # debug        
         request.seek(0)
-        response = self._transport.request(request)
-
+        return request
+    
+    def __instrument(self, ctx):
+        "Collect statistics of reply if enabled"
+        if self.collectStats:
+            self.lastStats["reply"] = hessian.instrument(ctx)
+    
+    def __deref(self, obj):
         # this will retain same credentials for all interfaces we are working with
-        deref_f = lambda x : deref(x, self._authdata)
+        return deref(obj, self._authdata, self._registry)
+
+    def __invoke(self, method, params, readReply=None):        
+        if readReply is not None and self.protocolVersion != 1:
+            raise HessianError("Lazy replies are supported by Hessian 1.0 only")
+        response = self._transport.request(self.__request(method, params))
+        deref_f = self.__deref
         
-        ctx = hessian.ParseContext(response, deref_f)
-        (headers, status, value) = hessian.Reply().read(ctx, ctx.read(1))
+        if readReply is None:
+            ctx = hessian.BufferedParseContext(response, deref_f, 
+                                               registry=self._registry)
+            hessian.setOptions(ctx, self.parseOptions)
+            prefix = ctx.read(1)
+            streamer = hessian2.replyStreamer(ctx, prefix, self._registry)
+            self.__instrument(ctx)
+            (headers, status, value) = streamer.read(ctx, prefix)
+        else:
+            (headers, status, value) = readReply(response.read(), deref_f, 
+                                                 self._registry)
         if not status:
-            # value is a description of remote call
-            assert type(value) == dict            
-            e = Exception()
-            e.__dict__.update(value)
-            raise e 
+            raise remoteError(value)
         else:
             return value
+    
+    def __iterate(self, method, params):
+        response = self._transport.open(self.__request(method, params))
+        try:
+            ctx = hessian.BufferedParseContext(response, self.__deref, 
+                                               registry=self._registry)
+            hessian.setOptions(ctx, self.parseOptions)
+            prefix = ctx.read(1)
+            streamer = hessian2.replyStreamer(ctx, prefix, self._registry)
+            self.__instrument(ctx)
+            (headers, status, value) = streamer.readStart(ctx, prefix)
+            if not status:
+                raise remoteError(value)
+            if value != "N" and not hasattr(ctx.codeMap.get(value), "iterate"):
+                raise HessianError("List expected as result of %s, got %s" 
+                                   % (method, `value`))
+        except:
+            response.close()
+            raise
+        return self.__elements(ctx, response, streamer, value)
+    
+    def __elements(self, ctx, response, streamer, prefix):
+        try:
+            if prefix != "N":
+                for element in ctx.codeMap[prefix].iterate(ctx, prefix):
+                    yield element
+            streamer.readEnd(ctx)
+        finally:
+            response.close()
         
     def __str__(self):
         return "%s(%s)" % (self.__class__.__name__, `self.url`)
@@ -107,4 +210,7 @@ class HessianProxy:
         return "%s(%s, %s)" % (self.__class__.__name__, `self.url`, `self._authdata`)
     
     def __getattr__(self, name):
-        return Method(self.__invoke, name)
+        # method stub is made once
+        method = Method(self.__invoke, name, self.__iterate)
+        self.__dict__[name] = method
+        return method
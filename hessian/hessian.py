@@ -19,12 +19,26 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 #
-from struct import pack, unpack
+from struct import Struct, pack, unpack
 #from types import StringType
 import UTF8
 from common import HessianError
-from datetime import datetime
+from datetime import datetime, timedelta
+from inspect import getmro
+from array import array
+from collections import Iterator
+from itertools import chain
+from ast import literal_eval
+import re
+import sys
 import time
+from mmap import mmap
+from timeit import default_timer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # NumPy arrays are not supported
 
 __revision__ = "$Rev$"
 
@@ -32,6 +46,16 @@ types = []
 CODE_MAP = {}
 TYPE_MAP = {}
 
+# Precompiled codecs. TAGGED_* ones pack type code together with value.
+SHORT = Struct(">H")
+TAGGED_SHORT = Struct(">cH")
+INT = Struct(">l")
+TAGGED_INT = Struct(">cl")
+LONG = Struct(">q")
+TAGGED_LONG = Struct(">cq")
+DOUBLE = Struct(">d")
+TAGGED_DOUBLE = Struct(">cd")
+
 
 class ValueStreamer:
     "Describes contract for value serializers"
@@ -53,30 +77,306 @@ def readObject(ctx):
     return readObjectByPrefix(ctx, prefix)
 
 
+NOTHING = object() # no value (see readObjectByPrefix)
+
+
+class Frame(object):
+    """List or map being read by readObjectByPrefix. Streamers of lists 
+    and maps create frames in their 'open' method.
+    
+    container - list or dict elements are added to, 
+    count - number of elements that follow or -1 if elements are 
+        followed by 'end' code, 0 if container is complete,
+    prefix - code of first element if it is already read,
+    finish - function that makes value of complete container."""
+    
+    __slots__ = ["container", "isMap", "count", "end", "prefix", "finish", "key"]
+    
+    def __init__(self, container, isMap=False, count=-1, end="z", prefix=None, finish=None):
+        self.container = container
+        self.isMap = isMap
+        self.count = count
+        self.end = end
+        self.prefix = prefix
+        self.finish = finish
+        self.key = NOTHING # key of map entry which value is not read yet
+
+
+def readers(registry):
+    """Jump table of type code to method that reads value: 'open' 
+    of list and map streamers (see Frame), 'read' of others"""
+    try:
+        return registry.derived["read"]
+    except KeyError:
+        pass
+    result = registry.derived["read"] = {}
+    for code, streamer in registry.codeMap.items():
+        result[code] = getattr(streamer, "open", streamer.read)
+    return result
+
+
 def readObjectByPrefix(ctx, prefix):
-    return ctx.post(CODE_MAP[prefix].read(ctx, prefix))
+    """Read value which type code is prefix. Nested lists and maps 
+    are read with explicit stack instead of recursion, so depth 
+    of value is not limited by recursion limit."""
+    try:
+        handlers = ctx.registry.derived["read"]
+    except KeyError:
+        handlers = readers(ctx.registry)
+    post = ctx.post
+    value = handlers[prefix](ctx, prefix)
+    if value.__class__ is not Frame:
+        return post(value)
+    if value.count == 0:
+        if value.finish is None:
+            return post(value.container)
+        return post(value.finish(value.container))
+    read = ctx.read
+    frameClass = Frame
+    nothing = NOTHING
+    stack = [] # enclosing containers of current one
+    frame = value # current container
+    child = nothing # value of nested container that is complete
+    while True:
+        container = frame.container
+        count = frame.count
+        end = frame.end
+        prefix = frame.prefix
+        frame.prefix = None
+        nested = None
+        if frame.isMap:
+            key = frame.key
+            while True:
+                if child is not nothing:
+                    if key is nothing:
+                        key = child
+                    else:
+                        container[key] = child
+                        key = nothing
+                    child = nothing
+                if prefix is None:
+                    prefix = read(1)
+                if prefix == end:
+                    if key is not nothing:
+                        raise HessianError("No value of map key %s" % `key`)
+                    break
+                if not prefix:
+                    raise HessianError("Unexpected end of data")
+                value = handlers[prefix](ctx, prefix)
+                prefix = None
+                if value.__class__ is frameClass:
+                    if value.count != 0:
+                        nested = value
+                        frame.key = key
+                        break
+                    elif value.finish is None:
+                        value = value.container
+                    else:
+                        value = value.finish(value.container)
+                child = post(value)
+        else:
+            append = container.append
+            if child is not nothing:
+                append(child)
+                child = nothing
+                if count > 0:
+                    count -= 1
+            while count != 0:
+                if prefix is None:
+                    prefix = read(1)
+                if prefix == end and count < 0:
+                    break
+                if not prefix:
+                    raise HessianError("Unexpected end of data")
+                value = handlers[prefix](ctx, prefix)
+                prefix = None
+                if value.__class__ is frameClass:
+                    if value.count != 0:
+                        nested = value
+                        break
+                    elif value.finish is None:
+                        value = value.container
+                    else:
+                        value = value.finish(value.container)
+                append(post(value))
+                if count > 0:
+                    count -= 1
+        if nested is not None:
+            frame.count = count
+            stack.append(frame)
+            frame = nested
+        else:
+            if frame.finish is None:
+                child = post(container)
+            else:
+                child = post(frame.finish(container))
+            if not stack:
+                return child
+            frame = stack.pop()
+
+
+def identity(value):
+    "Default pre-processing of values (see WriteContext)"
+    return value
+
+
+# How writeObject encodes values of common classes 
+# that are written by standard streamers (see writers)
+INLINE_NULL, INLINE_BOOL, INLINE_INT, INLINE_LONG, INLINE_DOUBLE, \
+    INLINE_STRING, INLINE_BINARY = range(7)
+
+
+def writers(registry):
+    """Jump table of common Python classes to inline encoding (INLINE_*) 
+    if values are written by standard Hessian 1.0 streamer, or to 'encode' 
+    function of the streamer. The function returns encoded value 
+    or None if value should be written by the streamer."""
+    try:
+        return registry.derived["write"]
+    except KeyError:
+        pass
+    result = registry.derived["write"] = {}
+    registry.derived["begin"] = {} # streamer to its begin (see beginOf)
+    inline = {Null : INLINE_NULL, Bool : INLINE_BOOL, Int : INLINE_INT, 
+              Long : INLINE_LONG, Double : INLINE_DOUBLE, 
+              UnicodeString : INLINE_STRING, Binary : INLINE_BINARY}
+    for cls in [type(None), bool, int, long, float, unicode, str]:
+        try:
+            streamer = registry.resolve(cls)
+        except HessianError:
+            continue
+        if streamer.__class__ in inline:
+            result[cls] = inline[streamer.__class__]
+        elif hasattr(streamer, "encode"):
+            result[cls] = streamer.encode
+    return result
+
+
+def definingClass(cls, name):
+    "Class in MRO of cls that defines attribute name (or None)"
+    for base in getmro(cls):
+        if name in base.__dict__:
+            return base
+    return None
+
+
+def methodOf(streamer, name):
+    """Streamer's method that stands for 'write' (e.g. 'begin') or None 
+    if it has none or its class overrides how values are written 
+    ('write' or '_write') below the class that defines the method."""
+    method = getattr(streamer, name, None)
+    if method is None or name in getattr(streamer, "__dict__", {}):
+        return method
+    cls = streamer.__class__
+    owner = definingClass(cls, name)
+    for override in ["write", "_write"]:
+        defining = definingClass(cls, override)
+        if defining is not None and defining is not owner \
+                and issubclass(defining, owner):
+            return None
+    return method
+
+
+def beginOf(streamer):
+    "Streamer's 'begin' method (see writeObject and methodOf)"
+    return methodOf(streamer, "begin")
 
 
 def writeObject(ctx, value, hessianTypeObject):
-    "Write value with specified type"   
-    value = ctx.pre(value)
-    if hessianTypeObject is None: # then autodetect type
-        # type is not explicitly set. Trying to autodetect.
-        if hasattr(value, "__class__"):            
-            hessianTypeObject = TYPE_MAP[value.__class__] 
+    """Write value with given streamer, if it is None then streamer 
+    is found by value's class. Nested lists and maps (streamers with 
+    'begin' method, see beginOf) are written with explicit stack 
+    instead of recursion.
+    Common scalars are encoded inline (see writers)."""
+    if hessianTypeObject is not None:
+        hessianTypeObject.write(ctx, ctx.pre(value))
+        return
+    registry = ctx.registry
+    try:
+        table = registry.derived["write"]
+    except KeyError:
+        table = writers(registry)
+    begins = registry.derived["begin"]
+    typeCache = ctx.typeCache
+    pre = ctx.pre
+    if pre is identity:
+        pre = None
+    write = ctx.write
+    nextOf = next
+    nothing = NOTHING
+    chunkSize = Chunked.chunk_size
+    stack = [] # (elements, closing code) of enclosing containers
+    elements = None # iterator of current container's elements
+    while True:
+        if pre is not None:
+            value = pre(value)
+        cls = value.__class__
+        how = table.get(cls)
+        if how is None:
+            try:
+                streamer = typeCache[cls]
+            except KeyError:
+                streamer = registry.resolve(cls)
+            try:
+                begin = begins[streamer]
+            except KeyError:
+                begin = begins[streamer] = beginOf(streamer)
+            if begin is None:
+                streamer.write(ctx, value)
+            else:
+                started = begin(ctx, value)
+                if started is not None:
+                    if elements is not None:
+                        stack.append((elements, closing))
+                    elements, closing = started
+        elif how.__class__ is not int:
+            data = how(value)
+            if data is None:
+                typeCache[cls].write(ctx, value)
+            else:
+                write(data)
+        elif how == INLINE_STRING and len(value) <= chunkSize:
+            write(TAGGED_SHORT.pack("S", len(value)))
+            write(value.encode("UTF-8"))
+        elif how == INLINE_INT:
+            write(TAGGED_INT.pack("I", value))
+        elif how == INLINE_DOUBLE:
+            write(TAGGED_DOUBLE.pack("D", value))
+        elif how == INLINE_NULL:
+            write("N")
+        elif how == INLINE_BOOL:
+            if value:
+                write("T")
+            else:
+                write("F")
+        elif how == INLINE_LONG:
+            write(TAGGED_LONG.pack("L", value))
+        elif how == INLINE_BINARY and len(value) <= chunkSize:
+            write(TAGGED_SHORT.pack("B", len(value)))
+            write(value)
         else:
-            # should never get here if is on Python 2.3 or later
-            hessianTypeObject = TYPE_MAP[type(value)]
-    assert not hessianTypeObject is None
-    hessianTypeObject.write(ctx, value)
+            typeCache[cls].write(ctx, value)
+        # next element of current container or closing of complete ones
+        while elements is not None:
+            value = nextOf(elements, nothing)
+            if value is not nothing:
+                break
+            if closing:
+                write(closing)
+            if stack:
+                elements, closing = stack.pop()
+            else:
+                elements = None
+        else:
+            return
 
 
 def readShort(stream):
-    return unpack('>H', stream.read(2))[0]
+    return SHORT.unpack(stream.read(2))[0]
 
 
 def writeShort(stream, value):
-    stream.write(pack(">H", value))
+    stream.write(SHORT.pack(value))
 
 
 def readVersion(stream):
@@ -89,6 +389,36 @@ def writeVersion(stream):
     stream.write("\x01\x00")
 
     
+# symbols that take more than one octet in UTF-8 (see utf8Size)
+TWO_OCTETS = re.compile(u"[\u0080-\uffff]")
+THREE_OCTETS = re.compile(u"[\u0800-\uffff]")
+SURROGATE_PAIR = re.compile(u"[\ud800-\udbff][\udc00-\udfff]")
+if sys.maxunicode > 0xffff:
+    TWO_OCTETS = re.compile(u"[\u0080-\U0010ffff]")
+    THREE_OCTETS = re.compile(u"[\u0800-\U0010ffff]")
+    FOUR_OCTETS = re.compile(u"[\U00010000-\U0010ffff]")
+else:
+    FOUR_OCTETS = None # are surrogate pairs
+
+
+def utf8Size(value):
+    "Length of value.encode('UTF-8') found without encoding"
+    size = len(value)
+    if TWO_OCTETS.search(value) is None:
+        return size
+    size += len(TWO_OCTETS.findall(value)) + len(THREE_OCTETS.findall(value))
+    # pair of 3 octet surrogates is encoded as 4 octet symbol 
+    size -= 2 * len(SURROGATE_PAIR.findall(value))
+    if FOUR_OCTETS is not None:
+        size += len(FOUR_OCTETS.findall(value))
+    return size
+
+
+def chunkCount(length):
+    "Number of chunks of chunked value (see Chunked.write)"
+    return 1 + max(0, (length - 1) // Chunked.chunk_size)
+
+
 class SimpleValue:
     "Single valued types (e.g. None)"
     def read(self, ctx, prefix):
@@ -98,6 +428,10 @@ class SimpleValue:
     def write(self, ctx, value):
         assert value == self.value
         ctx.write(self.codes[0])
+    
+    def size(self, ctx, value):
+        "Octets of encoded value (see SizingContext)"
+        return 1
 
 
 class Null(SimpleValue):
@@ -120,6 +454,9 @@ class Bool:
         k = 0
         if value: k = 1
         ctx.write(self.codes[k])
+    
+    def size(self, ctx, value):
+        return 1
 types.append(Bool)
 
 
@@ -130,11 +467,13 @@ class BasicInt:
         assert prefix in self.codes
         dat = ctx.read(4)
         assert len(dat) == 4
-        return unpack(">l", dat)[0]
+        return INT.unpack(dat)[0]
     
     def write(self, ctx, value):
-        ctx.write(self.codes[0])
-        ctx.write(pack(">l", value))
+        ctx.write(TAGGED_INT.pack(self.codes[0], value))
+    
+    def size(self, ctx, value):
+        return 5
 
    
 class Int(BasicInt):
@@ -149,11 +488,13 @@ class Long:
     
     def read(self, ctx, prefix):
         assert prefix in self.codes
-        return unpack('>q', ctx.read(8))[0]
+        return LONG.unpack(ctx.read(8))[0]
     
     def write(self, ctx, value):
-        ctx.write(self.codes[0])
-        ctx.write(pack(">q", value))
+        ctx.write(TAGGED_LONG.pack(self.codes[0], value))
+    
+    def size(self, ctx, value):
+        return 9
 types.append(Long)
 
 
@@ -163,30 +504,112 @@ class Double:
 
     def read(self, ctx, prefix):
         assert prefix in self.codes
-        return unpack('>d', ctx.read(8))[0]
+        return DOUBLE.unpack(ctx.read(8))[0]
         
     def write(self, ctx, value):
-        ctx.write(self.codes[0])
-        ctx.write(pack(">d", value))
+        ctx.write(TAGGED_DOUBLE.pack(self.codes[0], value))
+    
+    def size(self, ctx, value):
+        return 9
 types.append(Double)
 
 
+EPOCH = datetime(1970, 1, 1)
+
+
+def localOffset():
+    "Current UTC offset of local time in milliseconds"
+    if time.daylight and time.localtime().tm_isdst > 0:
+        return -time.altzone * 1000
+    return -time.timezone * 1000
+
+
+def dateOffset(ctx):
+    """UTC offset (milliseconds) of naive dates in ctx. 
+    See ParseContext.dates"""
+    if ctx.dates == "utc":
+        return 0
+    if ctx.localOffset is None:
+        ctx.localOffset = localOffset()
+    return ctx.localOffset
+
+
+def fromMilliseconds(milliseconds, mode="local", offset=0):
+    """Naive date by milliseconds since epoch.
+    mode - see ParseContext.dates, offset - UTC offset (milliseconds) 
+    of result in "utc" and "offset" modes"""
+    if mode == "local":
+        return datetime.fromtimestamp(milliseconds / 1000.0)
+    return EPOCH + timedelta(0, 0, 0, milliseconds + offset)
+
+
+def toMilliseconds(value, mode="local", offset=0):
+    """Milliseconds since epoch of date. Dates with tzinfo are converted
+    by their UTC offset, mode and offset apply to naive ones 
+    (see fromMilliseconds)."""
+    if value.tzinfo is not None:
+        offset = value.utcoffset()
+        offset = (offset.days * 86400 + offset.seconds) * 1000 + offset.microseconds // 1000
+        value = value.replace(tzinfo=None)
+    elif mode == "local":
+        seconds = int(time.mktime(value.timetuple()))
+        return seconds * 1000 + value.microsecond // 1000
+    d = value - EPOCH
+    return (d.days * 86400 + d.seconds) * 1000 + d.microseconds // 1000 - offset
+
+
+def readDate(ctx, milliseconds):
+    "Date by milliseconds since epoch as configured in ctx"
+    if ctx.dates == "local":
+        return fromMilliseconds(milliseconds)
+    return fromMilliseconds(milliseconds, ctx.dates, dateOffset(ctx))
+
+
+def writeDate(ctx, value):
+    "Milliseconds since epoch of date as configured in ctx"
+    if ctx.dates == "local":
+        return toMilliseconds(value)
+    return toMilliseconds(value, ctx.dates, dateOffset(ctx))
+
+
 class Date:
     codes = ["d"]
     ptype = datetime
 
     def read(self, ctx, prefix):
         assert prefix in self.codes
-        milliseconds = unpack('>q', ctx.read(8))[0]        
-        return datetime.fromtimestamp(milliseconds / 1000.0)
+        return readDate(ctx, LONG.unpack(ctx.read(8))[0])
     
     def write(self, ctx, value):
-        seconds = time.mktime(value.timetuple()) + value.microsecond / 1000000.0 
-        ctx.write(self.codes[0])
-        ctx.write(pack(">q", seconds * 1000))
+        ctx.write(TAGGED_LONG.pack(self.codes[0], writeDate(ctx, value)))
+    
+    def size(self, ctx, value):
+        return 9
 types.append(Date)
 
 
+class DateColumn:
+    """Sequence of dates that is written as list of dates at once.
+    values - datetime objects, milliseconds since epoch or 
+    numpy datetime64 array."""
+    
+    def __init__(self, values):
+        self.values = values
+    
+    def milliseconds(self, ctx):
+        "Milliseconds since epoch of values"
+        values = self.values
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            return values.astype("datetime64[ms]").astype("int64").tolist()
+        if len(values) == 0 or not isinstance(values[0], datetime):
+            return values
+        if ctx.dates == "local":
+            return [toMilliseconds(v) for v in values]
+        mode = ctx.dates
+        offset = dateOffset(ctx)
+        return [toMilliseconds(v, mode, offset) for v in values]
+
+
 class ShortSequence:
     codes = []
 
@@ -195,9 +618,28 @@ class ShortSequence:
         return ctx.read(count)
 
     def write(self, ctx, value):
-        ctx.write(self.codes[0])
-        writeShort(ctx, len(value))
+        ctx.write(TAGGED_SHORT.pack(self.codes[0], len(value)))
         ctx.write(value)    
+    
+    def size(self, ctx, value):
+        return 3 + len(value)
+
+
+def readChunks(streamer, ctx, prefix, empty):
+    """Read chunked sequence. Chunks are collected and joined once 
+    (join allocates result of total length) so reading is linear 
+    in sequence length. Single chunk is returned as is."""
+    last, more = streamer.codes
+    if prefix == last:
+        return streamer.readChunk(ctx, prefix)
+    chunks = []
+    append = chunks.append
+    while prefix == more:
+        append(streamer.readChunk(ctx, prefix))
+        prefix = ctx.read(1)
+    assert prefix == last
+    append(streamer.readChunk(ctx, prefix))
+    return empty.join(chunks)
 
 
 class Chunked(ShortSequence):
@@ -209,26 +651,31 @@ class Chunked(ShortSequence):
     chunk_size = 2 ** 12 # 4KiB
 
     def read(self, ctx, prefix):
-        result = "";
-        while (prefix == self.codes[1]):
-            result += self.readChunk(ctx, self.codes[1])
-            prefix = ctx.read(1)
-        assert prefix == self.codes[0]
-        result += self.readChunk(ctx, prefix)
-        return result
+        return readChunks(self, ctx, prefix, "")
+
+    # Chunks share memory of value (see WriteContext.writeView)
+    views = False
+
+    def slice(self, value, start, end):
+        "Chunk's data"
+        return value[start : end]
 
     def write(self, ctx, value):        
         length = len(value)
         pos = 0
+        writeChunk = ctx.writeView if self.views else ctx.write
+        if pos < length - Chunked.chunk_size:
+            chunk_prefix = TAGGED_SHORT.pack(self.codes[1], Chunked.chunk_size)
         while pos < length - Chunked.chunk_size:
-            ctx.write(self.codes[1])
-            writeShort(ctx, Chunked.chunk_size)
-            ctx.write(value[pos : pos + Chunked.chunk_size])
+            ctx.write(chunk_prefix)
+            writeChunk(self.slice(value, pos, pos + Chunked.chunk_size))
             pos += Chunked.chunk_size
         # write last chunk
-        ctx.write(self.codes[0])
-        writeShort(ctx, length - pos)
-        ctx.write(value[pos : ])
+        ctx.write(TAGGED_SHORT.pack(self.codes[0], length - pos))
+        writeChunk(self.slice(value, pos, length))
+    
+    def size(self, ctx, value):
+        return 3 * chunkCount(len(value)) + len(value)
 
 
 class UTF8Sequence:
@@ -245,34 +692,40 @@ class UTF8Sequence:
         return UTF8.readString(ctx, count)
             
     def read(self, ctx, prefix):                
-        result = u""
-        while (prefix == self.codes[1]):
-            result += self.readChunk(ctx, prefix)
-            prefix = ctx.read(1)
-        assert prefix == self.codes[0]
-        result += self.readChunk(ctx, prefix)
-        return result
+        return readChunks(self, ctx, prefix, u"")
     
-    def writeChunk(self, ctx, val):
-        length = len(val)
-        writeShort(ctx, length)
+    def writeChunk(self, ctx, prefix, val):
+        ctx.write(TAGGED_SHORT.pack(prefix, len(val)))
         ctx.write(val.encode("UTF-8"))
 
     def write(self, ctx, value):
         length = len(value)        
         pos = 0
         while pos < length - Chunked.chunk_size:
-            ctx.write(self.codes[1])
-            self.writeChunk(ctx, value[pos : pos + Chunked.chunk_size])
+            self.writeChunk(ctx, self.codes[1], value[pos : pos + Chunked.chunk_size])
             pos += Chunked.chunk_size
         # write last chunk
-        ctx.write(self.codes[0])
-        self.writeChunk(ctx, value[pos : ])
+        self.writeChunk(ctx, self.codes[0], value[pos : ])
+    
+    def size(self, ctx, value):
+        "Octets of encoded value, UTF-8 symbols are counted, not encoded"
+        size = Chunked.chunk_size
+        if len(value) <= size:
+            return 3 + utf8Size(value)
+        # surrogate pair may be split between chunks
+        return sum([3 + utf8Size(value[pos : pos + size]) 
+                    for pos in range(0, len(value), size)])
 
     
 class UnicodeString(UTF8Sequence):
     codes = ["S", "s"]
     ptype = unicode
+    
+    def read(self, ctx, prefix):
+        value = readChunks(self, ctx, prefix, u"")
+        if ctx.internStrings and len(value) <= ctx.internStrings:
+            return ctx.intern(value)
+        return value
 types.append(UnicodeString)
 
 
@@ -295,10 +748,46 @@ class Binary(Chunked):
     ptype = str
     
     def read(self, ctx, prefix):
-        return Chunked.read(self, ctx, prefix)
+        if ctx.binaryViews and prefix == self.codes[0] and hasattr(ctx, "view"):
+            result = ctx.view(readShort(ctx))
+            if ctx.numpyBinaries and result[:len(NPY_MAGIC)] == NPY_MAGIC:
+                return readNpy(str(bytearray(result)))
+            return result
+        result = Chunked.read(self, ctx, prefix)
+        if ctx.numpyBinaries and result.startswith(NPY_MAGIC):
+            return readNpy(result)
+        return result
 types.append(Binary)
 
 
+def window(value, start, end):
+    "Part of binary value that shares its memory"
+    if isinstance(value, memoryview):
+        return value[start : end]
+    return buffer(value, start, end - start)
+
+
+class BinaryView(Binary):
+    "Serialises bytearray. Chunks are written without copying."
+    ptype = bytearray
+    views = True
+
+    def slice(self, value, start, end):
+        return window(value, start, end)
+types.append(BinaryView)
+
+
+class MemoryView(BinaryView):
+    ptype = memoryview
+types.append(MemoryView)
+
+
+class MappedBinary(BinaryView):
+    "Serialises contents of memory mapped file"
+    ptype = mmap
+types.append(MappedBinary)
+
+
 class TypeName(ShortSequence):
     codes = ["t"]    
 types.append(TypeName)
@@ -312,14 +801,229 @@ types.append(Length)
 def writeReferenced(stream, writeMethod, obj):
     """Write reference if object has been met before.
     Else write object itself."""
-    
+    if stream.references == "off":
+        writeMethod(stream, obj)
+        return
     objId = stream.getRefId(obj)
     if objId != -1:
         Ref().write(stream, objId)
     else:
         writeMethod(stream, obj)
+
+
+def referencedSize(ctx, obj, size):
+    """Octets that writeReferenced writes: size of object 
+    or of reference if object has been met before"""
+    if ctx.references != "off" and ctx.getRefId(obj) != -1:
+        return 5
+    return size
         
 
+# Numbers that lists of same-typed values are packed/unpacked at once for.
+# Type code -> (octets in value, struct format, array.array typecode)
+NUMBER_FORMATS = {
+    "I" : (4, "l", "i"),
+    "L" : (8, "q", "l"),
+    "D" : (8, "d", "d"),
+}
+# also dates (milliseconds since epoch)
+COLUMN_FORMATS = dict(NUMBER_FORMATS)
+COLUMN_FORMATS["d"] = (8, "q", "l")
+INT_RANGE = (-2 ** 31, 2 ** 31)
+LONG_RANGE = (-2 ** 63, 2 ** 63)
+
+
+def tagNumbers(code, values):
+    """Encode sequence of numbers as values of type 'code'. 
+    Numbers are packed with single call and then interleaved 
+    with type codes."""
+    width, fmt, _ = COLUMN_FORMATS[code]
+    count = len(values)
+    raw = pack(">%d%s" % (count, fmt), *values)
+    stride = width + 1
+    tagged = bytearray(count * stride)
+    tagged[0::stride] = code * count
+    for k in range(width):
+        tagged[k + 1::stride] = raw[k::width]
+    return str(tagged)
+
+
+def packedCode(ctx, value):
+    """Type code of elements if value is written at once by packNumbers 
+    (homogeneous sequence of int, long, float or datetime, also 
+    array.array), else None. Elements are not packed if ctx.pre is set 
+    as it has to be applied to every element."""
+    if len(value) < 2 or ctx.pre is not identity:
+        return None
+    if isinstance(value, array):
+        if value.typecode in "cu":
+            return None
+        if value.typecode in "fd":
+            return "D"
+        bounds = (min(value), max(value))
+        if INT_RANGE[0] <= bounds[0] and bounds[1] < INT_RANGE[1]:
+            return "I"
+        return "L"
+    classes = set(map(type, value))
+    if len(classes) != 1:
+        return None
+    cls = classes.pop()
+    streamer = ctx.typeCache.get(cls)
+    if cls is float and isinstance(streamer, Double):
+        return "D"
+    if cls is long and isinstance(streamer, Long):
+        return "L"
+    if cls is int and isinstance(streamer, Int) \
+            and INT_RANGE[0] <= min(value) and max(value) < INT_RANGE[1]:
+        return "I"
+    if cls is datetime and isinstance(streamer, Date):
+        return "d"
+    return None
+
+
+def packNumbers(ctx, value):
+    """Encode elements of homogeneous sequence of int, long or float
+    (also array.array) at once. Returns None if the sequence is not such
+    or its elements are not written by standard streamers (see packedCode)."""
+    code = packedCode(ctx, value)
+    if code is None:
+        return None
+    if code == "d":
+        return tagNumbers("d", DateColumn(value).milliseconds(ctx))
+    return tagNumbers(code, value)
+    
+
+def packNumpyNumbers(value):
+    """Encode elements of one-dimensional numeric numpy array. 
+    Returns (type code, encoded elements) or None if array is not such."""
+    kind = value.dtype.kind
+    if value.ndim != 1 or not kind in "iuf" or len(value) == 0:
+        return None
+    if kind == "f":
+        code = "D"
+    else:
+        bounds = (value.min(), value.max())
+        if INT_RANGE[0] <= bounds[0] and bounds[1] < INT_RANGE[1]:
+            code = "I"
+        elif LONG_RANGE[0] <= bounds[0] and bounds[1] < LONG_RANGE[1]:
+            code = "L"
+        else:
+            return None
+    width = NUMBER_FORMATS[code][0]
+    tagged = numpy.empty(len(value), 
+                         dtype=[("code", "S1"), ("value", ">%s%d" % (kind, width))])
+    tagged["code"] = code
+    tagged["value"] = value
+    return code, tagged.tostring()
+
+
+def peekColumn(ctx, prefix, count):
+    """Encoded elements of list of 'count' fixed size values of type 
+    'prefix' (see COLUMN_FORMATS) with closing "z". First element's 
+    prefix is already read. Returns None if list is not homogeneous.
+    Data is not consumed."""
+    if not hasattr(ctx, "peek"):
+        return None # can not look ahead in plain stream
+    width = COLUMN_FORMATS[prefix][0]
+    stride = width + 1
+    size = count * stride
+    # every element's value is followed by next element's type code
+    # or list end marker
+    data = ctx.peek(size)
+    if len(data) != size or data[width::stride] != prefix * (count - 1) + "z":
+        return None
+    return data
+
+
+def readDates(ctx, count):
+    """Decode list of 'count' dates at once as list of datetime, 
+    array.array of milliseconds or numpy datetime64 array 
+    (see ParseContext.dateLists). First element's prefix is already read.
+    Returns None (and consumes nothing) if list is not homogeneous."""
+    data = peekColumn(ctx, "d", count)
+    if data is None:
+        return None
+    result = decodeDates(ctx, data, count, 0)
+    if result is not None:
+        ctx.pos += count * 9
+    return result
+
+
+def decodeDates(ctx, data, count, offset):
+    """Dates of 'count' tagged 8 octet values in data as configured 
+    by ctx.dateLists (see readDates). Value of first element starts 
+    at offset. Returns None if there is no suitable array type."""
+    mode = ctx.dateLists
+    if mode == "milliseconds":
+        width, _, typecode = COLUMN_FORMATS["d"]
+        if array(typecode).itemsize != width:
+            return None # no suitable array type on this platform
+    raw = bytearray(count * 8)
+    for k in range(8):
+        raw[k::8] = data[offset + k::9]
+    milliseconds = unpack(">%dq" % count, str(raw))
+    if mode == "numpy":
+        result = numpy.array(milliseconds, dtype="datetime64[ms]")
+    elif mode == "milliseconds":
+        result = array(typecode, milliseconds)
+    elif ctx.dates == "local":
+        result = [fromMilliseconds(m) for m in milliseconds]
+    else:
+        offset = dateOffset(ctx)
+        result = [fromMilliseconds(m, ctx.dates, offset) for m in milliseconds]
+    return result
+
+
+def readNumbers(ctx, prefix, count):
+    """Decode list of 'count' numbers of type 'prefix' at once as 
+    array.array or numpy array (see ParseContext.numericLists).
+    First element's prefix is already read. Closing "z" is consumed too.
+    Returns None (and consumes nothing) if list is not homogeneous."""
+    data = peekColumn(ctx, prefix, count)
+    if data is None:
+        return None
+    result = decodeNumbers(ctx, prefix, data, count, 0)
+    if result is not None:
+        ctx.pos += len(data)
+    return result
+
+
+def decodeNumbers(ctx, prefix, data, count, offset):
+    """Numbers of 'count' values of type 'prefix' in data (each value 
+    is tagged with prefix) as configured by ctx.numericLists 
+    (see readNumbers). Value of first element starts at offset.
+    Returns None if there is no suitable array type."""
+    width, _, typecode = NUMBER_FORMATS[prefix]
+    stride = width + 1
+    if ctx.numericLists == "numpy":
+        fmt = ">" + {"I" : "i4", "L" : "i8", "D" : "f8"}[prefix]
+        dtype = numpy.dtype({"names" : ["value"], "formats" : [fmt], 
+                             "offsets" : [offset], "itemsize" : stride})
+        values = numpy.frombuffer(data, dtype, count)["value"]
+        result = values.astype(values.dtype.newbyteorder("="))
+    else:
+        result = array(typecode)
+        if result.itemsize != width:
+            return None # no suitable array type on this platform
+        raw = bytearray(count * width)
+        for k in range(width):
+            raw[k::width] = data[offset + k::stride]
+        result.fromstring(str(raw))
+        if sys.byteorder == "little":
+            result.byteswap()
+    return result
+
+
+def checkedLength(count):
+    "Frame's finish function that checks length of list"
+    def finish(result):
+        if len(result) != count:
+            raise HessianError("List length %d does not match %d elements" 
+                               % (count, len(result)))
+        return result
+    return finish
+
+
 class Array:
     codes = ["V"]
     ptype = list
@@ -327,14 +1031,70 @@ class Array:
     type_streamer = TypeName()
     length_streamer = Length()
     
-    def read(self, ctx, prefix):
+    def readStart(self, ctx, prefix):
+        """Read list's type name and length. Returns (type name, length, 
+        code of first element), length is -1 if it is not given"""
         assert prefix == "V"
         prefix = ctx.read(1)
+        typeName = None
         if prefix in self.type_streamer.codes:
-            self.type_streamer.read(ctx, prefix)
+            typeName = self.type_streamer.read(ctx, prefix)
             prefix = ctx.read(1)
-        count = self.length_streamer.read(ctx, prefix)        
-        prefix = ctx.read(1)        
+        count = -1 # length is optional
+        if prefix in self.length_streamer.codes:
+            count = self.length_streamer.read(ctx, prefix)        
+            prefix = ctx.read(1)        
+        return (typeName, count, prefix)
+
+    def readPacked(self, ctx, typeName, count, prefix):
+        """Read homogeneous list of numbers or dates at once if it is
+        enabled by options (see readNumbers, readDates). Returns None
+        if list should be read element by element."""
+        if count > 0 and ctx.numericLists and prefix in NUMBER_FORMATS:
+            result = readNumbers(ctx, prefix, count)
+            if result is not None:
+                if typeName is not None and ctx.numericLists == "numpy":
+                    result = reshapeNumbers(result, typeName)
+                ctx.referencedObjects.append(result)
+                return result
+        if count > 0 and ctx.dateLists and prefix == "d":
+            result = readDates(ctx, count)
+            if result is not None:
+                ctx.referencedObjects.append(result)
+                return result
+        return None
+
+    def open(self, ctx, prefix):
+        "Start reading list (see Frame)"
+        assert prefix in self.codes
+        # same as readStart, inlined as lists are often short
+        prefix = ctx.read(1)
+        typeName = None
+        if prefix == "t":
+            typeName = self.type_streamer.read(ctx, prefix)
+            prefix = ctx.read(1)
+        count = -1
+        if prefix == "l":
+            count = self.length_streamer.read(ctx, prefix)        
+            prefix = ctx.read(1)        
+            if count > 0 and (ctx.numericLists or ctx.dateLists):
+                result = self.readPacked(ctx, typeName, count, prefix)
+                if result is not None:
+                    return Frame(result, False, 0)
+        result = []
+        ctx.referencedObjects.append(result)
+        finish = None
+        if count != -1:
+            finish = checkedLength(count)
+        if prefix == "z":
+            return Frame(result, False, 0, "z", None, finish)
+        return Frame(result, False, -1, "z", prefix, finish)
+
+    def read(self, ctx, prefix):
+        typeName, count, prefix = self.readStart(ctx, prefix)
+        result = self.readPacked(ctx, typeName, count, prefix)
+        if result is not None:
+            return result
         result = []
         ctx.referencedObjects.append(result)        
         while prefix != "z":        
@@ -344,6 +1104,55 @@ class Array:
         assert prefix == "z"
         return result
 
+    def iterate(self, ctx, prefix):
+        """Generator of list's elements that yields every element 
+        as soon as it is read. The list itself is not built: references 
+        to it get an empty placeholder list."""
+        typeName, count, prefix = self.readStart(ctx, prefix)
+        ctx.referencedObjects.append([])
+        n = 0
+        while prefix != "z":
+            if not prefix:
+                raise HessianError("Unexpected end of list")
+            yield readObjectByPrefix(ctx, prefix)
+            n += 1
+            prefix = ctx.read(1)
+        if count != -1 and count != n:
+            raise HessianError("List length %d does not match %d elements" % (count, n))
+
+    def begin(self, ctx, value):
+        """Start writing list (see writeObject). Returns (elements, closing 
+        code) or None if list is written completely. It is not used 
+        for subclasses that override write or _write (see beginOf)."""
+        if ctx.references != "off":
+            objId = ctx.getRefId(value)
+            if objId != -1:
+                Ref().write(ctx, objId)
+                return None
+        ctx.write(self.codes[0])
+        self.length_streamer.write(ctx, len(value))
+        packed = packNumbers(ctx, value)
+        if packed is not None:
+            ctx.write(packed)
+            ctx.write("z")
+            return None
+        return (iter(value), "z")
+    
+    def sizeBegin(self, ctx, value):
+        """Same as begin but adds octets of list's start (and of packed 
+        elements) to SizingContext's size instead of writing them."""
+        if ctx.references != "off":
+            objId = ctx.getRefId(value)
+            if objId != -1:
+                ctx.size += 5
+                return None
+        ctx.size += 6
+        code = packedCode(ctx, value)
+        if code is not None:
+            ctx.size += len(value) * (1 + COLUMN_FORMATS[code][0]) + 1
+            return None
+        return (iter(value), "z")
+
     def _write(self, ctx, value):
         ctx.write(self.codes[0])
         
@@ -351,8 +1160,12 @@ class Array:
         # self.type_streamer.write(stream, "something")
         
         self.length_streamer.write(ctx, len(value))
-        for o in value:
-            writeObject(ctx, o, None)
+        packed = packNumbers(ctx, value)
+        if packed is not None:
+            ctx.write(packed)
+        else:
+            for o in value:
+                writeObject(ctx, o, None)
         ctx.write("z")
         
     def write(self, ctx, value):
@@ -360,6 +1173,29 @@ class Array:
 types.append(Array)
 
 
+class Iteration(Array):
+    """Serialises generators and other iterators as lists. Elements 
+    are written as they are produced, list length is not written.
+    Iterators are read as lists."""
+    ptype = Iterator
+    
+    batch = 256 # elements between ctx.sync() calls
+    
+    def _write(self, ctx, value):
+        if isinstance(ctx, SizingContext):
+            raise HessianError("Can not size iterator without consuming it")
+        ctx.write(self.codes[0])
+        n = 0
+        for o in value:
+            writeObject(ctx, o, None)
+            n += 1
+            if n == self.batch:
+                ctx.sync()
+                n = 0
+        ctx.write("z")
+types.append(Iteration)
+
+
 class Tuple(Array):
     "This class serialises tuples. They are always read as arrays"
     codes = ["V"]
@@ -367,18 +1203,163 @@ class Tuple(Array):
 types.append(Tuple)    
 
 
+class NumberArray(Array):
+    "Serialises array.array. It is read as list (see ParseContext.numericLists)"
+    ptype = array
+types.append(NumberArray)
+
+
+class DateList(Array):
+    "Serialises DateColumn. It is read as list (see ParseContext.dateLists)"
+    ptype = DateColumn
+    
+    def _write(self, ctx, value):
+        milliseconds = value.milliseconds(ctx)
+        ctx.write(self.codes[0])
+        self.length_streamer.write(ctx, len(milliseconds))
+        if len(milliseconds) > 0:
+            ctx.write(tagNumbers("d", milliseconds))
+        ctx.write("z")
+    
+    def size(self, ctx, value):
+        return referencedSize(ctx, value, 7 + 9 * len(value.values))
+types.append(DateList)
+
+
+# Java array type names of numeric lists
+ARRAY_TYPE_NAMES = {"I" : "[int", "L" : "[long", "D" : "[double"}
+
+# Shape of multidimensional numpy array is appended 
+# to list's type name, e.g. "[double[2,3]"
+SHAPE_PATTERN = re.compile(r"^\[[a-z]+\[(\d+(,\d+)*)\]$")
+
+# NPY format, see numpy.lib.format
+NPY_MAGIC = "\x93NUMPY"
+
+
+def reshapeNumbers(values, typeName):
+    "Restore shape of numpy array that is written as list"
+    match = SHAPE_PATTERN.match(typeName)
+    if match is None:
+        return values
+    shape = [int(n) for n in match.group(1).split(",")]
+    return values.reshape(shape)
+
+
+def npyHeader(value):
+    "NPY format (version 1.0) header for C-contiguous numpy array"
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" \
+        % (numpy.lib.format.dtype_to_descr(value.dtype), value.shape)
+    # data is aligned to 16 octets
+    length = len(NPY_MAGIC) + 4 + len(header) + 1
+    header += " " * (-length % 16) + "\n"
+    return NPY_MAGIC + "\x01\x00" + pack("<H", len(header)) + header
+
+
+def readNpy(data):
+    "Make numpy array that shares memory with data (unless byteswap is needed)"
+    if data[6] == "\x01":
+        start = 10
+        length = unpack("<H", data[8 : start])[0]
+    else:
+        start = 12
+        length = unpack("<I", data[8 : start])[0]
+    header = literal_eval(data[start : start + length])
+    dtype = numpy.dtype(header["descr"])
+    shape = header["shape"]
+    count = 1
+    for n in shape:
+        count *= n
+    if count == 0:
+        return numpy.empty(shape, dtype)
+    if header["fortran_order"]:
+        order = "F"
+    else:
+        order = "C"
+    result = numpy.frombuffer(data, dtype, count, start + length)
+    result = result.reshape(shape, order=order)
+    if not dtype.isnative:
+        result = result.astype(dtype.newbyteorder("="))
+    return result
+
+
+if numpy is not None:
+    class NumpyArray(Array):
+        """Serialises numpy arrays. 
+        In "list" mode numeric arrays are written as typed lists of 
+        their elements (in C order), shape of multidimensional array is 
+        appended to type name. Other arrays are written as nested lists.
+        In "binary" mode array is written as Binary in NPY format.
+        If mode is not set then WriteContext.numpyArrays is used.
+        To select mode for a value pass NumpyArray(mode) to writeObject.
+        Note: numpy arrays are decoded if ParseContext.numericLists 
+        or ParseContext.numpyBinaries options are set."""
+        ptype = numpy.ndarray
+        
+        binary_streamer = Binary()
+        
+        def __init__(self, mode=None):
+            self.mode = mode
+        
+        def write(self, ctx, value):
+            if value.ndim == 0:
+                writeObject(ctx, value.item(), None)
+            elif (self.mode or ctx.numpyArrays) == "binary":
+                if value.dtype.hasobject:
+                    raise HessianError("Can not write array of objects as binary")
+                value = numpy.ascontiguousarray(value)
+                self.binary_streamer.write(ctx, npyHeader(value) + value.tostring())
+            else:
+                Array.write(self, ctx, value)
+        
+        def _write(self, ctx, value):
+            packed = packNumpyNumbers(value.ravel())
+            if packed is None:
+                Array._write(self, ctx, value.tolist())
+                return
+            code, data = packed
+            ctx.write(self.codes[0])
+            typeName = ARRAY_TYPE_NAMES[code]
+            if value.ndim != 1:
+                typeName += "[%s]" % ",".join([str(n) for n in value.shape])
+            self.type_streamer.write(ctx, typeName)
+            self.length_streamer.write(ctx, value.size)
+            ctx.write(data)
+            ctx.write("z")
+    types.append(NumpyArray)
+
+
 class Map:
     codes = ["M"]
     ptype = dict
 
     type_streamer = TypeName()
     
+    def open(self, ctx, prefix):
+        "Start reading map (see Frame)"
+        assert prefix in self.codes
+        prefix = ctx.read(1)
+        if prefix in TypeName.codes:
+            typeName = self.type_streamer.read(ctx, prefix)
+            prefix = ctx.read(1)
+            streamer = ctx.classes.get(typeName)
+            if streamer is not None:
+                return Frame(streamer.readFields(ctx, prefix), False, 0)
+        result = {}
+        ctx.referencedObjects.append(result)
+        if prefix == "z":
+            return Frame(result, True, 0)
+        return Frame(result, True, -1, "z", prefix)
+    
     def read(self, ctx, prefix):
         assert prefix in self.codes
         prefix = ctx.read(1)
         if prefix in TypeName.codes:
-            self.type_streamer.read(ctx, prefix)
+            typeName = self.type_streamer.read(ctx, prefix)
             prefix = ctx.read(1)
+            streamer = ctx.classes.get(typeName)
+            if streamer is not None:
+                return streamer.readFields(ctx, prefix)
         result = {}
         ctx.referencedObjects.append(result)        
         while prefix != "z":
@@ -388,6 +1369,16 @@ class Map:
             prefix = ctx.read(1)
         return result
     
+    def begin(self, ctx, mapping):
+        "Start writing map (see Array.begin)"
+        if ctx.references != "off":
+            objId = ctx.getRefId(mapping)
+            if objId != -1:
+                Ref().write(ctx, objId)
+                return None
+        ctx.write(self.codes[0])
+        return (chain.from_iterable(mapping.iteritems()), "z")
+
     def _write(self, ctx, mapping):
         ctx.write(self.codes[0])
         for k, v in mapping.items():
@@ -400,6 +1391,139 @@ class Map:
 types.append(Map)    
 
 
+END = object() # marks end of map in typed object decoders
+
+
+def encodeValue(value):
+    "Encoded value (without references to other values)"
+    ctx = BufferedWriteContext(None)
+    writeObject(ctx, value, None)
+    return ctx.getvalue()
+
+
+class TypedObject:
+    """Serialises instances of a Python class as typed maps 
+    (M t<typeName> field value ... z), see TypeRegistry.registerClass.
+    
+    Encoder and decoder specialized for the class are generated once. 
+    Encoder writes pre-encoded type name and keys and reads attributes 
+    directly. Decoder expects fields in the order they are written 
+    and falls back to matching by name if they come in other order. 
+    Unknown fields are skipped, missing ones are not set 
+    (or are None for namedtuples). 
+    
+    Namedtuples are created after their fields are read, 
+    so they can not contain references to themselves."""
+    codes = []
+    
+    def __init__(self, pythonClass, typeName, fields):
+        """fields - names of attributes or (attribute, field name) pairs"""
+        self.ptype = pythonClass
+        self.typeName = typeName
+        self.attributes = []
+        self.fieldNames = []
+        for f in fields:
+            if isinstance(f, tuple):
+                attribute, name = f
+            else:
+                attribute, name = f, f
+            self.attributes.append(attribute)
+            self.fieldNames.append(unicode(name))
+        if not fields:
+            raise HessianError("No fields to serialize in %s" % `pythonClass`)
+        isTuple = issubclass(pythonClass, tuple)
+        namespace = {"writeObject" : writeObject, 
+                     "readObject" : readObject,
+                     "readObjectByPrefix" : readObjectByPrefix,
+                     "END" : END,
+                     "cls" : pythonClass,
+                     "new" : isTuple and tuple.__new__ or pythonClass.__new__,
+                     "attributes" : dict(zip(self.fieldNames, self.attributes))}
+        exec self.writerSource(isTuple) in namespace
+        exec self.readerSource(isTuple) in namespace
+        self._write = namespace["write"]
+        self.readFields = namespace["readFields"]
+        
+    def writerSource(self, isTuple):
+        head = "M" + TAGGED_SHORT.pack("t", len(self.typeName)) + self.typeName
+        lines = ["def write(ctx, value):", 
+                 "    write = ctx.write"]
+        if isTuple:
+            lines.append("    %s, = value" % ", ".join(
+                ["f%d" % k for k in range(len(self.attributes))]))
+        for k, (attribute, name) in enumerate(zip(self.attributes, self.fieldNames)):
+            lines.append("    write(%r)" % (head + encodeValue(name)))
+            head = ""
+            if isTuple:
+                lines.append("    writeObject(ctx, f%d, None)" % k)
+            else:
+                lines.append("    writeObject(ctx, value.%s, None)" % attribute)
+        lines.append("    write(%r)" % (head + "z"))
+        return "\n".join(lines) + "\n"
+    
+    def readerSource(self, isTuple):
+        lines = ["def readFields(ctx, prefix):",
+                 "    read = ctx.read",
+                 "    refs = ctx.referencedObjects",
+                 "    index = len(refs)"]
+        if isTuple:
+            lines.append("    refs.append(None) # not created yet")
+            for k in range(len(self.attributes)):
+                lines.append("    f%d = None" % k)
+        else:
+            lines += ["    result = new(cls)",
+                      "    refs.append(result)"]
+        nextKey = "    key = prefix == 'z' and END or readObjectByPrefix(ctx, prefix)"
+        lines.append(nextKey)
+        # fields in expected order
+        for k, (attribute, name) in enumerate(zip(self.attributes, self.fieldNames)):
+            if isTuple:
+                target = "f%d" % k
+            else:
+                target = "result.%s" % attribute
+            lines += ["    if key == %r:" % name,
+                      "        %s = readObject(ctx)" % target,
+                      "        prefix = read(1)",
+                      "    " + nextKey]
+        # remaining fields in any order
+        lines += ["    if key is not END:",
+                  "        rest = {}",
+                  "        while key is not END:",
+                  "            rest[key] = readObject(ctx)",
+                  "            prefix = read(1)",
+                  "        " + nextKey]
+        if isTuple:
+            for k, name in enumerate(self.fieldNames):
+                lines.append("        f%d = rest.get(%r, f%d)" % (k, name, k))
+            lines += ["    result = new(cls, (%s,))" % ", ".join(
+                          ["f%d" % k for k in range(len(self.attributes))]),
+                      "    refs[index] = result"]
+        else:
+            lines += ["        for key, value in rest.items():",
+                      "            if key in attributes:",
+                      "                setattr(result, attributes[key], value)"]
+        lines.append("    return result")
+        return "\n".join(lines) + "\n"
+    
+    def write(self, ctx, value):
+        writeReferenced(ctx, self._write, value)
+
+
+def classFields(pythonClass):
+    "Names of fields of namedtuple or class with __slots__"
+    if issubclass(pythonClass, tuple) and hasattr(pythonClass, "_fields"):
+        return list(pythonClass._fields)
+    fields = []
+    for base in reversed(getmro(pythonClass)):
+        slots = base.__dict__.get("__slots__", ())
+        if isinstance(slots, basestring):
+            slots = [slots]
+        fields += [f for f in slots if f not in ("__dict__", "__weakref__")]
+    if not fields:
+        raise HessianError("Fields of %s should be given" % `pythonClass`)
+    return fields
+
+
 class Ref(BasicInt):
     """ Reference to a previously occured object 
     (allows sharing objects in a map or a list) """
@@ -474,9 +1598,8 @@ class Call:
             
         return (method, headers, params)
 
-    def write(self, ctx, value):
-        # headers can be None or map of headers (header title->value)
-        method, headers, params = value
+    def writeStart(self, ctx, method, headers):
+        "Write call up to its parameters"
         ctx.write(self.codes[0])
         writeVersion(ctx)
         
@@ -488,12 +1611,24 @@ class Call:
         # write method
         self.method_streamer.write(ctx, method)
         
-        # write params
-        if params != None:
-            for v in params:
-                writeObject(ctx, v, None)
-                
+    def write(self, ctx, value):
+        # headers can be None or map of headers (header title->value)
+        method, headers, params = value
+        self.writeStart(ctx, method, headers)
+        self.writeParams(ctx, params or [])
+    
+    def writeParams(self, ctx, params):
+        "Write parameters and end of call"
+        for v in params:
+            writeObject(ctx, v, None)
         ctx.write("z");
+    
+    def template(self, method):
+        """Encoded start of call without headers. Calls of the method 
+        are this string followed by parameters and "z"."""
+        ctx = BufferedWriteContext(None)
+        self.writeStart(ctx, method, None)
+        return ctx.getvalue()
 types.append(Call)
 
 
@@ -535,7 +1670,10 @@ class Reply:
     header_streamer = Header()
     fault_streamer = Fault()
     
-    def read(self, ctx, prefix):
+    def readStart(self, ctx, prefix):
+        """Read reply up to its result. Returns (headers, succeeded, value)
+        where value is the fault if call failed or prefix of the result
+        otherwise. Result itself follows in ctx."""
         assert prefix in self.codes[0]
         # parse header 'r' x01 x00 ... 'z'
         readVersion(ctx)        
@@ -546,18 +1684,22 @@ class Reply:
             headers.append(self.header_streamer.read(ctx, prefix))
             prefix = ctx.read(1)        
 
-        succeeded = not prefix in self.fault_streamer.codes
-        
+        if prefix in self.fault_streamer.codes:
+            # closing "z" is read by Fault.read
+            return (headers, False, self.fault_streamer.read(ctx, prefix))
+        return (headers, True, prefix)
+    
+    def read(self, ctx, prefix):
+        (headers, succeeded, result) = self.readStart(ctx, prefix)
         if succeeded:
-            result = readObjectByPrefix(ctx, prefix)
-            prefix = ctx.read(1)
-            if prefix != 'z':
-                raise HessianError("No closing marker in reply.")
-        else:
-            result = self.fault_streamer.read(ctx, prefix)
-            # closing "z" is already read by Fault.read
-        
+            result = readObjectByPrefix(ctx, result)
+            self.readEnd(ctx)
         return (headers, succeeded, result)
+    
+    def readEnd(self, ctx):
+        "Read closing marker of succeeded reply"
+        if ctx.read(1) != 'z':
+            raise HessianError("No closing marker in reply.")
 
     def write(self, ctx, reply):
         (headers, succeeded, result) = reply
@@ -639,40 +1781,664 @@ def makeTypeMaps(types):
     return codeMap, typeMap
 
 
-CODE_MAP, TYPE_MAP = makeTypeMaps(types)
+class TypeRegistry:
+    """Set of serializers (found by Python class) and deserializers 
+    (found by type code). Serializer for a class that is not registered 
+    is looked up along the class' MRO once and then cached.
+    
+    Contexts use global REGISTRY unless other registry is given,
+    so different services can use different type mappings."""
+    
+    def __init__(self, types):
+        self.codeMap, self.typeMap = makeTypeMaps(types)
+        self.cache = dict(self.typeMap) # Python class to streamer
+        self.classes = {} # type name of typed map to TypedObject
+        # registries derived from this one (see hessian2.registryFor), 
+        # they are dropped when classes are registered
+        self.derived = {}
+    
+    def copy(self):
+        "Registry that can be altered without affecting this one"
+        result = TypeRegistry([])
+        result.codeMap.update(self.codeMap)
+        result.typeMap.update(self.typeMap)
+        result.cache.update(self.typeMap)
+        result.classes.update(self.classes)
+        return result
+    
+    def registerClass(self, pythonClass, typeName, fields=None):
+        """Serialize instances of pythonClass as typed maps with given 
+        type name (e.g. Java class name) and read such maps as instances.
+        fields - attribute names or (attribute, field name) pairs, 
+        default are fields of namedtuple or __slots__ of the class.
+        Returns TypedObject streamer."""
+        if fields is None:
+            fields = classFields(pythonClass)
+        streamer = TypedObject(pythonClass, typeName, fields)
+        self.register(streamer)
+        self.classes[typeName] = streamer
+        self.derived.clear()
+        return streamer
+        
+    def register(self, streamer):
+        """Add (or replace) serializer and deserializer.
+        Registered streamers override ones of the same codes or ptype."""
+        for ch in streamer.codes:
+            self.codeMap[ch] = streamer
+        if hasattr(streamer, "ptype"):
+            self.typeMap[streamer.ptype] = streamer
+        else:
+            self.typeMap[streamer.__class__] = streamer
+        self.derived.clear()
+        # resolved subclasses may be affected, update cache in place 
+        # as contexts keep reference to it
+        self.cache.clear()
+        self.cache.update(self.typeMap)
+        
+    def resolve(self, pythonClass):
+        "Return streamer for values of given class"
+        try:
+            return self.cache[pythonClass]
+        except KeyError:
+            pass
+        for base in getmro(pythonClass):
+            if base in self.typeMap:
+                streamer = self.typeMap[base]
+                break
+        else:
+            # abstract base classes (e.g. Iterator) are not in MRO
+            for ptype, streamer in self.typeMap.items():
+                if isinstance(ptype, type) and issubclass(pythonClass, ptype):
+                    break
+            else:
+                raise HessianError("Can not serialize value of type " + `pythonClass`)
+        self.cache[pythonClass] = streamer
+        return streamer
+
+
+REGISTRY = TypeRegistry(types)
+CODE_MAP, TYPE_MAP = REGISTRY.codeMap, REGISTRY.typeMap
+
+
+def setRegistry(ctx, registry):
+    "Attach type registry to parse or write context."
+    if registry is None:
+        registry = REGISTRY
+    derive = getattr(ctx, "deriveRegistry", None)
+    if derive is not None:
+        registry = derive(registry)
+    ctx.registry = registry
+    ctx.codeMap = registry.codeMap
+    ctx.classes = registry.classes
+    ctx.typeCache = registry.cache
+    
 
+def setOptions(ctx, options):
+    """Set context's options (class attributes of ParseContext and 
+    WriteContext) from dictionary"""
+    for name, value in options.items():
+        if not hasattr(ctx.__class__, name):
+            raise HessianError("Unknown option '%s' of %s" % (name, ctx.__class__))
+        if numpy is None and (value == "numpy" or name == "numpyBinaries" and value):
+            raise HessianError("Option '%s' = %r requires numpy module" % (name, value))
+        setattr(ctx, name, value)
+    
 
 class ParseContext:
-    def __init__(self, stream, post=lambda x: x):
+    
+    # Options (see also setOptions):
+    
+    # Decode homogeneous lists of I, L or D values at once
+    # as "array" (array.array) or "numpy" (numpy.ndarray).
+    # This is supported by BufferedParseContext only.
+    numericLists = None
+    
+    # Decode binaries in NPY format as numpy arrays
+    numpyBinaries = False
+    
+    # Read single chunk binaries as memoryviews of received data 
+    # instead of copying them (multiple chunks are joined once). 
+    # Note that a view keeps whole buffer it refers to in memory.
+    # This is supported by BufferedParseContext only.
+    binaryViews = False
+    
+    # How naive datetimes are converted from milliseconds since epoch 
+    # (same for WriteContext): "local" - local time (with DST changes 
+    # as of each date, slow), "utc" - UTC time, "offset" - local time 
+    # with UTC offset that is current when first date is converted.
+    # Dates with tzinfo are always converted by their UTC offset.
+    dates = "local"
+    
+    # Decode lists of dates at once as "datetime" (list of datetime), 
+    # "milliseconds" (array.array of milliseconds since epoch)
+    # or "numpy" (numpy datetime64 array). 
+    # This is supported by BufferedParseContext only.
+    dateLists = None
+    
+    # Strings of up to this many symbols (e.g. map keys) are shared:
+    # equal strings of a message are decoded to the same object. 
+    # 0 disables sharing.
+    internStrings = 0
+    # Bound of number of shared strings (see InternTable)
+    internTableSize = 2 ** 12
+    
+    def __init__(self, stream, post=lambda x: x, registry=None):
         """post - post-processing function for deserialized object.
         Note: not all streamers use self.post
+        registry - TypeRegistry to use (default is global REGISTRY)
         """
         self.referencedObjects = [] # objects that may be referenced by Ref
         self.objectIds = {}
-        self.stream = stream        
-        self.read = stream.read
+        self.stream = stream
+        if stream is not None:
+            self.read = stream.read
         self.post = post
+        self.internTable = None
+        self.localOffset = None # see dateOffset
+        self.stats = None # see instrument
+        setRegistry(self, registry)
+    
+    def intern(self, value):
+        "Shared string equal to value"
+        if self.internTable is None:
+            self.internTable = InternTable(self.internTableSize)
+        return self.internTable.get(value)
+
+
+class InternTable:
+    """Bounded table of shared strings. Strings are kept in two 
+    generations of size/2 each. When recent generation is full it 
+    replaces previous one, so strings that are not met during two 
+    generations are evicted."""
+    
+    def __init__(self, size):
+        self.size = max(size // 2, 1)
+        self.recent = {}
+        self.previous = {}
+        
+    def get(self, value):
+        "Shared string equal to value"
+        try:
+            return self.recent[value]
+        except KeyError:
+            pass
+        value = self.previous.pop(value, value)
+        if len(self.recent) >= self.size:
+            self.previous = self.recent
+            self.recent = {}
+        self.recent[value] = value
+        return value
+
+
+class BufferedParseContext(ParseContext):
+    """Parse context that pulls its stream in large windows and serves
+    streamers' reads from memory by advancing an offset.
+    
+    Source is either a stream or a string (or buffer, e.g. of mmap) 
+    holding whole message.
+    """
+    
+    window_size = 2 ** 16 # 64KiB
+    
+    def __init__(self, source, post=lambda x: x, length=None, registry=None):
+        """length - number of octets that belong to the message 
+        (e.g. HTTP's Content-Length). If None then stream is read 
+        until its end. Never read past the message if stream is a socket 
+        that is kept open, specify length instead.
+        """
+        ParseContext.__init__(self, None, post, registry)
+        if isinstance(source, (str, buffer)):
+            self.buffer = source
+            self.stream = None
+            self.remaining = 0
+        else:
+            self.buffer = ""
+            self.stream = source
+            self.remaining = length
+        self.pos = 0 # read position in self.buffer
+        self.end = len(self.buffer)
+        self.base = 0 # offset of self.buffer's start in the message 
+        
+    def read(self, count):
+        pos = self.pos
+        end = pos + count
+        if end > self.end:
+            self.fill(count)
+            pos = self.pos
+            end = min(pos + count, self.end)
+        self.pos = end
+        return self.buffer[pos : end]
+    
+    def fill(self, count):
+        """Make at least count octets available starting from self.pos 
+        (if the stream has them). Consumed data is dropped from buffer.
+        Returns number of available octets."""
+        chunks = [self.buffer[self.pos : ]]
+        available = len(chunks[0])
+        while available < count and self.stream is not None:
+            size = max(count - available, self.window_size)
+            if self.remaining is not None:
+                size = min(size, self.remaining)
+            data = size and self.stream.read(size)
+            if not data:
+                self.stream = None # no more data
+                break
+            if self.remaining is not None:
+                self.remaining -= len(data)
+            chunks.append(data)
+            available += len(data)
+        self.base += self.pos
+        self.buffer = "".join(chunks)
+        self.pos = 0
+        self.end = available
+        return available
+    
+    def view(self, count):
+        """Same as read(count) but returns memoryview of buffer 
+        (or buffer object if source is a buffer)"""
+        pos = self.pos
+        end = pos + count
+        if end > self.end:
+            self.fill(count)
+            pos = self.pos
+            end = min(pos + count, self.end)
+        self.pos = end
+        # buffer is replaced, not modified, on fill so view stays valid
+        if isinstance(self.buffer, buffer):
+            return buffer(self.buffer, pos, end - pos)
+        return memoryview(self.buffer)[pos : end]
+    
+    def peek(self, count):
+        "Next count octets (or less at stream end). They are not consumed."
+        if self.pos + count > self.end:
+            self.fill(count)
+        return self.buffer[self.pos : self.pos + count]
+    
+    def tell(self):
+        "Position in message"
+        return self.base + self.pos
 
 
 class WriteContext:
-    def __init__(self, stream, pre=lambda x: x):
+    
+    # Options (see also setOptions):
+    
+    # How numpy arrays are written by default: "list" or "binary" 
+    # (see NumpyArray)
+    numpyArrays = "list"
+    
+    # Back references to lists and maps that are met again:
+    # "off" - no references (tree-shaped data only, cycles never end), 
+    # "identity" - reference to same object,
+    # "value" - also reference to equal tuple 
+    references = "identity"
+    
+    # How naive datetimes are converted (see ParseContext.dates)
+    dates = "local"
+    
+    def __init__(self, stream, pre=identity, registry=None):
         """pre - pre-processing function for object being written. 
         Note: not all streamers use self.pre
+        registry - TypeRegistry to use (default is global REGISTRY)
         """
         self.objectIds = {} # is used for back references
+        self.referenced = [] # keeps objects alive so their ids are not reused
         self.count = 0
+        self.localOffset = None # see dateOffset
+        self.stats = None # see instrument
         self.stream = stream
-        self.write = stream.write
+        if stream is not None:
+            self.write = stream.write
         self.pre = pre
+        setRegistry(self, registry)
         
+    def writeView(self, data):
+        """Write buffer or memoryview that shares memory of value 
+        being written (see BinaryView)"""
+        self.write(data)
+
     def getRefId(self, obj):
         "Return numeric reference id if object has been already met."
+        key = id(obj)
+        if self.references == "value" and obj.__class__ is tuple:
+            try:
+                key = valueKey(obj)
+            except TypeError:
+                pass # has mutable elements 
         try:
-            return self.objectIds[id(obj)]
+            return self.objectIds[key]
         except KeyError:
-            self.objectIds[id(obj)] = self.count
+            self.objectIds[key] = self.count
+            self.referenced.append(obj)
             self.count += 1
             return - 1
+    
+    def sync(self):
+        """Streamers of values that are produced while they are written 
+        call this between parts of value."""
+        pass
+
+
+def valueKey(value):
+    """Hashable key that is equal for values which are written same way.
+    Raises TypeError if value is mutable."""
+    if value.__class__ is tuple:
+        return (tuple, tuple([valueKey(v) for v in value]))
+    elif value.__class__ is float:
+        return (float, DOUBLE.pack(value)) # 0.0 differs from -0.0
+    hash(value)
+    return (value.__class__, value)
+
+
+class BufferedWriteContext(WriteContext):
+    """Write context that collects message fragments in memory and 
+    hands whole message to the stream with single write on flush.
+    Stream may be None if only getvalue() is used."""
+    
+    # Options (see also setOptions):
+    
+    # Write collected fragments to the stream on every sync(), 
+    # so message is sent while it is produced (see Iteration)
+    streaming = False
+    
+    def __init__(self, stream, pre=identity, registry=None):
+        WriteContext.__init__(self, stream, pre, registry)
+        self.fragments = []
+        self.write = self.fragments.append
+        self.views = False # some fragments are not strings
+    
+    def writeView(self, data):
+        self.views = True
+        self.write(data)
+    
+    def join(self):
+        "Fragments copied once into single bytearray"
+        fragments = self.fragments
+        data = bytearray(sum(map(len, fragments)))
+        pos = 0
+        for fragment in fragments:
+            end = pos + len(fragment)
+            data[pos : end] = fragment
+            pos = end
+        return data
+        
+    def getvalue(self):
+        "Message written so far"
+        fragments = self.fragments
+        if len(fragments) != 1 or self.views:
+            # collapse so next call does not join again
+            if self.views:
+                fragments[:] = [str(self.join())]
+                self.views = False
+            else:
+                fragments[:] = ["".join(fragments)]
+        return fragments[0]
+    
+    def flush(self):
+        "Write collected message to stream."
+        if self.views:
+            # stream gets bytearray, not copied again to string
+            data = self.join()
+            self.views = False
+        else:
+            data = self.getvalue()
+        del self.fragments[:]
+        self.stream.write(data)
+    
+    def sync(self):
+        if self.streaming:
+            self.flush()
+
+
+class SizingContext(WriteContext):
+    """Write context that only counts octets of written message, 
+    so exact size of a message can be known before it is sent 
+    (e.g. for HTTP's Content-Length). Values are sized by 'size' 
+    (or 'sizeBegin') methods of streamers without encoding them, 
+    values of other streamers are written and counted (see SizedStreamer). 
+    Back references, chunks and UTF-8 are accounted for. 
+    Use same options as in context that writes the message. 
+    Iterators can not be sized as they are consumed by writing."""
+    
+    def __init__(self, pre=identity, registry=None):
+        self.size = 0
+        WriteContext.__init__(self, None, pre, registry)
+    
+    def write(self, data):
+        self.size += len(data)
+    
+    def deriveRegistry(self, registry):
+        "See setRegistry"
+        return sizing(registry)
+
+
+class SizedStreamer:
+    """Streamer that adds size of value to SizingContext's size 
+    if streamer can tell it, else writes value (see SizingContext)"""
+    
+    def __init__(self, streamer):
+        self.streamer = streamer
+        self.sizeOf = methodOf(streamer, "size")
+        self.begin = methodOf(streamer, "sizeBegin") or beginOf(streamer)
+    
+    def write(self, ctx, value):
+        if self.sizeOf is None:
+            self.streamer.write(ctx, value)
+        else:
+            ctx.size += self.sizeOf(ctx, value)
+
+
+def sizing(registry):
+    """Copy of registry which streamers size values (see SizingContext)"""
+    try:
+        return registry.derived["sizing"]
+    except KeyError:
+        pass
+    result = registry.copy()
+    result.derived["write"] = {} # no inline encoding
+    result.derived["begin"] = {}
+    result.derived["sizing"] = result
+    result.cache = StreamerWrappers(registry, SizedStreamer)
+    registry.derived["sizing"] = result
+    return result
+
+
+class Statistics:
+    """Counts of values read or written with instrumented context 
+    (see instrument). Octets and seconds of a value do not include 
+    ones of values nested in it, so time is attributed to types 
+    it is spent on. Octets of list and map end markers are not 
+    attributed to any type.
+    
+    types - type code (first octet of value) to [values, octets, seconds],
+    octets - octets read or written so far,
+    depth - deepest nesting of lists and maps,
+    references - size of reference table."""
+    
+    def __init__(self):
+        self.types = {}
+        self.octets = 0
+        self.depth = 0
+        self.references = 0
+        self.level = 0 # nesting of current value
+        self.nestedOctets = 0 # of values nested in one being timed
+        self.nestedSeconds = 0.0
+        self.code = None # first octet written of value being timed
+    
+    def start(self):
+        "Start timing a value. Returns state to pass to account()."
+        saved = (self.nestedOctets, self.nestedSeconds)
+        self.nestedOctets = 0
+        self.nestedSeconds = 0.0
+        return saved
+    
+    def account(self, code, saved, octets, seconds):
+        "Add value which octets and seconds include nested values"
+        try:
+            entry = self.types[code]
+        except KeyError:
+            entry = self.types[code] = [0, 0, 0.0]
+        entry[0] += 1
+        entry[1] += octets - self.nestedOctets
+        entry[2] += seconds - self.nestedSeconds
+        self.nestedOctets = saved[0] + octets
+        self.nestedSeconds = saved[1] + seconds
+    
+    def enter(self):
+        "Nested list or map starts"
+        self.level += 1
+        if self.level > self.depth:
+            self.depth = self.level
+    
+    def __str__(self):
+        lines = ["code     values     octets    seconds"]
+        for code, (values, octets, seconds) in sorted(self.types.items()):
+            lines.append("%-6s %8d %10d %10.6f" % (`code`, values, octets, seconds))
+        lines.append("octets %d, depth %d, references %d" 
+                     % (self.octets, self.depth, self.references))
+        return "\n".join(lines)
+
+
+def timedReader(read):
+    "Jump table's reader (see readers) that accounts values in ctx.stats"
+    def timed(ctx, prefix):
+        stats = ctx.stats
+        saved = stats.start()
+        start = ctx.tell()
+        started = default_timer()
+        value = read(ctx, prefix)
+        seconds = default_timer() - started
+        stats.octets = ctx.tell()
+        octets = stats.octets - start + 1 # with prefix
+        if value.__class__ is Frame:
+            if value.prefix is not None:
+                octets -= 1 # is accounted with first element
+            stats.enter()
+            value.finish = leaving(ctx, value.finish)
+        stats.account(prefix, saved, octets, seconds)
+        stats.references = len(ctx.referencedObjects)
+        return value
+    return timed
+
+
+def leaving(ctx, finish):
+    "Frame's finish function that also tracks nesting"
+    def leave(container):
+        stats = ctx.stats
+        stats.level -= 1
+        stats.octets = ctx.tell() # with end marker
+        if finish is None:
+            return container
+        return finish(container)
+    return leave
+
+
+def tracked(stats, elements):
+    "Elements of list or map being written, tracks nesting"
+    stats.enter()
+    for element in elements:
+        yield element
+    stats.level -= 1
+
+
+class TimedStreamer:
+    "Streamer that accounts values it writes in ctx.stats"
+    
+    def __init__(self, streamer):
+        self.streamer = streamer
+        if beginOf(streamer) is None:
+            self.begin = None # see writeObject
+    
+    def write(self, ctx, value):
+        self.timed(ctx, self.streamer.write, value)
+    
+    def begin(self, ctx, value):
+        started = self.timed(ctx, self.streamer.begin, value)
+        if started is not None:
+            elements, closing = started
+            started = (tracked(ctx.stats, elements), closing)
+        return started
+    
+    def timed(self, ctx, method, value):
+        stats = ctx.stats
+        saved = stats.start()
+        outerCode = stats.code
+        stats.code = None
+        start = stats.octets
+        started = default_timer()
+        result = method(ctx, value)
+        seconds = default_timer() - started
+        stats.account(stats.code, saved, stats.octets - start, seconds)
+        if outerCode is not None:
+            stats.code = outerCode
+        # else first octet of enclosing value is this value's one
+        stats.references = ctx.count
+        return result
+
+
+class StreamerWrappers(dict):
+    """Python class to wrapper of registry's streamer 
+    (e.g. TimedStreamer), used as type cache of contexts"""
+    
+    def __init__(self, registry, wrapper):
+        dict.__init__(self)
+        self.registry = registry
+        self.wrapper = wrapper
+    
+    def __missing__(self, cls):
+        result = self[cls] = self.wrapper(self.registry.resolve(cls))
+        return result
+    
+    def get(self, cls, default=None):
+        # packNumbers checks classes of original streamers
+        return self.registry.cache.get(cls, default)
+
+
+def instrumented(registry):
+    """Copy of registry which readers and streamers account values 
+    in context's statistics (see instrument)"""
+    try:
+        return registry.derived["instrumented"]
+    except KeyError:
+        pass
+    result = registry.copy()
+    result.derived["read"] = dict([(code, timedReader(read)) 
+                                   for code, read in readers(registry).items()])
+    result.derived["write"] = {} # no inline encoding
+    result.derived["begin"] = {}
+    result.derived["instrumented"] = result
+    result.cache = StreamerWrappers(registry, TimedStreamer)
+    registry.derived["instrumented"] = result
+    return result
+
+
+def instrument(ctx, stats=None):
+    """Collect Statistics of values read or written with parse or write 
+    context. Call this when context is prepared (e.g. by hessian2.attach). 
+    Contexts that are not instrumented are not slowed down. 
+    Returns the statistics (also available as ctx.stats)."""
+    if stats is None:
+        stats = Statistics()
+    ctx.stats = stats
+    setRegistry(ctx, instrumented(ctx.registry))
+    if isinstance(ctx, ParseContext):
+        if not hasattr(ctx, "tell"):
+            read = ctx.read
+            def countedRead(count):
+                data = read(count)
+                stats.octets += len(data)
+                return data
+            ctx.read = countedRead
+            ctx.tell = lambda: stats.octets
+    else:
+        write = ctx.write
+        def countedWrite(data):
+            if stats.code is None:
+                stats.code = str(data[:1])
+            stats.octets += len(data)
+            write(data)
+        ctx.write = countedWrite
+    return stats
 
 
 def printRegisteredTypes():
@@ -0,0 +1,1094 @@
+#
+# Hessian protocol implementation
+# This file contains Hessian 2.0 serialization/deserialization code.
+#
+# Protocol specification can be found here:
+# http://hessian.caucho.com/doc/hessian-serialization.html
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Hessian 2.0 streamers.
+
+Values are read and written with hessian.readObject and hessian.writeObject
+using contexts that are prepared by attach(). These contexts carry tables
+of class definitions and type names that 2.0 messages refer to.
+
+Calls and replies start with "H" x02 x00 followed by "C" (call),
+"R" (reply) or "F" (fault). A peer tells protocol version of a message
+by its first octet: "c" or "r" for 1.0 and "H" for 2.0.
+
+Hessian 2.0 has no headers and no remote references. XML strings are
+written as strings.
+
+Elements of array.array, numpy arrays and hessian.DateColumn are written
+at once with fixed size encodings (I, L, D and J) rather than compact ones.
+Options numericLists, dateLists and numpyBinaries read them at once
+as in Hessian 1.0.
+"""
+
+from array import array
+from collections import Iterator
+from itertools import chain
+from datetime import datetime
+from math import copysign
+from struct import Struct
+import hessian
+from hessian import INT, LONG, SHORT, DOUBLE, \
+    TAGGED_INT, TAGGED_LONG, TAGGED_SHORT, TAGGED_DOUBLE, \
+    Frame, readObject, readObjectByPrefix, writeObject
+import UTF8
+from common import HessianError
+
+__revision__ = "$Rev$"
+
+types = []
+
+VERSION = "\x02\x00"
+
+TAGGED_BYTE = Struct(">cb")
+TAGGED_SIGNED_SHORT = Struct(">ch")
+
+
+def codeRange(first, last):
+    "Type codes from first to last inclusive"
+    return [chr(c) for c in range(first, last + 1)]
+
+
+# one octet ints -16..47
+COMPACT_INTS = codeRange(0x80, 0xbf)
+
+
+def encodeInt(value):
+    "Shortest encoding of 32 bit int (longer ints are encoded as long)"
+    if -0x10 <= value < 0x30:
+        return COMPACT_INTS[value + 0x10]
+    elif -0x800 <= value < 0x800:
+        return chr(0xc8 + (value >> 8)) + chr(value & 0xff)
+    elif -0x40000 <= value < 0x40000:
+        return chr(0xd4 + (value >> 16)) + SHORT.pack(value & 0xffff)
+    elif hessian.INT_RANGE[0] <= value < hessian.INT_RANGE[1]:
+        return TAGGED_INT.pack("I", value)
+    return encodeLong(value)
+
+
+def encodeLong(value):
+    "Shortest encoding of 64 bit long"
+    if -0x08 <= value < 0x10:
+        return chr(0xe0 + value)
+    elif -0x800 <= value < 0x800:
+        return chr(0xf8 + (value >> 8)) + chr(value & 0xff)
+    elif -0x40000 <= value < 0x40000:
+        return chr(0x3c + (value >> 16)) + SHORT.pack(value & 0xffff)
+    elif hessian.INT_RANGE[0] <= value < hessian.INT_RANGE[1]:
+        return TAGGED_INT.pack("Y", value)
+    return TAGGED_LONG.pack("L", value)
+
+
+def encodeDouble(value):
+    "Shortest encoding of double"
+    if -0x8000 <= value < 0x8000:
+        n = int(value)
+        if n == value:
+            if n == 0:
+                if copysign(1.0, value) < 0:
+                    return TAGGED_DOUBLE.pack("D", value) # -0.0
+                return "\x5b"
+            elif n == 1:
+                return "\x5c"
+            elif -0x80 <= n < 0x80:
+                return TAGGED_BYTE.pack("\x5d", n)
+            return TAGGED_SIGNED_SHORT.pack("\x5e", n)
+        mills = int(value * 1000)
+        if 0.001 * mills == value:
+            return TAGGED_INT.pack("\x5f", mills)
+    return TAGGED_DOUBLE.pack("D", value)
+
+
+def encodeString(value):
+    "Encoding of string that fits in single chunk, None for longer ones"
+    if len(value) > hessian.Chunked.chunk_size:
+        return None
+    return chunkLengthPrefix(len(value), 0x20, 0x00, 0x30, "S") + value.encode("UTF-8")
+
+
+def encodeBinary(value):
+    "Encoding of binary that fits in single chunk, None for longer ones"
+    if len(value) > hessian.Chunked.chunk_size:
+        return None
+    return chunkLengthPrefix(len(value), 0x10, 0x20, 0x34, "B") + value
+
+
+def chunkLengthPrefix(length, compactLimit, compactCode, mediumCode, code):
+    """Prefix of last chunk of string or binary: one octet for lengths
+    below compactLimit, two octets for lengths below 1024"""
+    if length < compactLimit:
+        return chr(compactCode + length)
+    elif length < 0x400:
+        return chr(mediumCode + (length >> 8)) + chr(length & 0xff)
+    return TAGGED_SHORT.pack(code, length)
+
+
+def intSize(value):
+    "Octets of encodeInt(value)"
+    if -0x10 <= value < 0x30:
+        return 1
+    elif -0x800 <= value < 0x800:
+        return 2
+    elif -0x40000 <= value < 0x40000:
+        return 3
+    elif hessian.INT_RANGE[0] <= value < hessian.INT_RANGE[1]:
+        return 5
+    return longSize(value)
+
+
+def longSize(value):
+    "Octets of encodeLong(value)"
+    if -0x08 <= value < 0x10:
+        return 1
+    elif -0x800 <= value < 0x800:
+        return 2
+    elif -0x40000 <= value < 0x40000:
+        return 3
+    elif hessian.INT_RANGE[0] <= value < hessian.INT_RANGE[1]:
+        return 5
+    return 9
+
+
+def doubleSize(value):
+    "Octets of encodeDouble(value)"
+    if -0x8000 <= value < 0x8000:
+        n = int(value)
+        if n == value:
+            if n == 0:
+                if copysign(1.0, value) < 0:
+                    return 9
+                return 1
+            elif n == 1:
+                return 1
+            elif -0x80 <= n < 0x80:
+                return 2
+            return 3
+        if 0.001 * int(value * 1000) == value:
+            return 5
+    return 9
+
+
+def chunkedSize(length, lastSize, compactLimit):
+    """Octets of string or binary of given length (symbols or octets)
+    but last chunk's data. Last chunk has lastSize symbols."""
+    size = 3 * ((length - lastSize) // hessian.Chunked.chunk_size)
+    if lastSize < compactLimit:
+        return size + 1
+    elif lastSize < 0x400:
+        return size + 2
+    return size + 3
+
+
+def readInt(ctx):
+    "Read int (e.g. length or reference)"
+    return INT_STREAMER.read(ctx, ctx.read(1))
+
+
+def readType(ctx):
+    "Read type name or reference to previously read one"
+    prefix = ctx.read(1)
+    if prefix in INT_CODES:
+        return ctx.typeNames[INT_STREAMER.read(ctx, prefix)]
+    name = STRING_STREAMER.read(ctx, prefix)
+    ctx.typeNames.append(name)
+    return name
+
+
+def writeType(ctx, name):
+    "Write type name or reference to previously written one"
+    try:
+        ctx.write(encodeInt(ctx.typeIds[name]))
+    except KeyError:
+        ctx.typeIds[name] = len(ctx.typeIds)
+        STRING_STREAMER.write(ctx, name)
+
+
+def listStart(ctx, count, typeName=None):
+    "Write start of fixed length list, typed if type name is given"
+    if typeName is None:
+        if count < 8:
+            ctx.write(chr(0x78 + count))
+        else:
+            ctx.write("X" + encodeInt(count))
+    elif count < 8:
+        ctx.write(chr(0x70 + count))
+        writeType(ctx, typeName)
+    else:
+        ctx.write("V")
+        writeType(ctx, typeName)
+        ctx.write(encodeInt(count))
+
+
+# octets of fixed size numbers and dates (milliseconds)
+# that are written at once (see hessian.tagNumbers)
+COLUMN_WIDTHS = {"I" : 4, "L" : 8, "D" : 8, "J" : 8}
+
+
+def peekColumn(ctx, code, count):
+    """Encoded elements of fixed length list of 'count' values that
+    are tagged with code (see COLUMN_WIDTHS). Returns None if list
+    is not such. Data is not consumed."""
+    if not hasattr(ctx, "peek"):
+        return None # can not look ahead in plain stream
+    stride = COLUMN_WIDTHS[code] + 1
+    size = count * stride
+    data = ctx.peek(size)
+    if len(data) != size or data[::stride] != code * count:
+        return None
+    return data
+
+
+def writeReferenced(ctx, writeMethod, obj):
+    """Write reference if object has been met before.
+    Else write object itself."""
+    if ctx.references == "off":
+        writeMethod(ctx, obj)
+        return
+    objId = ctx.getRefId(obj)
+    if objId != -1:
+        ctx.write("Q" + encodeInt(objId))
+    else:
+        writeMethod(ctx, obj)
+
+
+def referencedSize(ctx, obj, size):
+    "Octets that writeReferenced writes (see hessian.referencedSize)"
+    if ctx.references != "off":
+        objId = ctx.getRefId(obj)
+        if objId != -1:
+            return 1 + intSize(objId)
+    return size
+
+
+types.append(hessian.Null)
+types.append(hessian.Bool)
+
+
+class Int:
+    codes = ["I"] + COMPACT_INTS + codeRange(0xc0, 0xd7)
+    ptype = int
+
+    def read(self, ctx, prefix):
+        code = ord(prefix)
+        if code < 0xc0:
+            if prefix == "I":
+                return INT.unpack(ctx.read(4))[0]
+            return code - 0x90
+        elif code < 0xd0:
+            return ((code - 0xc8) << 8) + ord(ctx.read(1))
+        return ((code - 0xd4) << 16) + SHORT.unpack(ctx.read(2))[0]
+
+    encode = staticmethod(encodeInt) # see hessian.writers
+
+    def write(self, ctx, value):
+        ctx.write(encodeInt(value))
+
+    def size(self, ctx, value):
+        "Octets of encoded value (see hessian.SizingContext)"
+        return intSize(value)
+types.append(Int)
+
+
+class Long:
+    codes = ["L", "Y"] + codeRange(0xd8, 0xff) + codeRange(0x38, 0x3f)
+    ptype = long
+
+    def read(self, ctx, prefix):
+        if prefix == "L":
+            return LONG.unpack(ctx.read(8))[0]
+        elif prefix == "Y":
+            return INT.unpack(ctx.read(4))[0]
+        code = ord(prefix)
+        if code >= 0xf0:
+            return ((code - 0xf8) << 8) + ord(ctx.read(1))
+        elif code >= 0xd8:
+            return code - 0xe0
+        return ((code - 0x3c) << 16) + SHORT.unpack(ctx.read(2))[0]
+
+    encode = staticmethod(encodeLong)
+
+    def write(self, ctx, value):
+        ctx.write(encodeLong(value))
+
+    def size(self, ctx, value):
+        return longSize(value)
+types.append(Long)
+
+
+class Double:
+    codes = ["D"] + codeRange(0x5b, 0x5f)
+    ptype = float
+
+    def read(self, ctx, prefix):
+        if prefix == "D":
+            return DOUBLE.unpack(ctx.read(8))[0]
+        elif prefix == "\x5b":
+            return 0.0
+        elif prefix == "\x5c":
+            return 1.0
+        elif prefix == "\x5d":
+            return float(TAGGED_BYTE.unpack(prefix + ctx.read(1))[1])
+        elif prefix == "\x5e":
+            return float(TAGGED_SIGNED_SHORT.unpack(prefix + ctx.read(2))[1])
+        return 0.001 * INT.unpack(ctx.read(4))[0]
+
+    encode = staticmethod(encodeDouble)
+
+    def write(self, ctx, value):
+        ctx.write(encodeDouble(value))
+
+    def size(self, ctx, value):
+        return doubleSize(value)
+types.append(Double)
+
+
+class Date:
+    "Milliseconds (J) or minutes (K) since epoch"
+    codes = ["J", "K"]
+    ptype = datetime
+
+    def read(self, ctx, prefix):
+        if prefix == "J":
+            milliseconds = LONG.unpack(ctx.read(8))[0]
+        else:
+            milliseconds = INT.unpack(ctx.read(4))[0] * 60000
+        return hessian.readDate(ctx, milliseconds)
+
+    def write(self, ctx, value):
+        milliseconds = hessian.writeDate(ctx, value)
+        minutes, rest = divmod(milliseconds, 60000)
+        if rest == 0 and hessian.INT_RANGE[0] <= minutes < hessian.INT_RANGE[1]:
+            ctx.write(TAGGED_INT.pack("K", minutes))
+        else:
+            ctx.write(TAGGED_LONG.pack("J", milliseconds))
+
+    def size(self, ctx, value):
+        minutes, rest = divmod(hessian.writeDate(ctx, value), 60000)
+        if rest == 0 and hessian.INT_RANGE[0] <= minutes < hessian.INT_RANGE[1]:
+            return 5
+        return 9
+types.append(Date)
+
+
+class UnicodeString:
+    """Non-final chunks start with R, final one with S or
+    has compact length prefix"""
+    codes = ["S", "R"] + codeRange(0x00, 0x1f) + codeRange(0x30, 0x33)
+    ptype = unicode
+
+    encode = staticmethod(encodeString)
+
+    def readChunk(self, ctx, prefix):
+        if prefix == "S" or prefix == "R":
+            count = SHORT.unpack(ctx.read(2))[0]
+        else:
+            count = ord(prefix)
+            if count >= 0x30:
+                count = ((count - 0x30) << 8) + ord(ctx.read(1))
+        return UTF8.readString(ctx, count)
+
+    def read(self, ctx, prefix):
+        if prefix == "R":
+            chunks = []
+            while prefix == "R":
+                chunks.append(self.readChunk(ctx, prefix))
+                prefix = ctx.read(1)
+            chunks.append(self.readChunk(ctx, prefix))
+            return u"".join(chunks)
+        value = self.readChunk(ctx, prefix)
+        if ctx.internStrings and len(value) <= ctx.internStrings:
+            return ctx.intern(value)
+        return value
+
+    def write(self, ctx, value):
+        size = hessian.Chunked.chunk_size
+        length = len(value)
+        pos = 0
+        while length - pos > size:
+            ctx.write(TAGGED_SHORT.pack("R", size))
+            ctx.write(value[pos : pos + size].encode("UTF-8"))
+            pos += size
+        ctx.write(chunkLengthPrefix(length - pos, 0x20, 0x00, 0x30, "S"))
+        ctx.write(value[pos : ].encode("UTF-8"))
+
+    def size(self, ctx, value):
+        "UTF-8 symbols are counted, not encoded"
+        size = hessian.Chunked.chunk_size
+        length = len(value)
+        if length <= size:
+            return chunkedSize(length, length, 0x20) + hessian.utf8Size(value)
+        # surrogate pair may be split between chunks
+        lastSize = length - size * ((length - 1) // size)
+        return chunkedSize(length, lastSize, 0x20) + \
+            sum([hessian.utf8Size(value[pos : pos + size]) 
+                 for pos in range(0, length, size)])
+types.append(UnicodeString)
+
+
+class Binary:
+    """Non-final chunks start with A, final one with B or
+    has compact length prefix"""
+    codes = ["B", "A"] + codeRange(0x20, 0x2f) + codeRange(0x34, 0x37)
+    ptype = str
+    views = False # see hessian.Chunked
+
+    encode = staticmethod(encodeBinary)
+
+    def readLength(self, ctx, prefix):
+        if prefix == "B" or prefix == "A":
+            return SHORT.unpack(ctx.read(2))[0]
+        count = ord(prefix)
+        if count >= 0x34:
+            return ((count - 0x34) << 8) + ord(ctx.read(1))
+        return count - 0x20
+
+    def readChunk(self, ctx, prefix):
+        return ctx.read(self.readLength(ctx, prefix))
+
+    def read(self, ctx, prefix):
+        if prefix != "A" and ctx.binaryViews and hasattr(ctx, "view"):
+            result = ctx.view(self.readLength(ctx, prefix))
+            if ctx.numpyBinaries and result[:len(hessian.NPY_MAGIC)] == hessian.NPY_MAGIC:
+                return hessian.readNpy(str(bytearray(result)))
+            return result
+        chunks = []
+        while prefix == "A":
+            chunks.append(self.readChunk(ctx, prefix))
+            prefix = ctx.read(1)
+        chunks.append(self.readChunk(ctx, prefix))
+        result = "".join(chunks)
+        if ctx.numpyBinaries and result.startswith(hessian.NPY_MAGIC):
+            return hessian.readNpy(result)
+        return result
+
+    def write(self, ctx, value):
+        size = hessian.Chunked.chunk_size
+        length = len(value)
+        pos = 0
+        writeChunk = ctx.writeView if self.views else ctx.write
+        while length - pos > size:
+            ctx.write(TAGGED_SHORT.pack("A", size))
+            writeChunk(self.slice(value, pos, pos + size))
+            pos += size
+        ctx.write(chunkLengthPrefix(length - pos, 0x10, 0x20, 0x34, "B"))
+        writeChunk(self.slice(value, pos, length))
+
+    def size(self, ctx, value):
+        size = hessian.Chunked.chunk_size
+        length = len(value)
+        lastSize = length - size * max(0, (length - 1) // size)
+        return chunkedSize(length, lastSize, 0x10) + length
+
+    def slice(self, value, start, end):
+        return value[start : end]
+types.append(Binary)
+
+
+class BinaryView(Binary):
+    "Serialises bytearray without copying (see hessian.BinaryView)"
+    ptype = bytearray
+    views = True
+
+    def slice(self, value, start, end):
+        return hessian.window(value, start, end)
+types.append(BinaryView)
+
+
+class MemoryView(BinaryView):
+    ptype = memoryview
+types.append(MemoryView)
+
+
+class MappedBinary(BinaryView):
+    ptype = hessian.mmap
+types.append(MappedBinary)
+
+
+class Array:
+    """Lists are fixed length (V, X, compact) or end with Z (U, W).
+    Typed ones (V, U, x70-x77) have type name."""
+    codes = ["U", "V", "W", "X"] + codeRange(0x70, 0x7f)
+    ptype = list
+
+    def readStart(self, ctx, prefix):
+        """Read list's type name and length.
+        Returns (type name, length), length is -1 if list ends with Z"""
+        code = ord(prefix)
+        if code >= 0x78:
+            return (None, code - 0x78)
+        elif code >= 0x70:
+            return (readType(ctx), code - 0x70)
+        elif prefix == "V":
+            typeName = readType(ctx)
+            return (typeName, readInt(ctx))
+        elif prefix == "X":
+            return (None, readInt(ctx))
+        elif prefix == "U":
+            return (readType(ctx), -1)
+        return (None, -1)
+
+    def readPacked(self, ctx, typeName, count):
+        """Read fixed length list of numbers or dates at once if it is
+        enabled by options (see hessian.Array.readPacked). Only elements
+        written at once (see COLUMN_WIDTHS) are read so. Returns None
+        if list should be read element by element."""
+        code = ctx.peek(1)
+        if ctx.numericLists and code in hessian.NUMBER_FORMATS:
+            data = peekColumn(ctx, code, count)
+            if data is None:
+                return None
+            result = hessian.decodeNumbers(ctx, code, data, count, 1)
+            if result is not None and typeName is not None \
+                    and ctx.numericLists == "numpy":
+                result = hessian.reshapeNumbers(result, typeName)
+        elif ctx.dateLists and code == "J":
+            data = peekColumn(ctx, code, count)
+            if data is None:
+                return None
+            result = hessian.decodeDates(ctx, data, count, 1)
+        else:
+            return None
+        if result is not None:
+            ctx.pos += len(data)
+            ctx.referencedObjects.append(result)
+        return result
+
+    def open(self, ctx, prefix):
+        "Start reading list (see hessian.Frame)"
+        typeName, count = self.readStart(ctx, prefix)
+        if count > 0 and (ctx.numericLists or ctx.dateLists) and hasattr(ctx, "peek"):
+            result = self.readPacked(ctx, typeName, count)
+            if result is not None:
+                return Frame(result, False, 0)
+        result = []
+        ctx.referencedObjects.append(result)
+        if count < 0:
+            return Frame(result, False, -1, "Z")
+        return Frame(result, False, count)
+
+    def read(self, ctx, prefix):
+        typeName, count = self.readStart(ctx, prefix)
+        if count > 0 and (ctx.numericLists or ctx.dateLists) and hasattr(ctx, "peek"):
+            result = self.readPacked(ctx, typeName, count)
+            if result is not None:
+                return result
+        result = []
+        ctx.referencedObjects.append(result)
+        if count < 0:
+            prefix = ctx.read(1)
+            while prefix != "Z":
+                if not prefix:
+                    raise HessianError("Unexpected end of list")
+                result.append(readObjectByPrefix(ctx, prefix))
+                prefix = ctx.read(1)
+        else:
+            for _ in xrange(count):
+                result.append(readObject(ctx))
+        return result
+
+    def iterate(self, ctx, prefix):
+        """Generator of list's elements that yields every element
+        as soon as it is read (see hessian.Array.iterate)."""
+        count = self.readStart(ctx, prefix)[1]
+        ctx.referencedObjects.append([])
+        if count < 0:
+            prefix = ctx.read(1)
+            while prefix != "Z":
+                if not prefix:
+                    raise HessianError("Unexpected end of list")
+                yield readObjectByPrefix(ctx, prefix)
+                prefix = ctx.read(1)
+        else:
+            for _ in xrange(count):
+                yield readObject(ctx)
+
+    def begin(self, ctx, value):
+        "Start writing list (see hessian.Array.begin)"
+        if ctx.references != "off":
+            objId = ctx.getRefId(value)
+            if objId != -1:
+                ctx.write("Q" + encodeInt(objId))
+                return None
+        listStart(ctx, len(value))
+        return (iter(value), None)
+
+    def _write(self, ctx, value):
+        listStart(ctx, len(value))
+        for o in value:
+            writeObject(ctx, o, None)
+
+    def write(self, ctx, value):
+        writeReferenced(ctx, self._write, value)
+types.append(Array)
+
+
+class Iteration(Array):
+    "Serialises iterators as lists that end with Z (see hessian.Iteration)"
+    ptype = Iterator
+
+    batch = hessian.Iteration.batch
+
+    def _write(self, ctx, value):
+        if isinstance(ctx, hessian.SizingContext):
+            raise HessianError("Can not size iterator without consuming it")
+        ctx.write("W")
+        n = 0
+        for o in value:
+            writeObject(ctx, o, None)
+            n += 1
+            if n == self.batch:
+                ctx.sync()
+                n = 0
+        ctx.write("Z")
+types.append(Iteration)
+
+
+class Tuple(Array):
+    ptype = tuple
+types.append(Tuple)
+
+
+class NumberArray(Array):
+    """Serialises array.array. Elements are written at once with fixed
+    size encoding (I, L or D), these are read at once with
+    ParseContext.numericLists option."""
+    ptype = array
+
+    def begin(self, ctx, value):
+        "Start writing list (see hessian.Array.begin)"
+        if ctx.references != "off":
+            objId = ctx.getRefId(value)
+            if objId != -1:
+                ctx.write("Q" + encodeInt(objId))
+                return None
+        listStart(ctx, len(value))
+        code = hessian.packedCode(ctx, value)
+        if code is not None:
+            ctx.write(hessian.tagNumbers(code, value))
+            return None
+        return (iter(value), None)
+
+    def _write(self, ctx, value):
+        code = hessian.packedCode(ctx, value)
+        if code is None:
+            Array._write(self, ctx, value)
+            return
+        listStart(ctx, len(value))
+        ctx.write(hessian.tagNumbers(code, value))
+types.append(NumberArray)
+
+
+class DateList(Array):
+    "Serialises hessian.DateColumn, dates are written as milliseconds (J)"
+    ptype = hessian.DateColumn
+
+    def _write(self, ctx, value):
+        milliseconds = value.milliseconds(ctx)
+        listStart(ctx, len(milliseconds))
+        pack = TAGGED_LONG.pack
+        ctx.write("".join([pack("J", m) for m in milliseconds]))
+
+    def size(self, ctx, value):
+        count = len(value.values)
+        size = 1 + 9 * count
+        if count >= 8:
+            size += intSize(count)
+        return referencedSize(ctx, value, size)
+types.append(DateList)
+
+
+if hessian.numpy is not None:
+    class NumpyArray(Array):
+        """Serialises numpy arrays (see hessian.NumpyArray). In "list"
+        mode numeric arrays are written as typed lists ([int, [long or
+        [double, shape of multidimensional array is appended), elements
+        are written at once with fixed size encoding."""
+        ptype = hessian.numpy.ndarray
+
+        binary_streamer = Binary()
+
+        def __init__(self, mode=None):
+            self.mode = mode
+
+        def write(self, ctx, value):
+            if value.ndim == 0:
+                writeObject(ctx, value.item(), None)
+            elif (self.mode or ctx.numpyArrays) == "binary":
+                if value.dtype.hasobject:
+                    raise HessianError("Can not write array of objects as binary")
+                value = hessian.numpy.ascontiguousarray(value)
+                self.binary_streamer.write(ctx, hessian.npyHeader(value) + value.tostring())
+            else:
+                writeReferenced(ctx, self._write, value)
+
+        def _write(self, ctx, value):
+            packed = hessian.packNumpyNumbers(value.ravel())
+            if packed is None:
+                Array._write(self, ctx, value.tolist())
+                return
+            code, data = packed
+            typeName = hessian.ARRAY_TYPE_NAMES[code]
+            if value.ndim != 1:
+                typeName += "[%s]" % ",".join([str(n) for n in value.shape])
+            listStart(ctx, value.size, typeName)
+            ctx.write(data)
+    types.append(NumpyArray)
+
+
+class Map:
+    """Untyped (H) or typed (M) map. Typed maps of classes registered
+    with TypeRegistry.registerClass are read as instances, instance is
+    created after its fields are read."""
+    codes = ["M", "H"]
+    ptype = dict
+
+    def open(self, ctx, prefix):
+        "Start reading map (see hessian.Frame)"
+        typed = None
+        if prefix == "M":
+            typed = ctx.classes.get(readType(ctx))
+        result = {}
+        refs = ctx.referencedObjects
+        index = len(refs)
+        refs.append(result)
+        finish = None
+        if typed is not None:
+            def finish(result):
+                refs[index] = ClassDefinition(typed.typeName, result.keys(), 
+                                              typed).create(result.values())
+                return refs[index]
+        return Frame(result, True, -1, "Z", None, finish)
+
+    def read(self, ctx, prefix):
+        typed = None
+        if prefix == "M":
+            typed = ctx.classes.get(readType(ctx))
+        result = {}
+        refs = ctx.referencedObjects
+        index = len(refs)
+        refs.append(result)
+        prefix = ctx.read(1)
+        while prefix != "Z":
+            if not prefix:
+                raise HessianError("Unexpected end of map")
+            key = readObjectByPrefix(ctx, prefix)
+            result[key] = readObject(ctx)
+            prefix = ctx.read(1)
+        if typed is not None:
+            result = refs[index] = ClassDefinition(typed.typeName,
+                                                   result.keys(),
+                                                   typed).create(result.values())
+        return result
+
+    def begin(self, ctx, mapping):
+        "Start writing map (see hessian.Array.begin)"
+        if ctx.references != "off":
+            objId = ctx.getRefId(mapping)
+            if objId != -1:
+                ctx.write("Q" + encodeInt(objId))
+                return None
+        ctx.write("H")
+        return (chain.from_iterable(mapping.iteritems()), "Z")
+
+    def _write(self, ctx, mapping):
+        ctx.write("H")
+        for k, v in mapping.items():
+            writeObject(ctx, k, None)
+            writeObject(ctx, v, None)
+        ctx.write("Z")
+
+    def write(self, ctx, value):
+        writeReferenced(ctx, self._write, value)
+types.append(Map)
+
+
+class Ref:
+    "Reference to list, map or object read before"
+    codes = ["Q"]
+
+    def read(self, ctx, prefix):
+        return ctx.referencedObjects[readInt(ctx)]
+types.append(Ref)
+
+
+class ClassDefinition:
+    """Class name and field names (as defined by C). If class is
+    registered then fields are mapped to attributes of its TypedObject,
+    unknown fields are dropped."""
+
+    def __init__(self, name, fields, typed):
+        self.name = name
+        self.fields = fields
+        self.typed = typed
+        self.targets = None
+        if typed is not None:
+            self.isTuple = issubclass(typed.ptype, tuple)
+            if self.isTuple:
+                targets = dict([(f, k) for k, f in enumerate(typed.fieldNames)])
+            else:
+                targets = dict(zip(typed.fieldNames, typed.attributes))
+            self.targets = [targets.get(f) for f in fields]
+
+    def create(self, values):
+        "Instance of registered class from values of fields"
+        cls = self.typed.ptype
+        if self.isTuple:
+            items = [None] * len(self.typed.fieldNames)
+            for k, value in zip(self.targets, values):
+                if k is not None:
+                    items[k] = value
+            return tuple.__new__(cls, items)
+        result = cls.__new__(cls)
+        for attribute, value in zip(self.targets, values):
+            if attribute is not None:
+                setattr(result, attribute, value)
+        return result
+
+
+class ObjectReader:
+    """Reads class definitions (C) and objects (O, x60-x6f).
+    Objects of classes that are not registered are read as dicts."""
+    codes = ["C", "O"] + codeRange(0x60, 0x6f)
+
+    def read(self, ctx, prefix):
+        if prefix == "C":
+            name = STRING_STREAMER.read(ctx, ctx.read(1))
+            count = readInt(ctx)
+            fields = [readObject(ctx) for _ in xrange(count)]
+            ctx.classDefs.append(ClassDefinition(name, fields, ctx.classes.get(name)))
+            # value follows definition
+            prefix = ctx.read(1)
+            return ctx.codeMap[prefix].read(ctx, prefix)
+        elif prefix == "O":
+            index = readInt(ctx)
+        else:
+            index = ord(prefix) - 0x60
+        definition = ctx.classDefs[index]
+        refs = ctx.referencedObjects
+        if definition.typed is None:
+            result = {}
+            refs.append(result)
+            for f in definition.fields:
+                result[f] = readObject(ctx)
+        elif definition.isTuple:
+            index = len(refs)
+            refs.append(None) # not created yet
+            values = [readObject(ctx) for _ in definition.fields]
+            result = refs[index] = definition.create(values)
+        else:
+            result = definition.typed.ptype.__new__(definition.typed.ptype)
+            refs.append(result)
+            for attribute in definition.targets:
+                value = readObject(ctx)
+                if attribute is not None:
+                    setattr(result, attribute, value)
+        return result
+types.append(ObjectReader)
+
+
+class Object:
+    """Serialises instances of class registered with
+    TypeRegistry.registerClass. Class definition is written
+    once per message before first instance."""
+    codes = []
+
+    def __init__(self, typed):
+        self.ptype = typed.ptype
+        self.typed = typed
+        self.isTuple = issubclass(typed.ptype, tuple)
+        ctx = hessian.BufferedWriteContext(None)
+        ctx.write("C")
+        STRING_STREAMER.write(ctx, unicode(typed.typeName))
+        ctx.write(encodeInt(len(typed.fieldNames)))
+        for name in typed.fieldNames:
+            STRING_STREAMER.write(ctx, name)
+        self.definition = ctx.getvalue()
+
+    def _write(self, ctx, value):
+        try:
+            index = ctx.classIds[self.ptype]
+        except KeyError:
+            index = ctx.classIds[self.ptype] = len(ctx.classIds)
+            ctx.write(self.definition)
+        if index < 0x10:
+            ctx.write(chr(0x60 + index))
+        else:
+            ctx.write("O" + encodeInt(index))
+        if self.isTuple:
+            for v in value:
+                writeObject(ctx, v, None)
+        else:
+            for attribute in self.typed.attributes:
+                writeObject(ctx, getattr(value, attribute), None)
+
+    def write(self, ctx, value):
+        writeReferenced(ctx, self._write, value)
+
+
+INT_STREAMER = Int()
+INT_CODES = frozenset(Int.codes)
+STRING_STREAMER = UnicodeString()
+
+
+def readEnvelope(ctx, prefix):
+    "Read start of message, returns message code"
+    if prefix != "H":
+        raise HessianError("Hessian 2.0 message expected")
+    version = ctx.read(2)
+    if version != VERSION:
+        raise HessianError("Unsupported protocol version %s" % `version`)
+    return ctx.read(1)
+
+
+class Call:
+    "Hessian 2.0 call. Headers are not supported."
+    autoRegister = False
+    codes = ["H"]
+
+    def read(self, ctx, prefix):
+        if readEnvelope(ctx, prefix) != "C":
+            raise HessianError("Call expected")
+        method = readObject(ctx)
+        count = readInt(ctx)
+        params = [readObject(ctx) for _ in xrange(count)]
+        return (method, [], params)
+
+    def template(self, method):
+        "Encoded start of call (see hessian.Call.template)"
+        ctx = hessian.BufferedWriteContext(None)
+        ctx.write("H" + VERSION + "C")
+        STRING_STREAMER.write(ctx, unicode(method))
+        return ctx.getvalue()
+
+    def writeParams(self, ctx, params):
+        "Write parameters that follow template"
+        ctx.write(encodeInt(len(params)))
+        for v in params:
+            writeObject(ctx, v, None)
+
+    def write(self, ctx, value):
+        method, headers, params = value
+        if headers:
+            raise HessianError("Hessian 2.0 calls can not have headers")
+        ctx.write(self.template(method))
+        self.writeParams(ctx, params or [])
+
+
+class Reply:
+    "Hessian 2.0 reply or fault"
+    autoRegister = False
+    codes = ["H"]
+
+    def readStart(self, ctx, prefix):
+        """Read reply up to its result (see hessian.Reply.readStart).
+        Hessian 2.0 replies have no headers."""
+        code = readEnvelope(ctx, prefix)
+        if code == "F":
+            return ([], False, readObject(ctx))
+        elif code != "R":
+            raise HessianError("Reply expected")
+        return ([], True, ctx.read(1))
+
+    def read(self, ctx, prefix):
+        (headers, succeeded, result) = self.readStart(ctx, prefix)
+        if succeeded:
+            result = readObjectByPrefix(ctx, result)
+        return (headers, succeeded, result)
+
+    def readEnd(self, ctx):
+        "Hessian 2.0 reply has no closing marker"
+        pass
+
+    def write(self, ctx, reply):
+        (headers, succeeded, result) = reply
+        if succeeded:
+            ctx.write("H" + VERSION + "R")
+        else:
+            ctx.write("H" + VERSION + "F")
+        writeObject(ctx, result, None)
+
+
+class Unsupported:
+    """Stands for custom streamer of Hessian 1.0 registry that has 
+    no Hessian 2.0 counterpart (see registryFor). Its values can not 
+    be written to Hessian 2.0 messages."""
+    codes = []
+
+    def __init__(self, ptype, streamer):
+        self.ptype = ptype
+        self.streamer = streamer
+
+    def write(self, ctx, value):
+        raise HessianError("Streamer %s of %s is Hessian 1.0 only, "
+                           "set its 'streamer2' to write Hessian 2.0" 
+                           % (self.streamer.__class__.__name__, self.ptype))
+
+
+REGISTRY = hessian.TypeRegistry(types)
+
+# Python class to standard Hessian 1.0 streamer
+STANDARD_TYPES = hessian.makeTypeMaps(hessian.types)[1]
+
+
+def registryFor(registry=None):
+    """Hessian 2.0 registry with classes registered in given
+    (Hessian 1.0) registry, default is hessian.REGISTRY.
+    Other streamers registered in given registry are replaced 
+    by their 'streamer2' attribute (Hessian 2.0 streamer of the 
+    same values, it may also read its codes). Values of ones without 
+    it can not be written (see Unsupported)."""
+    if registry is None:
+        registry = hessian.REGISTRY
+    try:
+        return registry.derived[2]
+    except KeyError:
+        pass
+    result = REGISTRY.copy()
+    for ptype, streamer in registry.typeMap.items():
+        if isinstance(streamer, hessian.TypedObject) \
+                or STANDARD_TYPES.get(ptype).__class__ is streamer.__class__:
+            continue
+        streamer2 = getattr(streamer, "streamer2", None)
+        if streamer2 is None:
+            streamer2 = Unsupported(ptype, streamer)
+        result.register(streamer2)
+    for typed in registry.classes.values():
+        result.register(Object(typed))
+        result.classes[typed.typeName] = typed
+    registry.derived[2] = result
+    return result
+
+
+def attach(ctx, registry=None):
+    """Prepare parse or write context for Hessian 2.0 values.
+    registry - see registryFor"""
+    hessian.setRegistry(ctx, registryFor(registry))
+    ctx.classDefs = [] # ClassDefinition-s read
+    ctx.typeNames = [] # type names read
+    ctx.classIds = {} # Python class to index of written class definition
+    ctx.typeIds = {} # written type name to its index
+
+
+def replyStreamer(ctx, prefix, registry=None):
+    """Streamer of reply that starts with prefix (either Hessian 1.0
+    or 2.0 one). Context is prepared for 2.0 if needed."""
+    if prefix == "H":
+        attach(ctx, registry)
+        return Reply()
+    return hessian.Reply()
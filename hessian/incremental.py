@@ -0,0 +1,268 @@
+#
+# Hessian protocol implementation
+# This file contains incremental (push style) parser.
+#
+# Protocol specification can be found here:
+# http://www.caucho.com/resin-3.0/protocols/hessian-1.0-spec.xtp
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Parser for non-blocking I/O. Data is fed to the parser in fragments
+of any size as they arrive. Parser keeps track of message structure
+(calls, replies, lists, maps, chunked strings) between fragments and
+returns every message as soon as its last octet is fed.
+
+Usage example:
+
+    parser = IncrementalParser("reply")
+    for fragment in fragments:
+        for (headers, succeeded, result) in parser.feed(fragment):
+            ...
+    parser.close()
+"""
+
+import hessian
+import UTF8
+from common import HessianError
+
+__revision__ = "$Rev$"
+
+
+# Scanner states. Scanner keeps stack of them.
+VALUE = 0         # a value (or next chunk of a chunked one)
+ELEMENTS = 1      # values until "z" (list elements, map entries, arguments)
+LIST_TYPE = 2     # optional list type, then LIST_LENGTH
+LIST_LENGTH = 3   # optional list length, then ELEMENTS
+MAP_TYPE = 4      # optional map type, then ELEMENTS
+TYPE_NAME = 5     # type name (of remote reference)
+CALL = 6          # call start and version, then CALL_HEADERS
+CALL_HEADERS = 7  # headers, then method name and ELEMENTS
+REPLY = 8         # reply start and version, then REPLY_HEADERS
+REPLY_HEADERS = 9 # headers, then fault or value with REPLY_END
+REPLY_END = 10    # closing "z" of reply
+
+
+def _codes(s):
+    return [ord(c) for c in s]
+
+# octets in fixed size values
+FIXED_SIZES = {}
+for _c, _n in [("N", 1), ("T", 1), ("F", 1),
+               ("I", 5), ("R", 5), ("L", 9), ("D", 9), ("d", 9)]:
+    FIXED_SIZES[ord(_c)] = _n
+
+S_LAST, S_MORE, X_LAST, X_MORE = _codes("SsXx")
+B_LAST, B_MORE = _codes("Bb")
+LIST, MAP, REMOTE, FAULT, Z = _codes("VMrfz")
+TYPE, LENGTH, HEADER, METHOD = _codes("tlHm")
+CALL_CODE, REPLY_CODE = _codes("cr")
+
+
+def shortSequenceEnd(buf, pos, end):
+    "End of prefix, 16 bit length and that many octets. -1 if incomplete."
+    if pos + 3 > end:
+        return -1
+    stop = pos + 3 + (buf[pos + 1] << 8 | buf[pos + 2])
+    if stop > end:
+        return -1
+    return stop
+
+
+def utf8ChunkEnd(buf, pos, end):
+    "End of prefix, 16 bit length and that many UTF-8 symbols. -1 if incomplete."
+    if pos + 3 > end:
+        return -1
+    return UTF8.symbolsEnd(buf, pos + 3, end, buf[pos + 1] << 8 | buf[pos + 2])
+
+
+def scan(stack, buf, pos, end):
+    """Advance over complete tokens of buf[pos : end] updating
+    stack of scanner states. Returns offset of first token that
+    is not complete yet (or end of message if stack is empty)."""
+    while stack and pos < end:
+        state = stack[-1]
+        code = buf[pos]
+        if state == VALUE:
+            size = FIXED_SIZES.get(code)
+            if size is not None:
+                if pos + size > end:
+                    break
+                pos += size
+                stack.pop()
+            elif code == S_LAST or code == X_LAST or code == S_MORE or code == X_MORE:
+                stop = utf8ChunkEnd(buf, pos, end)
+                if stop < 0:
+                    break
+                pos = stop
+                if code == S_LAST or code == X_LAST:
+                    stack.pop()
+                # else next chunk is expected
+            elif code == B_LAST or code == B_MORE:
+                stop = shortSequenceEnd(buf, pos, end)
+                if stop < 0:
+                    break
+                pos = stop
+                if code == B_LAST:
+                    stack.pop()
+            elif code == LIST:
+                pos += 1
+                stack[-1] = LIST_TYPE
+            elif code == MAP:
+                pos += 1
+                stack[-1] = MAP_TYPE
+            elif code == REMOTE:
+                pos += 1
+                # type name, then url
+                stack.append(TYPE_NAME)
+            else:
+                raise HessianError("Unknown type code 0x%02x at %d" % (code, pos))
+        elif state == ELEMENTS:
+            if code == Z:
+                pos += 1
+                stack.pop()
+            else:
+                stack.append(VALUE)
+        elif state == LIST_TYPE or state == MAP_TYPE or state == TYPE_NAME:
+            if code == TYPE:
+                stop = shortSequenceEnd(buf, pos, end)
+                if stop < 0:
+                    break
+                pos = stop
+            elif state == TYPE_NAME:
+                raise HessianError("Type name expected at %d" % pos)
+            if state == LIST_TYPE:
+                stack[-1] = LIST_LENGTH
+            elif state == MAP_TYPE:
+                stack[-1] = ELEMENTS
+            else:
+                stack.pop()
+        elif state == LIST_LENGTH:
+            if code == LENGTH:
+                if pos + 5 > end:
+                    break
+                pos += 5
+            stack[-1] = ELEMENTS
+        elif state == CALL or state == REPLY:
+            if pos + 3 > end:
+                break
+            if state == CALL:
+                expected = CALL_CODE
+                stack[-1] = CALL_HEADERS
+            else:
+                expected = REPLY_CODE
+                stack[-1] = REPLY_HEADERS
+            if code != expected:
+                raise HessianError("Message start expected at %d" % pos)
+            pos += 3
+        elif state == CALL_HEADERS or state == REPLY_HEADERS:
+            if code == HEADER:
+                stop = shortSequenceEnd(buf, pos, end)
+                if stop < 0:
+                    break
+                pos = stop
+                stack.append(VALUE)
+            elif state == CALL_HEADERS:
+                if code != METHOD:
+                    raise HessianError("Method name expected at %d" % pos)
+                stop = shortSequenceEnd(buf, pos, end)
+                if stop < 0:
+                    break
+                pos = stop
+                stack[-1] = ELEMENTS
+            elif code == FAULT:
+                # closing "z" of fault closes reply too
+                pos += 1
+                stack[-1] = ELEMENTS
+            else:
+                stack[-1] = REPLY_END
+                stack.append(VALUE)
+        elif state == REPLY_END:
+            if code != Z:
+                raise HessianError("No closing marker in reply.")
+            pos += 1
+            stack.pop()
+        else:
+            assert False # unknown state
+    return pos
+
+
+class IncrementalParser:
+    """Push style parser. Messages are returned by feed() once they
+    are received completely. Each message is decoded by hessian's
+    streamers with its own reference table.
+
+    message - what the data consists of: "value" (sequence of values),
+        "call" (sequence of calls) or "reply" (sequence of replies).
+    post, registry - see hessian.ParseContext.
+    options - options of parse context (see hessian.setOptions).
+    """
+
+    def __init__(self, message="value", post=lambda x: x, registry=None, options={}):
+        self.message = message
+        self.post = post
+        self.registry = registry
+        self.options = options
+        self.buffer = bytearray() # data of current message
+        self.pos = 0 # scanned part of the buffer
+        self.stack = [] # scanner states
+        self.skipClosing = False
+
+    def feed(self, data):
+        "Add data. Returns list of messages that are complete now."
+        buf = self.buffer
+        buf += data
+        result = []
+        while True:
+            if not self.stack:
+                # buffer starts with next message
+                if len(buf) == 0:
+                    break
+                if self.skipClosing and buf[0] == Z:
+                    # hessian.Reply writes extra "z" after fault
+                    del buf[0]
+                    self.skipClosing = False
+                    continue
+                self.skipClosing = False
+                self.stack.append({"value" : VALUE,
+                                   "call" : CALL,
+                                   "reply" : REPLY}[self.message])
+            self.pos = scan(self.stack, buf, self.pos, len(buf))
+            if self.stack:
+                break # wait for more data
+            result.append(self.decode(str(buf[:self.pos])))
+            del buf[:self.pos]
+            self.pos = 0
+        return result
+
+    def decode(self, data):
+        "Decode complete message"
+        ctx = hessian.BufferedParseContext(data, self.post, registry=self.registry)
+        hessian.setOptions(ctx, self.options)
+        if self.message == "call":
+            return hessian.Call().read(ctx, ctx.read(1))
+        elif self.message == "reply":
+            reply = hessian.Reply().read(ctx, ctx.read(1))
+            self.skipClosing = not reply[1]
+            return reply
+        else:
+            return hessian.readObject(ctx)
+
+    def pending(self):
+        "Number of octets of incomplete message received so far"
+        return len(self.buffer)
+
+    def close(self):
+        "Check that no incomplete message is left."
+        if self.stack or len(self.buffer) > self.pos:
+            raise HessianError("Incomplete message (%d octets)" % len(self.buffer))
@@ -0,0 +1,334 @@
+#
+# Hessian protocol implementation
+# This file contains skip scanner and lazily decoded containers.
+#
+# Protocol specification can be found here:
+# http://www.caucho.com/resin-3.0/protocols/hessian-1.0-spec.xtp
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Selective access to encoded values.
+
+Skip scanner walks over an encoded value and finds where it ends without
+building Python objects. Document scans its value once to find offsets
+of referenced objects and ends of lists and maps. Its lists and maps
+are decoded lazily: LazyList and LazyMap decode their members only when
+these are accessed. Typed maps of classes registered in registry
+(see TypeRegistry.registerClass) are decoded at once as instances,
+so same reply gives same types whether it is read lazily or not.
+
+Usage example:
+
+    headers, succeeded, result = readReply(data)
+    print result["name"], result["items"][10]
+"""
+
+from collections import Mapping, Sequence
+import hessian
+import UTF8
+from common import HessianError
+
+__revision__ = "$Rev$"
+
+
+# octets in fixed size values
+FIXED_SIZES = {"N" : 1, "T" : 1, "F" : 1,
+               "I" : 5, "R" : 5, "L" : 9, "D" : 9, "d" : 9}
+
+
+def shortSequenceEnd(data, pos):
+    "End of prefix, 16 bit length and that many octets"
+    return pos + 3 + hessian.SHORT.unpack(data[pos + 1 : pos + 3])[0]
+
+
+def skipObject(data, pos, refs=None, ends=None):
+    """Offset that follows value that starts at 'pos' in data.
+    If 'refs' list is given then offsets of lists and maps are appended
+    to it in order they are numbered by references ("R").
+    If 'ends' dictionary is given then it maps offsets of lists and maps
+    to their ends."""
+    depth = 0 # containers that are not closed yet
+    starts = [] # of containers that are not closed yet
+    try:
+        while True:
+            code = data[pos]
+            size = FIXED_SIZES.get(code)
+            if size is not None:
+                pos += size
+            elif code in "SsXx":
+                count = hessian.SHORT.unpack(data[pos + 1 : pos + 3])[0]
+                pos = UTF8.symbolsEnd(data, pos + 3, len(data), count)
+                if pos < 0:
+                    raise IndexError()
+                if code in "sx":
+                    continue # next chunk follows
+            elif code in "Bb":
+                pos = shortSequenceEnd(data, pos)
+                if code == "b":
+                    continue
+            elif code == "V" or code == "M":
+                if refs is not None:
+                    refs.append(pos)
+                if ends is not None:
+                    starts.append(pos)
+                pos += 1
+                if data[pos] == "t":
+                    pos = shortSequenceEnd(data, pos)
+                if code == "V" and data[pos] == "l":
+                    pos += 5
+                depth += 1
+                continue
+            elif code == "z":
+                pos += 1
+                depth -= 1
+                if depth < 0:
+                    raise HessianError("Unexpected end of list or map at %d" % pos)
+                if ends is not None:
+                    ends[starts.pop()] = pos
+            elif code == "r":
+                # remote reference: type name and url string follow
+                pos = shortSequenceEnd(data, pos + 1)
+                continue
+            else:
+                raise HessianError("Unknown type code %s at %d" % (`code`, pos))
+            if depth == 0:
+                if pos > len(data):
+                    raise IndexError()
+                return pos
+    except IndexError:
+        raise HessianError("Unexpected end of data")
+
+
+class Document:
+    """Encoded value which lists and maps are decoded on demand.
+    Reference table of whole value is built in advance by skip scanner.
+
+    post, registry - see hessian.ParseContext"""
+
+    def __init__(self, data, pos=0, post=lambda x: x, registry=None):
+        self.data = data
+        self.post = post
+        self.registry = registry
+        self.refOffsets = [] # offsets of referencable objects
+        self.ends = {} # list and map offsets to their ends
+        self.end = skipObject(data, pos, self.refOffsets, self.ends)
+        self.refIds = dict([(offset, k) for k, offset in enumerate(self.refOffsets)])
+        self.objects = {} # reference id to decoded object
+        self.root = self.value(pos)
+
+    def value(self, pos):
+        "Decoded value (or lazy container) that starts at 'pos'"
+        code = self.data[pos]
+        if code == "V" or code == "M":
+            return self.container(self.refIds[pos])
+        elif code == "R":
+            return self.container(hessian.INT.unpack(self.data[pos + 1 : pos + 5])[0])
+        ctx = hessian.BufferedParseContext(self.data, self.post, registry=self.registry)
+        ctx.pos = pos
+        return hessian.readObject(ctx)
+
+    def skip(self, pos):
+        "Offset that follows value at pos"
+        try:
+            return self.ends[pos] # list or map
+        except KeyError:
+            return skipObject(self.data, pos)
+
+    def container(self, refId):
+        "Lazy container by its reference id"
+        try:
+            return self.objects[refId]
+        except KeyError:
+            pass
+        pos = self.refOffsets[refId]
+        if self.data[pos] == "V":
+            result = LazyList(self, pos)
+        elif self.isRegistered(pos):
+            return self.decode(pos, refId)
+        else:
+            result = LazyMap(self, pos)
+        self.objects[refId] = result
+        return result
+
+    def isRegistered(self, pos):
+        "Whether map at pos is typed with registered type name"
+        data = self.data
+        if data[pos + 1] != "t":
+            return False
+        typeName = data[pos + 4 : shortSequenceEnd(data, pos + 1)]
+        return typeName in (self.registry or hessian.REGISTRY).classes
+
+    def decode(self, pos, refId):
+        """Decode object at pos (with its members) at once.
+        Decoded lists and maps it contains are kept for references."""
+        ctx = hessian.BufferedParseContext(self.data, self.post, registry=self.registry)
+        ctx.pos = pos
+        refs = ctx.referencedObjects = References(self, refId)
+        hessian.readObject(ctx)
+        for k, obj in enumerate(list.__iter__(refs)):
+            self.objects.setdefault(refId + k, obj)
+        return self.objects[refId]
+
+
+class References(list):
+    """Reference table of object that is decoded at once in document
+    (see Document.decode). Objects numbered before 'start' are
+    document's ones."""
+
+    def __init__(self, document, start):
+        list.__init__(self)
+        self.document = document
+        self.start = start
+
+    def __len__(self):
+        return self.start + list.__len__(self)
+
+    def __getitem__(self, refId):
+        if refId < self.start:
+            return self.document.container(refId)
+        return list.__getitem__(self, refId - self.start)
+
+    def __setitem__(self, refId, value):
+        list.__setitem__(self, refId - self.start, value)
+
+
+def containerStart(data, pos):
+    "Offset of first member of list or map that starts at pos"
+    code = data[pos]
+    pos += 1
+    if data[pos] == "t":
+        pos = shortSequenceEnd(data, pos)
+    if code == "V" and data[pos] == "l":
+        pos += 5
+    return pos
+
+
+class LazyList(Sequence):
+    "List which elements are decoded on first access"
+
+    def __init__(self, document, pos):
+        self.document = document
+        self.pos = pos
+        self.offsets = None # of elements
+        self.values = {} # index to decoded element
+
+    def _scan(self):
+        data = self.document.data
+        self.offsets = []
+        pos = containerStart(data, self.pos)
+        skip = self.document.skip
+        while data[pos] != "z":
+            self.offsets.append(pos)
+            pos = skip(pos)
+
+    def __len__(self):
+        if self.offsets is None:
+            self._scan()
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if self.offsets is None:
+            self._scan()
+        if isinstance(index, slice):
+            return [self[k] for k in range(*index.indices(len(self.offsets)))]
+        if index < 0:
+            index += len(self.offsets)
+        try:
+            return self.values[index]
+        except KeyError:
+            if not 0 <= index < len(self.offsets):
+                raise IndexError("list index out of range")
+            value = self.values[index] = self.document.value(self.offsets[index])
+            return value
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, LazyList)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "LazyList(%d elements at %d)" % (len(self), self.pos)
+
+
+class LazyMap(Mapping):
+    "Map which keys are decoded on first access and values are decoded on demand"
+
+    def __init__(self, document, pos):
+        self.document = document
+        self.pos = pos
+        self.offsets = None # key to value offset
+        self.values = {}
+
+    def _scan(self):
+        document = self.document
+        data = document.data
+        self.offsets = {}
+        pos = containerStart(data, self.pos)
+        skip = document.skip
+        while data[pos] != "z":
+            key = document.value(pos)
+            pos = skip(pos)
+            self.offsets[key] = pos
+            pos = skip(pos)
+
+    def __len__(self):
+        if self.offsets is None:
+            self._scan()
+        return len(self.offsets)
+
+    def __iter__(self):
+        if self.offsets is None:
+            self._scan()
+        return iter(self.offsets)
+
+    def __contains__(self, key):
+        if self.offsets is None:
+            self._scan()
+        return key in self.offsets
+
+    def __getitem__(self, key):
+        try:
+            return self.values[key]
+        except KeyError:
+            if self.offsets is None:
+                self._scan()
+            value = self.values[key] = self.document.value(self.offsets[key])
+            return value
+
+    def __repr__(self):
+        return "LazyMap(%d entries at %d)" % (len(self), self.pos)
+
+
+def readObject(data, pos=0, post=lambda x: x, registry=None):
+    "Value that starts at 'pos'. Lists and maps are decoded lazily."
+    return Document(data, pos, post, registry).root
+
+
+def readReply(data, post=lambda x: x, registry=None):
+    """Read reply which result (if call succeeded) is decoded lazily.
+    Returns (headers, succeeded, result) as hessian.Reply.read does."""
+    ctx = hessian.BufferedParseContext(data, post, registry=registry)
+    streamer = hessian.Reply()
+    if ctx.read(1) != streamer.codes[0]:
+        raise HessianError("Reply expected")
+    (headers, succeeded, value) = streamer.readStart(ctx, streamer.codes[0])
+    if not succeeded:
+        return (headers, False, value)
+    document = Document(data, ctx.pos - 1, post, registry)
+    if data[document.end : document.end + 1] != "z":
+        raise HessianError("No closing marker in reply.")
+    return (headers, True, document.root)
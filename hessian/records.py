@@ -0,0 +1,206 @@
+#
+# Hessian protocol implementation
+# This file contains record files (sequences of encoded values on disk).
+#
+# Protocol specification can be found here:
+# http://www.caucho.com/resin-3.0/protocols/hessian-1.0-spec.xtp
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Files of Hessian encoded values with random access by record number.
+
+File layout:
+    header: "HREC", protocol version (1 or 2), 3 reserved octets
+    records: 32 bit length and that many octets of encoded value each
+    index: 64 bit offset of every record
+    trailer: 64 bit offset of index, 64 bit number of records, "HIDX"
+All numbers are big-endian. If file has no trailer (writer was not
+closed) then its records are found by walking the length frames.
+
+Usage example:
+
+    writer = RecordWriter(open("data.hrec", "wb"))
+    for value in values:
+        writer.write(value)
+    writer.close()
+
+    records = RecordFile("data.hrec")
+    print len(records), records[1000]
+"""
+
+from mmap import mmap, ACCESS_READ
+from os import fstat
+from struct import Struct, pack
+import hessian
+import hessian2
+from common import HessianError
+
+__revision__ = "$Rev$"
+
+
+HEADER = Struct(">4sB3x")
+FRAME = Struct(">I")
+OFFSET = Struct(">q")
+TRAILER = Struct(">qq4s")
+MAGIC = "HREC"
+INDEX_MAGIC = "HIDX"
+
+
+class RecordWriter:
+    """Appends values to record file. Index is written by close().
+
+    stream - file open for writing, it is closed by close().
+    version - Hessian protocol version of records (1 or 2).
+    pre, registry - see hessian.WriteContext.
+    options - options of write contexts (see hessian.setOptions).
+    """
+
+    def __init__(self, stream, version=1, pre=hessian.identity, registry=None, options={}):
+        if version not in (1, 2):
+            raise HessianError("Unknown protocol version %s" % `version`)
+        self.stream = stream
+        self.version = version
+        self.pre = pre
+        self.registry = registry
+        self.options = options
+        self.offsets = [] # of records
+        stream.write(HEADER.pack(MAGIC, version))
+        self.pos = HEADER.size
+
+    def write(self, value):
+        "Append value. Returns its record number."
+        ctx = hessian.BufferedWriteContext(None, self.pre, self.registry)
+        if self.version == 2:
+            hessian2.attach(ctx, self.registry)
+        hessian.setOptions(ctx, self.options)
+        hessian.writeObject(ctx, value, None)
+        return self.writeEncoded(ctx.getvalue())
+
+    def writeEncoded(self, data):
+        "Append already encoded value. Returns its record number."
+        self.offsets.append(self.pos)
+        self.stream.write(FRAME.pack(len(data)))
+        self.stream.write(data)
+        self.pos += FRAME.size + len(data)
+        return len(self.offsets) - 1
+
+    def close(self):
+        "Write index and close the stream."
+        indexOffset = self.pos
+        offsets = self.offsets
+        batch = 4096
+        for k in xrange(0, len(offsets), batch):
+            part = offsets[k : k + batch]
+            self.stream.write(pack(">%dq" % len(part), *part))
+        self.stream.write(TRAILER.pack(indexOffset, len(offsets), INDEX_MAGIC))
+        self.stream.close()
+
+
+class RecordFile:
+    """Memory mapped record file. Records are decoded by number with
+    hessian's streamers, only the pages of that record are read.
+
+    source - file name or file open for reading.
+    post, registry - see hessian.ParseContext.
+    options - options of parse contexts (see hessian.setOptions).
+    """
+
+    def __init__(self, source, post=lambda x: x, registry=None, options={}):
+        opened = isinstance(source, basestring)
+        if opened:
+            source = open(source, "rb")
+        self.file = source
+        self.post = post
+        self.registry = registry
+        self.options = options
+        self.map = None
+        try:
+            # empty files can not be mapped
+            if fstat(source.fileno()).st_size < HEADER.size:
+                raise HessianError("Not a record file")
+            self.map = mmap(source.fileno(), 0, access=ACCESS_READ)
+            self.readIndex()
+        except:
+            if self.map is not None:
+                self.map.close()
+            if opened:
+                source.close()
+            raise
+
+    def readIndex(self):
+        "Read header and find records (by index if file has one)"
+        size = len(self.map)
+        magic, self.version = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise HessianError("Not a record file")
+        self.offsets = None # if file has no index
+        indexOffset, count, magic = (0, 0, None)
+        if size >= HEADER.size + TRAILER.size:
+            indexOffset, count, magic = TRAILER.unpack_from(self.map, size - TRAILER.size)
+        if magic == INDEX_MAGIC \
+                and indexOffset + OFFSET.size * count + TRAILER.size == size:
+            self.indexOffset = indexOffset
+            self.count = count
+        else:
+            self.offsets = self.scan()
+            self.count = len(self.offsets)
+
+    def scan(self):
+        "Offsets of records found by their length frames"
+        data = self.map
+        size = len(data)
+        offsets = []
+        pos = HEADER.size
+        while pos + FRAME.size <= size:
+            end = pos + FRAME.size + FRAME.unpack_from(data, pos)[0]
+            if end > size:
+                break # incomplete record
+            offsets.append(pos)
+            pos = end
+        return offsets
+
+    def __len__(self):
+        return self.count
+
+    def offset(self, index):
+        "Offset of record's frame"
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("record index out of range")
+        if self.offsets is not None:
+            return self.offsets[index]
+        return OFFSET.unpack_from(self.map, self.indexOffset + OFFSET.size * index)[0]
+
+    def record(self, index):
+        "Encoded record as buffer that shares memory of the file"
+        pos = self.offset(index)
+        length = FRAME.unpack_from(self.map, pos)[0]
+        return buffer(self.map, pos + FRAME.size, length)
+
+    def __getitem__(self, index):
+        ctx = hessian.BufferedParseContext(self.record(index), self.post,
+                                           registry=self.registry)
+        if self.version == 2:
+            hessian2.attach(ctx, self.registry)
+        hessian.setOptions(ctx, self.options)
+        return hessian.readObject(ctx)
+
+    def __iter__(self):
+        for k in xrange(self.count):
+            yield self[k]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
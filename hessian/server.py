@@ -21,7 +21,8 @@
 #
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 import hessian
-from StringIO import StringIO
+import hessian2
+from collections import Iterator
 import traceback
 import socket
 
@@ -31,17 +32,72 @@ __revision__ = "$Rev$"
 
 class HessianHTTPRequestHandler(BaseHTTPRequestHandler):    
     """Subclasses should create clss's member message_map which maps method 
-    names into function objects """
+    names into function objects. Subclasses may also set 'registry' 
+    (hessian.TypeRegistry) to use their own type mapping."""
     
     MAX_CHUNK_SIZE = 2 ^ 12
     
-    def do_POST(self):        
+    registry = None # use hessian.REGISTRY
+    
+    protocol = hessian # module of protocol version of current call
+    
+    # options of hessian.ParseContext for calls (see hessian.setOptions)
+    parse_options = {}
+    # options of hessian.WriteContext for replies
+    write_options = {}
+    
+    # Size reply (see hessian.SizingContext) and write it straight to 
+    # the socket instead of collecting whole reply in memory. 
+    # Reply is encoded twice. Replies with iterators are still buffered.
+    stream_replies = False
+    
+    stream_buffer_size = 2 ** 16 # 64KiB
+    
+    # Collect hessian.Statistics of every call and its reply, 
+    # they are passed to statsCollected
+    collect_stats = False
+    
+    def do_POST(self):
+        # {"call" : hessian.Statistics, "reply" : hessian.Statistics}
+        # of current call if collect_stats is set
+        self.stats = None
+        self.method_name = None
+        self.handleCall()
+        if self.stats is not None:
+            self.statsCollected(self.method_name, self.stats)
+    
+    def statsCollected(self, method, stats):
+        """Called when reply is sent if collect_stats is set.
+        stats - see self.stats. Reply statistics are None if reply 
+        was not written."""
+        pass
+    
+    def handleCall(self):
         try:
-            ctx = hessian.ParseContext(self.rfile)
-            (method, headers, params) = hessian.Call().read(ctx, ctx.read(1))
+            length = self.headers.getheader("Content-Length")
+            if length is None:
+                # can not read ahead as we do not know where the call ends
+                ctx = hessian.ParseContext(self.rfile, registry=self.registry)
+            else:
+                ctx = hessian.BufferedParseContext(self.rfile, length=int(length),
+                                                   registry=self.registry)
+            hessian.setOptions(ctx, self.parse_options)
+            prefix = ctx.read(1)
+            # reply with protocol version of the call
+            if prefix == "H":
+                hessian2.attach(ctx, self.registry)
+                self.protocol = hessian2
+            else:
+                self.protocol = hessian
+            if self.collect_stats:
+                stats = {"call" : hessian.instrument(ctx), "reply" : None}
+            (method, headers, params) = self.protocol.Call().read(ctx, prefix)
         except Exception as e:
             self.send_error(500, "Can not parse call request. Error: " + str(e))
             return
+        if self.collect_stats:
+            self.stats = stats
+            self.method_name = method
       
         if not self.message_map.has_key(method):    
             self.send_error(500, "Method '" + method + "' is not found")
@@ -56,12 +112,17 @@ class HessianHTTPRequestHandler(BaseHTTPRequestHandler):
             result = {"stackTrace" : stackTrace, "args" : e.args}
             result.update(e.__dict__)             
         
+        if succeeded and isinstance(result, Iterator):
+            self.streamReply(headers, result)
+            return
+        
+        if self.stream_replies and self.sendSized((headers, succeeded, result)):
+            return
+        
         try:
-            sio = StringIO()
-            hessian.Reply().write(
-                          hessian.WriteContext(sio),
-                          (headers, succeeded, result))
-            reply = sio.getvalue()
+            ctx = self.replyContext()
+            self.protocol.Reply().write(ctx, (headers, succeeded, result))
+            length = len(ctx.getvalue())
         except Exception:
             stackTrace = traceback.format_exc()
             # todo write this to logs
@@ -70,9 +131,59 @@ class HessianHTTPRequestHandler(BaseHTTPRequestHandler):
         
         self.send_response(200, "OK")
         self.send_header("Content-type", "application/octet-stream")                
-        self.send_header("Content-Length", str(len(reply)))
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        ctx.flush()
+    
+    def replyContext(self, ctx=None):
+        "Context to write reply to, default is buffered one"
+        if ctx is None:
+            ctx = hessian.BufferedWriteContext(self.wfile, registry=self.registry)
+        if self.protocol is hessian2:
+            hessian2.attach(ctx, self.registry)
+        hessian.setOptions(ctx, self.write_options)
+        if self.stats is not None and not isinstance(ctx, hessian.SizingContext):
+            self.stats["reply"] = hessian.instrument(ctx)
+        return ctx
+    
+    def sendSized(self, reply):
+        """Send reply with Content-Length that is found by sizing pass.
+        Returns False if reply can not be sized."""
+        try:
+            sizing = self.replyContext(hessian.SizingContext(registry=self.registry))
+            self.protocol.Reply().write(sizing, reply)
+        except Exception:
+            return False # e.g. has iterators, let buffered write report errors
+        self.send_response(200, "OK")
+        self.send_header("Content-type", "application/octet-stream")                
+        self.send_header("Content-Length", str(sizing.size))
         self.end_headers()
-        self.wfile.write(reply)
+        stream = socket._fileobject(self.connection, "wb", self.stream_buffer_size)
+        try:
+            ctx = self.replyContext(hessian.WriteContext(stream, registry=self.registry))
+            self.protocol.Reply().write(ctx, reply)
+            stream.flush()
+        except Exception:
+            # too late to report error, client gets incomplete reply
+            traceback.print_exc()
+        return True
+    
+    def streamReply(self, headers, result):
+        """Send reply while iterator result produces elements.
+        Reply length is unknown so connection is closed after it."""
+        self.send_response(200, "OK")
+        self.send_header("Content-type", "application/octet-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = 1
+        ctx = self.replyContext()
+        ctx.streaming = True
+        try:
+            self.protocol.Reply().write(ctx, (headers, True, result))
+            ctx.flush()
+        except Exception:
+            # too late to report error, client gets incomplete reply
+            traceback.print_exc()
 
 class ServerStoppedError(Exception):
     pass
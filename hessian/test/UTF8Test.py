@@ -5,7 +5,8 @@ Created on Oct 23, 2009
 @author: petr
 '''
 import codecs
-from hessian.UTF8 import readSymbol, readString, symbolToUTF8 
+from hessian.UTF8 import readSymbol, readString, symbolToUTF8, \
+    readStringPy, readStringBulk, UTF8Exception
 
 # ----------------------------------------------------------
 # Attic
@@ -50,6 +51,31 @@ def test():
     s = u"".join(s)
     assert s == src
 
+def testBulkDecoder():
+    from StringIO import StringIO
+    src = u"ascii Кириллица ÀùúûüýþÿĀā $¢£¤¥₣₤₧₪₫€ \x00\x7f\u07ff\u0800\uffff"
+    data = src.encode("UTF-8") + "tail"
+    for size in range(len(src) + 1):
+        s_py = StringIO(data)
+        s_bulk = StringIO(data)
+        assert readStringPy(s_py, size) == readStringBulk(s_bulk, size) == src[:size]
+        # decoder must stop right after last symbol 
+        assert s_py.tell() == s_bulk.tell()
+    def expectException(s, size):
+        try: 
+            readStringBulk(StringIO(s), size)
+        except UTF8Exception:
+            pass
+        else:
+            assert False
+    expectException("\xff", 1)
+    expectException("\x80", 1)
+    expectException("\xc0\x00", 1)
+    expectException("\xe0\x80\x00", 1)
+    expectException("\xd0\xb0\xd0", 2)
+    expectException("abc", 4)
+    
+    
 def testExceptions():
     def decodeStr(s):
         from StringIO import StringIO        
@@ -101,6 +127,12 @@ def testPerformance():
     tDecode = now() - tStart       
     print "Decoding(readString)",  (len(src) / tDecode), "symbols/sec"
     #--------------------------
+    tStart = now()
+    s_read = StringIO(u0)
+    readStringPy(s_read, len(src))     
+    tDecode = now() - tStart       
+    print "Decoding(readStringPy)",  (len(src) / tDecode), "symbols/sec"
+    #--------------------------
 #    tStart = now()
 #    s_read = StringIO(u0)
 #    readString2(s_read, len(src))     
@@ -125,6 +157,7 @@ def testPerformance():
 if __name__ == "__main__":
     bruteDecoderTest()
     test()
+    testBulkDecoder()
     testExceptions()
     testPerformance()
     print "Tests passed."
@@ -0,0 +1,258 @@
+# -*- coding: UTF-8 -*-
+"""
+Codec micro-benchmarks.
+
+Every case encodes and decodes a value of generated corpus (same for
+every run) with Hessian 1.0 and 2.0 streamers. Results are written as
+JSON and may be compared with results saved earlier:
+
+    python hessian/test/benchmark.py --output base.json
+    ... change code ...
+    python hessian/test/benchmark.py --baseline base.json
+
+Comparison exits with status 1 if a case got slower than threshold.
+
+Results of each case and operation:
+    seconds - best time of one operation,
+    octets - size of encoded value,
+    mb_per_second - encoded octets per second,
+    retained_objects - garbage collector tracked objects that are kept 
+        alive by result of one operation, i.e. containers and instances 
+        of decoded value. Encoded messages are strings, so it is about 0 
+        for encoding. Temporary objects are not counted (CPython does 
+        not count allocations), so use it to compare memory held by 
+        decoded values, not allocation rate.
+"""
+import gc
+import json
+import platform
+import random
+import sys
+from collections import namedtuple
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from timeit import default_timer
+
+from hessian import hessian
+from hessian import hessian2
+
+
+CORPUS_VERSION = 1
+SEED = 20091023
+
+Point = namedtuple("Point", "x y label")
+
+
+def makeRegistry():
+    registry = hessian.REGISTRY.copy()
+    registry.registerClass(Point, "example.Point")
+    return registry
+
+REGISTRY = makeRegistry()
+
+
+def words(rnd, count, alphabet):
+    return [u"".join([rnd.choice(alphabet) for _ in range(rnd.randint(3, 12))])
+            for _ in range(count)]
+
+
+def makeCorpus():
+    "Name to value of every case. Values depend only on SEED."
+    rnd = random.Random(SEED)
+    ascii = u"abcdefghijklmnopqrstuvwxyz"
+    cyrillic = u"абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+    corpus = {}
+    corpus["int"] = [rnd.randint(-2 ** 31, 2 ** 31 - 1) for _ in range(1000)]
+    corpus["small int"] = [rnd.randint(-16, 47) for _ in range(1000)]
+    corpus["long"] = [long(rnd.randint(-2 ** 63, 2 ** 63 - 1)) for _ in range(1000)]
+    corpus["double"] = [rnd.uniform(-1e6, 1e6) for _ in range(1000)]
+    corpus["bool and null"] = [rnd.choice([True, False, None]) for _ in range(1000)]
+    corpus["scalars"] = [rnd.choice([rnd.randint(0, 1000), rnd.random(), True, None])
+                         for _ in range(1000)]
+    start = datetime(2009, 10, 23)
+    corpus["date"] = [start + timedelta(seconds=rnd.randint(0, 10 ** 8))
+                      for _ in range(1000)]
+    corpus["short string"] = words(rnd, 1000, ascii)
+    corpus["long string"] = u" ".join(words(rnd, 20000, ascii))
+    corpus["non-ascii text"] = u" ".join(words(rnd, 20000, cyrillic))
+    corpus["binary"] = "".join([chr(rnd.randint(0, 255)) for _ in range(2 ** 17)])
+    corpus["nested maps"] = [
+        {u"id" : k, u"name" : rnd.choice(words(rnd, 5, ascii)),
+         u"score" : rnd.random(), u"active" : rnd.random() < 0.5,
+         u"tags" : words(rnd, 3, ascii),
+         u"address" : {u"city" : words(rnd, 1, ascii)[0], u"zip" : rnd.randint(0, 99999)}}
+        for k in range(500)]
+    shared = [{u"id" : k, u"tags" : words(rnd, 2, ascii)} for k in range(50)]
+    graph = [{u"node" : k, u"links" : [rnd.choice(shared) for _ in range(5)]}
+             for k in range(500)]
+    graph.append(graph) # cycle
+    corpus["references"] = graph
+    corpus["typed objects"] = [Point(rnd.randint(0, 100), rnd.random(), rnd.choice(ascii))
+                               for _ in range(1000)]
+    corpus["call"] = ("getRecords", [], [corpus["nested maps"][:50], 10, u"filter"])
+    corpus["reply"] = ([], True, corpus["nested maps"][:50])
+    return corpus
+
+
+def envelope(name):
+    "Streamer class name of case's value (or None for values)"
+    return {"call" : "Call", "reply" : "Reply"}.get(name)
+
+
+def codec(name, value, version):
+    "Returns (encode, decode) functions of case"
+    module = {1 : hessian, 2 : hessian2}[version]
+    streamerName = envelope(name)
+
+    def writeContext():
+        ctx = hessian.BufferedWriteContext(None, registry=REGISTRY)
+        if version == 2:
+            hessian2.attach(ctx, REGISTRY)
+        return ctx
+
+    def readContext(data):
+        ctx = hessian.BufferedParseContext(data, registry=REGISTRY)
+        if version == 2:
+            hessian2.attach(ctx, REGISTRY)
+        return ctx
+
+    if streamerName is None:
+        def encode():
+            ctx = writeContext()
+            hessian.writeObject(ctx, value, None)
+            return ctx.getvalue()
+
+        def decode(data):
+            return hessian.readObject(readContext(data))
+    else:
+        streamer = getattr(module, streamerName)()
+
+        def encode():
+            ctx = writeContext()
+            streamer.write(ctx, value)
+            return ctx.getvalue()
+
+        def decode(data):
+            ctx = readContext(data)
+            return streamer.read(ctx, ctx.read(1))
+    return encode, decode
+
+
+def measure(operation, repeat, minTime):
+    """Best time of one call of operation. Calls are repeated in batches
+    that take at least minTime, best of 'repeat' batches is taken."""
+    calls = 1
+    while True:
+        start = default_timer()
+        for _ in xrange(calls):
+            operation()
+        elapsed = default_timer() - start
+        if elapsed >= minTime:
+            break
+        calls *= 2
+    best = elapsed / calls
+    for _ in range(repeat - 1):
+        start = default_timer()
+        for _ in xrange(calls):
+            operation()
+        best = min(best, (default_timer() - start) / calls)
+    return best
+
+
+def countRetained(operation):
+    "Number of tracked objects that are kept alive by operation's result"
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        result = operation()
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+    del result
+    return after - before
+
+
+def run(names, repeat, minTime):
+    corpus = makeCorpus()
+    results = {}
+    for name in names:
+        for version in [1, 2]:
+            encode, decode = codec(name, corpus[name], version)
+            data = encode()
+            for op, operation in [("encode", encode), ("decode", lambda: decode(data))]:
+                seconds = measure(operation, repeat, minTime)
+                key = "%s/%d/%s" % (name, version, op)
+                results[key] = {"seconds" : seconds,
+                                "octets" : len(data),
+                                "mb_per_second" : len(data) / seconds / 2 ** 20,
+                                "retained_objects" : countRetained(operation)}
+                print >> sys.stderr, "%-32s %10.1f us %8.2f MB/s" % \
+                    (key, seconds * 1e6, results[key]["mb_per_second"])
+    return {"corpus" : CORPUS_VERSION,
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "results" : results}
+
+
+def compare(report, baseline, threshold):
+    """Print cases which time changed by more than threshold (fraction).
+    Returns number of regressions."""
+    if baseline.get("corpus") != report["corpus"]:
+        print >> sys.stderr, "Baseline has different corpus version, results may differ"
+    regressions = 0
+    for key in sorted(report["results"]):
+        if key not in baseline["results"]:
+            continue
+        old = baseline["results"][key]["seconds"]
+        new = report["results"][key]["seconds"]
+        change = new / old - 1
+        if change > threshold:
+            regressions += 1
+            print "SLOWER %-32s %+6.1f%%" % (key, 100 * change)
+        elif change < -threshold:
+            print "faster %-32s %+6.1f%%" % (key, 100 * change)
+        oldSize = baseline["results"][key]["octets"]
+        newSize = report["results"][key]["octets"]
+        if oldSize != newSize:
+            print "size   %-32s %d -> %d" % (key, oldSize, newSize)
+    return regressions
+
+
+def main(args):
+    parser = OptionParser(usage="%prog [options] [case ...]")
+    parser.add_option("-o", "--output", help="write results to file (JSON)")
+    parser.add_option("-b", "--baseline", help="compare with results saved earlier")
+    parser.add_option("-t", "--threshold", type="float", default=0.1,
+                      help="relative slow down that is reported as regression")
+    parser.add_option("-r", "--repeat", type="int", default=5,
+                      help="batches of calls, best one is taken")
+    parser.add_option("-m", "--min-time", type="float", default=0.05, dest="minTime",
+                      help="minimal duration of batch (seconds)")
+    parser.add_option("-l", "--list", action="store_true", help="list cases")
+    options, names = parser.parse_args(args)
+    available = sorted(makeCorpus())
+    if options.list:
+        print "\n".join(available)
+        return 0
+    for name in names:
+        if name not in available:
+            parser.error("Unknown case '%s'" % name)
+    report = run(names or available, options.repeat, options.minTime)
+    if options.output:
+        f = open(options.output, "w")
+        json.dump(report, f, indent=1, sort_keys=True)
+        f.close()
+    elif not options.baseline:
+        print json.dumps(report, indent=1, sort_keys=True)
+    if options.baseline:
+        f = open(options.baseline)
+        baseline = json.load(f)
+        f.close()
+        if compare(report, baseline, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
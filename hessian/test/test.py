@@ -23,12 +23,19 @@
 #
 from hessian.hessian import ParseContext, WriteContext, readObjectByPrefix
 from hessian import hessian  
+from hessian import hessian2
+from hessian import records
 from hessian.client import HessianProxy
 from hessian.server import HessianHTTPRequestHandler, StoppableHTTPServer
 from StringIO import StringIO
+from datetime import datetime, timedelta, tzinfo
+from tempfile import TemporaryFile, mkstemp
+from mmap import mmap
+from array import array
 from time import sleep
 from threading import Thread
 import traceback
+import os
 
 
 __revision__ = "$Rev$"
@@ -150,6 +157,741 @@ def testHessianTypes():
     autoLoopBackTest(hessian.XmlString(u"<hello who=\"Небольшой текст тут!\"/>"))    
     
 
+def chunkedTest():
+    size = hessian.Chunked.chunk_size
+    for length in [0, 1, size - 1, size, size + 1, 3 * size + 5]:
+        loopBackTest(hessian.Binary, "".join([chr(k % 256) for k in range(length)]))
+        loopBackTest(hessian.UnicodeString, (u"Щ" * length))
+        loopBackTest(hessian.Xml, hessian.XmlString(u"x" * length))
+    
+
+def subclassTest():
+    from collections import OrderedDict, namedtuple
+    
+    class Text(unicode):
+        pass
+    
+    Point = namedtuple("Point", "x y")
+    autoLoopBackTest(OrderedDict([(u"one", 1), (u"two", 2)]))
+    autoLoopBackTest(Text(u"some text"))
+    s = StringIO()
+    hessian.writeObject(WriteContext(s), Point(1, 2), None)
+    assert readObjectString(s.getvalue()) == [1, 2]
+
+
+def registryTest():
+    class SetStreamer(hessian.Array):
+        ptype = set
+        def write(self, ctx, value):
+            hessian.Array.write(self, ctx, sorted(value))
+    
+    registry = hessian.REGISTRY.copy()
+    registry.register(SetStreamer())
+    s = StringIO()
+    hessian.writeObject(WriteContext(s, registry=registry), set([3, 1, 2]), None)
+    assert readObjectString(s.getvalue()) == [1, 2, 3]
+    # set's iteration order is not sorted, override must be used
+    words = set([u"b", u"a", u"c", u"zz", u"q"])
+    assert list(words) != sorted(words)
+    s = StringIO()
+    hessian.writeObject(WriteContext(s, registry=registry), [words], None)
+    assert readObjectString(s.getvalue()) == [sorted(words)]
+    
+    class SortedMap(hessian.Map):
+        def _write(self, ctx, mapping):
+            ctx.write("M")
+            for k in sorted(mapping):
+                hessian.writeObject(ctx, k, None)
+                hessian.writeObject(ctx, mapping[k], None)
+            ctx.write("z")
+    
+    registry.register(SortedMap())
+    mapping = dict([(k, None) for k in words])
+    assert list(mapping) != sorted(mapping)
+    s = StringIO()
+    hessian.writeObject(WriteContext(s, registry=registry), mapping, None)
+    assert s.getvalue() == "M" + "".join([hessian.encodeValue(k) + "N" for k in sorted(words)]) + "z"
+    
+    # global registry is not affected
+    try:
+        hessian.writeObject(WriteContext(StringIO()), set([1]), None)
+        assert False # should not get here
+    except hessian.HessianError:
+        pass
+    
+
+def typedObjectTest():
+    from collections import namedtuple
+    Point = namedtuple("Point", "x y")
+    
+    class Node(object):
+        __slots__ = ("name", "children")
+    
+    registry = hessian.REGISTRY.copy()
+    registry.registerClass(Point, "com.example.Point")
+    registry.registerClass(Node, "com.example.Node", ["name", ("children", "kids")])
+    
+    def loopBack(value, registry=registry):
+        s = StringIO()
+        hessian.writeObject(WriteContext(s, registry=registry), value, None)
+        data = s.getvalue()
+        return data, hessian.readObject(ParseContext(StringIO(data), registry=registry))
+    
+    p = Point(1, u"two")
+    data, r = loopBack([p, p])
+    assert "Mt\x00\x11com.example.Point" in data
+    assert r == [p, p] and type(r[0]) == Point and r[0] is r[1]
+    
+    root = Node()
+    root.name = u"root"
+    root.children = [root]
+    data, r = loopBack(root)
+    assert "kids" in data
+    assert type(r) == Node and r.name == u"root" and r.children[0] is r
+    
+    # fields in other order, unknown and missing fields
+    txt = """M t x00 x11 com.example.Point
+        S x00 x01 y I x00 x00 x00 x02
+        S x00 x05 color S x00 x03 red
+        z"""
+    r = readObjectString(parseData(txt))
+    assert r == {"y" : 2, "color" : u"red"} # not registered globally 
+    r = hessian.readObject(ParseContext(StringIO(parseData(txt)), registry=registry))
+    assert r == Point(None, 2)
+    
+
+def internTest():
+    records = [{u"name" : u"n%d" % k, u"id" : k} for k in range(50)]
+    s = StringIO()
+    hessian.writeObject(WriteContext(s), records, None)
+    ctx = ParseContext(StringIO(s.getvalue()))
+    hessian.setOptions(ctx, {"internStrings" : 8})
+    r = hessian.readObject(ctx)
+    assert r == records
+    keys = [k for k in r[0] if k == u"name"][0]
+    assert all([[k for k in m if k == u"name"][0] is keys for m in r])
+    # empty strings are not interned unless asked
+    for version in [1, 2]:
+        ctx = hessian.BufferedWriteContext(None)
+        if version == 2:
+            hessian2.attach(ctx, None)
+        hessian.writeObject(ctx, [u"", u""], None)
+        ctx = hessian.BufferedParseContext(ctx.getvalue())
+        if version == 2:
+            hessian2.attach(ctx, None)
+        assert hessian.readObject(ctx) == [u"", u""]
+        assert ctx.internTable is None
+    
+    table = hessian.InternTable(4)
+    a = table.get(u"key a")
+    assert table.get(u" ".join([u"key", u"a"])) is a
+    for v in u"bcdef":
+        table.get(u"key " + v)
+    assert table.get(u" ".join([u"key", u"a"])) is not a # evicted
+    assert len(table.recent) + len(table.previous) <= 4
+    
+
+def dateTest():
+    def roundTrip(value, options, dateLists=None):
+        ctx = hessian.BufferedWriteContext(None)
+        hessian.setOptions(ctx, options)
+        hessian.writeObject(ctx, value, None)
+        ctx = hessian.BufferedParseContext(ctx.getvalue())
+        hessian.setOptions(ctx, dict(options, dateLists=dateLists))
+        return hessian.readObject(ctx)
+    
+    d = datetime(2011, 3, 27, 1, 30, 15, 250000)
+    utc = {"dates" : "utc"}
+    assert hessian.toMilliseconds(d, "utc") == 1301189415250
+    assert hessian.fromMilliseconds(1301189415250, "utc") == d
+    assert roundTrip(d, utc) == d
+    assert roundTrip(d, {"dates" : "offset"}) == d
+    assert roundTrip(d, {}) == d
+    # both modes round down to milliseconds, also before epoch
+    old = datetime(1960, 5, 5, 1, 2, 3, 4500)
+    for mode in ["local", "utc"]:
+        m = hessian.toMilliseconds(old, mode)
+        assert hessian.fromMilliseconds(m, mode) == old.replace(microsecond=4000)
+    
+    class Zone(tzinfo):
+        def utcoffset(self, dt):
+            return timedelta(hours=3)
+    aware = d.replace(tzinfo=Zone())
+    assert hessian.toMilliseconds(aware) == 1301189415250 - 3 * 3600000
+    assert roundTrip(aware, utc) == d - timedelta(hours=3)
+    
+    dates = [d + timedelta(days=k, milliseconds=k) for k in range(100)]
+    for value in [dates, hessian.DateColumn(dates)]:
+        assert roundTrip(value, utc) == dates
+        assert roundTrip(value, utc, "datetime") == dates
+        assert roundTrip(value, {}, "datetime") == dates
+        r = roundTrip(value, utc, "milliseconds")
+        assert list(r) == [hessian.toMilliseconds(v, "utc") for v in dates]
+    milliseconds = [hessian.toMilliseconds(v, "utc") for v in dates]
+    assert roundTrip(hessian.DateColumn(milliseconds), utc, "datetime") == dates
+    mixed = [d, 1]
+    assert roundTrip(mixed, utc, "datetime") == mixed
+    
+    ctx = hessian.BufferedWriteContext(None)
+    hessian2.attach(ctx, None)
+    hessian.setOptions(ctx, utc)
+    hessian.writeObject(ctx, hessian.DateColumn(dates), None)
+    ctx = hessian.BufferedParseContext(ctx.getvalue())
+    hessian2.attach(ctx, None)
+    hessian.setOptions(ctx, utc)
+    assert hessian.readObject(ctx) == dates
+    
+
+def binaryViewTest():
+    blob = "".join([chr(k % 256) for k in range(10000)])
+    f = TemporaryFile()
+    f.write(blob)
+    f.flush()
+    mapped = mmap(f.fileno(), 0)
+    for module in [hessian, hessian2]:
+        for value in [bytearray(blob), memoryview(blob), mapped, blob]:
+            ctx = hessian.BufferedWriteContext(None)
+            if module is hessian2:
+                hessian2.attach(ctx, None)
+            hessian.writeObject(ctx, [value, "small"], None)
+            data = ctx.getvalue()
+            ctx = hessian.BufferedParseContext(data)
+            if module is hessian2:
+                hessian2.attach(ctx, None)
+            hessian.setOptions(ctx, {"binaryViews" : True})
+            r = hessian.readObject(ctx)
+            assert r[0] == blob # joined chunks
+            assert isinstance(r[1], memoryview) and r[1].tobytes() == "small"
+            # views are copied once when message is flushed
+            written = []
+            class Stream:
+                write = written.append
+            ctx = hessian.BufferedWriteContext(Stream())
+            if module is hessian2:
+                hessian2.attach(ctx, None)
+            hessian.writeObject(ctx, [value, "small"], None)
+            ctx.flush()
+            assert written == [data]
+            assert isinstance(written[0], bytearray) != (value is blob)
+    mapped.close()
+    f.close()
+    
+
+def recordsTest():
+    values = [{u"id" : k, u"name" : u"record %d" % k, u"data" : "x" * (k % 300)} 
+              for k in range(5000)]
+    handle, path = mkstemp()
+    os.close(handle)
+    for version in [1, 2]:
+        writer = records.RecordWriter(open(path, "wb"), version)
+        for v in values:
+            writer.write(v)
+        writer.close()
+        r = records.RecordFile(path, options={"binaryViews" : True})
+        assert len(r) == len(values)
+        assert r[4321][u"name"] == u"record 4321"
+        assert str(r[299][u"data"]) == "x" * 299
+        assert r[-1][u"id"] == 4999
+        assert [v[u"id"] for v in r] == range(5000)
+        try:
+            r[5000]
+            assert False
+        except IndexError:
+            pass
+        r.close()
+    os.remove(path)
+        
+    # no index: records are found by their frames
+    f = TemporaryFile()
+    writer = records.RecordWriter(f)
+    for v in values[:10]:
+        writer.write(v)
+    f.flush()
+    r = records.RecordFile(f)
+    assert list(r) == values[:10]
+    r.close()
+    
+    # files that are not record files are closed if opened by name
+    handle, path = mkstemp()
+    os.close(handle)
+    for data in ["", "HREC", "not a record file"]:
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        for source in [path, open(path, "rb")]:
+            try:
+                records.RecordFile(source)
+                assert False # should not get here
+            except hessian.HessianError:
+                pass
+            if isinstance(source, file):
+                assert not source.closed
+                source.close()
+    if os.path.isdir("/proc/self/fd"):
+        fds = len(os.listdir("/proc/self/fd"))
+        try:
+            records.RecordFile(path)
+        except hessian.HessianError:
+            pass
+        assert len(os.listdir("/proc/self/fd")) == fds
+    os.remove(path)
+    
+
+def sizingTest():
+    shared = {u"name" : u"Пррревед", "blob" : "x" * 10000}
+    values = [None, True, 7, long(2 ** 40), 1.5, -0.0, datetime(2000, 1, 1),
+              u"Пррревед обонентеги!" * 1000, "y" * 100000,
+              [shared, shared, (1, 2), (1, 2)], range(300), array("d", range(50))]
+    for version in [1, 2]:
+        for options in [{}, {"references" : "value"}, {"references" : "off"}]:
+            ctx = hessian.BufferedWriteContext(None)
+            sizing = hessian.SizingContext()
+            for c in [ctx, sizing]:
+                if version == 2:
+                    hessian2.attach(c, None)
+                hessian.setOptions(c, options)
+                hessian.writeObject(c, values, None)
+            assert sizing.size == len(ctx.getvalue())
+    # sizes of streamers' boundary cases are exact
+    chunk = hessian.Chunked.chunk_size
+    pair = u"\ud800\udc00"
+    strings = [u"", u"x" * 31, u"x" * 32, u"я" * 1023, u"я" * 1024, pair, 
+               u"x" * (chunk - 1) + pair, u"я" * chunk, u"\u20ac" * (2 * chunk + 1), 
+               u"\U0001f600" * 5]
+    binaries = ["", "b" * 15, "b" * 16, "b" * 1023, "b" * 1024, "b" * chunk, 
+                "b" * (chunk + 1), bytearray("c" * (3 * chunk))]
+    numbers = [0, -16, 47, 48, -2048, 2047, 2048, -262144, 262143, 262144, 
+               2 ** 31 - 1, -2 ** 31, long(7), long(-9), long(2 ** 40), 
+               0.0, -0.0, 1.0, 127.0, -128.0, 200.0, 32767.0, 32768.0, 0.25, 1e300, 
+               [1, 2, 3], [long(1), long(2)], [0.5, 1.5], array("i", [1, 2]), 
+               [datetime(2000, 1, 1), datetime(2001, 1, 1, 0, 0, 1)], 
+               datetime(1960, 5, 5, 1, 2, 3, 4000), 
+               hessian.DateColumn([datetime(2000, 1, 1)] * 9)]
+    for version in [1, 2]:
+        for value in strings + binaries + numbers:
+            for options in [{}, {"dates" : "utc"}]:
+                ctx = hessian.BufferedWriteContext(None)
+                sizing = hessian.SizingContext()
+                for c in [ctx, sizing]:
+                    if version == 2:
+                        hessian2.attach(c, None)
+                    hessian.setOptions(c, options)
+                    hessian.writeObject(c, [value, value], None)
+                assert sizing.size == len(ctx.getvalue()), (version, value)
+    # scalars are sized without being encoded
+    class Counting(hessian.SizingContext):
+        writes = 0
+        def write(self, data):
+            Counting.writes += 1
+            hessian.SizingContext.write(self, data)
+    for version in [1, 2]:
+        sizing = Counting()
+        if version == 2:
+            hessian2.attach(sizing, None)
+        hessian.writeObject(sizing, u"Пррревед" * 10000, None)
+        hessian.writeObject(sizing, 2.5, None)
+        hessian.writeObject(sizing, "x" * 10000, None)
+    assert Counting.writes == 0
+    try:
+        hessian.writeObject(hessian.SizingContext(), iter(range(3)), None)
+        assert False # should not get here
+    except hessian.HessianError:
+        pass
+    
+
+def deepTest():
+    depth = 100000
+    ctx = ParseContext(StringIO("V" * depth + "z" * depth))
+    r = hessian.readObject(ctx)
+    for _ in range(depth - 1):
+        r = r[0]
+    assert r == []
+    ctx = ParseContext(StringIO("MS\x00\x01k" * depth + "N" + "z" * depth))
+    r = hessian.readObject(ctx)
+    for _ in range(depth - 1):
+        r = r[u"k"]
+    assert r == {u"k" : None}
+    ctx = hessian.BufferedParseContext("\x79" * depth + "\x90")
+    hessian2.attach(ctx, None)
+    r = hessian.readObject(ctx)
+    for _ in range(depth):
+        r = r[0]
+    assert r == 0
+    
+    deep = []
+    for _ in range(depth):
+        deep = [deep, {u"k" : deep}]
+    for attach in [lambda ctx: None, lambda ctx: hessian2.attach(ctx, None)]:
+        ctx = hessian.BufferedWriteContext(None)
+        attach(ctx)
+        hessian.writeObject(ctx, deep, None)
+        ctx = hessian.BufferedParseContext(ctx.getvalue())
+        attach(ctx)
+        r = hessian.readObject(ctx)
+        for _ in range(depth):
+            assert r[1][u"k"] is r[0]
+            r = r[0]
+        assert r == []
+    
+    # pre-processing is applied to every value
+    seen = []
+    def pre(value):
+        seen.append(value)
+        return value
+    value = [1, u"a", {u"b" : 2.5}, None]
+    hessian.writeObject(hessian.BufferedWriteContext(None, pre), value, None)
+    assert seen == [value, 1, u"a", value[2], u"b", 2.5, None]
+    
+    # references are numbered in order lists and maps start
+    a = [1]
+    b = {u"x" : a}
+    value = [a, b, [b, a], {u"y" : [a]}]
+    s = StringIO()
+    hessian.writeObject(WriteContext(s), value, None)
+    ctx = ParseContext(StringIO(s.getvalue()))
+    r = hessian.readObject(ctx)
+    assert r == value
+    assert r[1][u"x"] is r[0] and r[2][0] is r[1] and r[3][u"y"][0] is r[0]
+    expected = [r, r[0], r[1], r[2], r[3], r[3][u"y"]]
+    assert [id(o) for o in ctx.referencedObjects] == [id(o) for o in expected]
+    
+    for data in ["Vl\x00\x00\x00\x02I\x00\x00\x00\x01", "MS\x00\x01kz",
+                 "Vl\x00\x00\x00\x03I\x00\x00\x00\x01z", "Vl\x00\x00\x00\x01z",
+                 "VVl\x00\x00\x00\x02I\x00\x00\x00\x01zz"]:
+        try:
+            hessian.readObject(ParseContext(StringIO(data)))
+            assert False # should not get here
+        except hessian.HessianError:
+            pass
+    
+
+def statsTest():
+    shared = {u"name" : u"Пррревед", u"tags" : [u"a", u"b"]}
+    value = [1, long(2 ** 40), 2.5, datetime(2000, 1, 1), u"Пррревед" * 10000, 
+             "x" * 100, [shared, [shared, None, True]], range(10)]
+    for version in [1, 2]:
+        plain = hessian.BufferedWriteContext(None)
+        ctx = hessian.BufferedWriteContext(None)
+        for c in [plain, ctx]:
+            if version == 2:
+                hessian2.attach(c, None)
+        stats = hessian.instrument(ctx)
+        assert ctx.stats is stats and plain.stats is None
+        hessian.writeObject(plain, value, None)
+        hessian.writeObject(ctx, value, None)
+        data = ctx.getvalue()
+        assert data == plain.getvalue() # same encoding
+        assert stats.octets == len(data)
+        assert (stats.depth, stats.references) == (4, 6)
+        for source in [StringIO(data), data]:
+            if isinstance(source, str):
+                parse = hessian.BufferedParseContext(source)
+            else:
+                parse = ParseContext(source)
+            if version == 2:
+                hessian2.attach(parse, None)
+            readStats = hessian.instrument(parse)
+            assert hessian.readObject(parse) == value
+            assert readStats.octets == len(data)
+            assert (readStats.depth, readStats.references) == (4, 6)
+    # octets of list end markers are not attributed to types (2 of 25)
+    ctx = hessian.BufferedWriteContext(None)
+    stats = hessian.instrument(ctx)
+    hessian.writeObject(ctx, [u"abc", [None, u"d"]], None)
+    data = ctx.getvalue()
+    expected = {"V" : [2, 12], "S" : [2, 10], "N" : [1, 1]}
+    assert dict([(code, entry[:2]) for code, entry in stats.types.items()]) == expected
+    parse = hessian.BufferedParseContext(data)
+    readStats = hessian.instrument(parse)
+    hessian.readObject(parse)
+    assert dict([(code, entry[:2]) for code, entry in readStats.types.items()]) == expected
+    assert stats.octets == readStats.octets == len(data) == 25
+    assert "references 2" in str(readStats)
+    
+
+def hessian2Test():
+    def write(value, registry=None):
+        ctx = hessian.BufferedWriteContext(None)
+        hessian2.attach(ctx, registry)
+        hessian.writeObject(ctx, value, None)
+        return ctx.getvalue()
+    
+    def read(data, registry=None, options={}):
+        ctx = hessian.BufferedParseContext(data)
+        hessian2.attach(ctx, registry)
+        hessian.setOptions(ctx, options)
+        result = hessian.readObject(ctx)
+        assert ctx.tell() == len(data)
+        return result
+    
+    # encodings from specification
+    for value, data in [(0, "\x90"), (-16, "\x80"), (47, "\xbf"), 
+                        (-2048, "\xc0\x00"), (2047, "\xcf\xff"),
+                        (-262144, "\xd0\x00\x00"), (262143, "\xd7\xff\xff"),
+                        (2 ** 31 - 1, "I\x7f\xff\xff\xff"),
+                        (0L, "\xe0"), (-8L, "\xd8"), (-2048L, "\xf0\x00"), 
+                        (-262144L, "\x38\x00\x00"), (2L ** 31 - 1, "Y\x7f\xff\xff\xff"),
+                        (2L ** 31, "L\x00\x00\x00\x00\x80\x00\x00\x00"),
+                        (0.0, "\x5b"), (1.0, "\x5c"), (-128.0, "\x5d\x80"),
+                        (32767.0, "\x5e\x7f\xff"), (12.25, "\x5f\x00\x00\x2f\xda"),
+                        (u"", "\x00"), (u"hello", "\x05hello"), 
+                        ("", "\x20"), ("\x01\x02", "\x22\x01\x02"),
+                        ([], "\x78"), ([0, 1], "\x7a\x90\x91"), 
+                        ({1 : u"a"}, "H\x91\x01aZ")]:
+        assert write(value) == data, (value, write(value))
+        assert read(data) == value
+    
+    from datetime import datetime
+    values = [-0.0, 1e300, 0.001, 2 ** 40, u"a" * 31, u"b" * 1023, u"Превед" * 3000,
+              "x" * 15, "y" * 1023, "z" * 9000, None, True, [u"a"] * 300, 
+              datetime(2020, 1, 2, 3, 4), datetime(2020, 1, 2, 3, 4, 5)]
+    for value in values:
+        r = read(write(value))
+        assert r == value and repr(r) == repr(value)
+    assert read(write((1, 2))) == [1, 2]
+    assert read(write(iter([1, 2]))) == [1, 2]
+    
+    # numbers and dates written at once are read at once with options
+    for code, value in [("I", array("i", [1, -2, 3])), ("D", array("d", [0.5] * 10)), 
+                        ("L", array("l", [2 ** 40, 1]))]:
+        data = write(value)
+        assert data.endswith(hessian.tagNumbers(code, value))
+        assert read(data) == value.tolist()
+        r = read(data, None, {"numericLists" : "array"})
+        assert type(r) == array and r.tolist() == value.tolist()
+    assert read(write([1, 2]), None, {"numericLists" : "array"}) == [1, 2] # compact
+    dates = [datetime(2020, 1, 2, 3, 4, k) for k in range(9)]
+    data = write(hessian.DateColumn(dates))
+    assert read(data) == dates
+    assert read(data, None, {"dateLists" : "datetime"}) == dates
+    r = read(data, None, {"dateLists" : "milliseconds"})
+    assert list(r) == [hessian.toMilliseconds(d) for d in dates]
+    
+    a = [1]
+    a.append(a)
+    r = read(write([a, a]))
+    assert r[0] is r[1] and r[0][1] is r[0]
+    
+    # objects, class definitions are sent once
+    from collections import namedtuple
+    Point = namedtuple("Point", "x y")
+    
+    class Node(object):
+        __slots__ = ("name", "parent")
+    
+    registry = hessian.REGISTRY.copy()
+    registry.registerClass(Point, "com.example.Point")
+    registry.registerClass(Node, "com.example.Node", [("name", "title"), "parent"])
+    n = Node()
+    n.name = u"root"
+    n.parent = n
+    data = write([Point(1, 2), Point(3, 4), n], registry)
+    assert data.count("com.example.Point") == 1
+    r = read(data, registry)
+    assert r[:2] == [Point(1, 2), Point(3, 4)] and type(r[1]) == Point
+    assert r[2].name == u"root" and r[2].parent is r[2]
+    unregistered = read(data)
+    assert unregistered[0] == {u"x" : 1, u"y" : 2}
+    assert unregistered[2]["parent"] is unregistered[2]
+    
+    # custom streamers of Hessian 1.0 registry
+    class Money(object):
+        def __init__(self, amount, currency):
+            self.amount = amount
+            self.currency = currency
+        def fields(self):
+            return {u"amount" : self.amount, u"currency" : self.currency}
+    
+    class MoneyStreamer(hessian.Map):
+        ptype = Money
+        def write(self, ctx, value):
+            hessian.Map.write(self, ctx, value.fields())
+    
+    custom = hessian.REGISTRY.copy()
+    custom.register(MoneyStreamer())
+    assert read(write([1, u"a"], custom)) == [1, u"a"]
+    try:
+        write(Money(10, u"EUR"), custom)
+        assert False # should not get here
+    except hessian.HessianError:
+        pass
+    
+    class Money2Streamer(hessian2.Map):
+        ptype = Money
+        def write(self, ctx, value):
+            hessian2.Map.write(self, ctx, value.fields())
+    
+    class PortableMoneyStreamer(MoneyStreamer):
+        streamer2 = Money2Streamer()
+    
+    custom.register(PortableMoneyStreamer())
+    assert read(write(Money(10, u"EUR"), custom)) == {u"amount" : 10, u"currency" : u"EUR"}
+    
+    # typed list and map with type references
+    txt = """U x01 t x91 Z
+             M x90 x01 x x92 Z"""
+    r = read(parseData("X x92 " + txt))
+    assert r == [[1], {u"x" : 2}]
+    txt = """M x11 com.example.Point x01 y x92 Z"""
+    assert read(parseData(txt), registry) == Point(None, 2)
+    
+    call = ("hello", [], [u"world", 1])
+    ctx = hessian.BufferedWriteContext(None)
+    hessian2.attach(ctx)
+    hessian2.Call().write(ctx, call)
+    data = ctx.getvalue()
+    assert data == "H\x02\x00C\x05hello\x92\x05world\x91"
+    ctx = hessian.BufferedParseContext(data)
+    hessian2.attach(ctx)
+    assert hessian2.Call().read(ctx, ctx.read(1)) == call
+    
+    for reply in [([], True, [1]), ([], False, {u"code" : u"Error"})]:
+        ctx = hessian.BufferedWriteContext(None)
+        hessian2.attach(ctx)
+        hessian2.Reply().write(ctx, reply)
+        ctx = hessian.BufferedParseContext(ctx.getvalue())
+        prefix = ctx.read(1)
+        assert hessian2.replyStreamer(ctx, prefix).read(ctx, prefix) == reply
+    
+
+def numericListTest():
+    from array import array
+    lists = [[1, -2, 3, 2 ** 31 - 1, -2 ** 31],
+             [1L, -2L, 2L ** 62],
+             [0.5, -1.0, 1e300],
+             [1, 2.0, 3L], # mixed
+             [True, False]]
+    for l in lists:
+        s = StringIO()
+        hessian.writeObject(WriteContext(s), l, None)
+        data = s.getvalue()
+        # should be the same as element by element encoding
+        s = StringIO()
+        ctx = WriteContext(s)
+        ctx.write("V")
+        hessian.Length().write(ctx, len(l))
+        for x in l: 
+            hessian.writeObject(ctx, x, None)
+        ctx.write("z")
+        assert s.getvalue() == data
+        for mode in [None, "array"]:
+            ctx = hessian.BufferedParseContext(data)
+            ctx.numericLists = mode
+            r = hessian.readObject(ctx)
+            assert list(r) == l
+            assert ctx.read(1) == ""
+    
+    for a in [array("d", [0.5, 1.5, -7.0]), array("i", [1, 2, -3]), array("h", [0, 1])]:
+        autoLoopBackTest(a.tolist()) 
+        s = StringIO()
+        hessian.writeObject(WriteContext(s), a, None)
+        assert readObjectString(s.getvalue()) == a.tolist()
+        ctx = hessian.BufferedParseContext(s.getvalue())
+        ctx.numericLists = "array"
+        r = hessian.readObject(ctx)
+        assert type(r) == array and r.tolist() == a.tolist()
+        
+    # pre-processing is applied to every element
+    pre = lambda x: x * 10 if type(x) is int else x
+    for value, expected in [([1, 2, 3], [10, 20, 30]), ([1, u"a"], [10, u"a"]), 
+                            (array("i", [1, 2]), [10, 20])]:
+        ctx = hessian.BufferedWriteContext(None, pre)
+        hessian.writeObject(ctx, value, None)
+        assert readObjectString(ctx.getvalue()) == expected
+        sizing = hessian.SizingContext(pre)
+        hessian.writeObject(sizing, value, None)
+        assert sizing.size == len(ctx.getvalue())
+    
+    # numpy options fail early if there is no numpy
+    saved = hessian.numpy
+    hessian.numpy = None
+    try:
+        for options in [{"numericLists" : "numpy"}, {"numpyBinaries" : True}, 
+                        {"dateLists" : "numpy"}]:
+            try:
+                hessian.setOptions(hessian.BufferedParseContext(""), options)
+                assert False # should not get here
+            except hessian.HessianError:
+                pass
+        hessian.setOptions(hessian.BufferedParseContext(""), {"numpyBinaries" : False})
+    finally:
+        hessian.numpy = saved
+    
+    if hessian.numpy is None:
+        print "Warning: Can not load numpy module. NumPy arrays will not be tested."
+        return
+    import numpy
+    for a in [numpy.array([0.5, 1.5, -7.0]), numpy.arange(10, dtype="int16"), 
+              numpy.array([2 ** 40, 3], dtype="int64"), numpy.array([True, False]),
+              numpy.arange(6).reshape(2, 3)]:
+        s = StringIO()
+        hessian.writeObject(WriteContext(s), a, None)
+        # N-D arrays are written flat, shape is kept in type name only
+        assert readObjectString(s.getvalue()) == a.ravel().tolist()
+        ctx = hessian.BufferedParseContext(s.getvalue())
+        ctx.numericLists = "numpy"
+        r = hessian.readObject(ctx)
+        if a.dtype.kind != "b":
+            assert type(r) == numpy.ndarray and r.shape == a.shape
+        assert numpy.all(numpy.array(r) == a)
+        
+
+def ndarrayTest():
+    if hessian.numpy is None:
+        print "Warning: Can not load numpy module. NumPy arrays will not be tested."
+        return
+    import numpy
+    arrays = [numpy.arange(6, dtype="int32").reshape(2, 3),
+              numpy.arange(24, dtype=">f8").reshape(2, 3, 4)[:, ::2, :],
+              numpy.array([2 ** 40, -1]),
+              numpy.asfortranarray(numpy.ones((3, 2), dtype="float32")),
+              numpy.array([], dtype="int16")]
+    for module in [hessian, hessian2]:
+        for a in arrays:
+            for mode in ["list", "binary"]:
+                ctx = hessian.BufferedWriteContext(None)
+                if module is hessian2:
+                    hessian2.attach(ctx, None)
+                hessian.writeObject(ctx, a, module.NumpyArray(mode))
+                data = ctx.getvalue()
+                ctx = hessian.BufferedParseContext(data)
+                if module is hessian2:
+                    hessian2.attach(ctx, None)
+                hessian.setOptions(ctx, {"numericLists" : "numpy", "numpyBinaries" : True})
+                r = hessian.readObject(ctx)
+                if a.size > 0:
+                    assert type(r) == numpy.ndarray
+                    assert r.shape == a.shape
+                    assert r.dtype.isnative
+                if mode == "binary":
+                    assert r.dtype == a.dtype.newbyteorder("=")
+                assert numpy.all(r == a)
+                
+                # context option selects mode by default
+                ctx = hessian.BufferedWriteContext(None)
+                if module is hessian2:
+                    hessian2.attach(ctx, None)
+                ctx.numpyArrays = mode
+                hessian.writeObject(ctx, a, None)
+                assert ctx.getvalue() == data
+            
+    # Java compatible type name
+    s = StringIO()
+    hessian.writeObject(WriteContext(s), numpy.array([1.0, 2.0]), None)
+    assert s.getvalue().startswith("Vt\x00\x07[doublel\x00\x00\x00\x02D")
+    # binaries are read as strings by default
+    s = StringIO()
+    hessian.writeObject(WriteContext(s), numpy.array([1.0, 2.0]), hessian.NumpyArray("binary"))
+    assert readObjectString(s.getvalue()).startswith(hessian.NPY_MAGIC)
+    # Hessian 2.0 typed lists refer to type names written before
+    ctx = hessian.BufferedWriteContext(None)
+    hessian2.attach(ctx, None)
+    hessian.writeObject(ctx, [numpy.array([1.0, 2.0]), numpy.array([3.0])], None)
+    data = ctx.getvalue()
+    assert data.startswith("\x7a\x72\x07[doubleD") and data.count("[double") == 1
+    assert "\x71\x90D" in data
+
+
 def serializeCallTest():    
     loopBackTest(hessian.Call, ("aaa", [], []))
     loopBackTest(hessian.Call, ("aaa", [], [1]))
@@ -160,6 +902,10 @@ def serializeCallTest():
                                ("headerName2", "headerValue2")], [23]))
     loopBackTest(hessian.Call, ("aaa", [], \
                         [{"name" : "beaver", "value" : [987654321, 2, 3.0] }]))
+    
+    s = StringIO()
+    hessian.Call().write(WriteContext(s), ("aaa", [], [u"ddd", 1]))
+    assert s.getvalue() == hessian.Call().template("aaa") + "S\x00\x03dddI\x00\x00\x00\x01z"
 
 
 def serializeReplyAndFaultTest():    
@@ -185,6 +931,30 @@ def referenceTest():
     a[0] = b
     loopBackTest(hessian.Call, ("aaa", [], [b, a]))
 
+
+def referencePolicyTest():
+    def write(value, references):
+        ctx = hessian.BufferedWriteContext(None)
+        hessian.setOptions(ctx, {"references" : references})
+        hessian.writeObject(ctx, value, None)
+        return ctx.getvalue()
+    
+    m = {"name" : "beaver"}
+    data = write([m, m], "off")
+    assert not "R" in data
+    assert [m, m] == readObjectString(data)
+    assert "R" in write([m, m], "identity")
+    
+    # temporary lists are not freed so their ids are not reused
+    value = readObjectString(write(([k] for k in range(100)), "identity"))
+    assert [[k] for k in range(100)] == value
+    
+    pair = (1, u"a")
+    data = write([pair, tuple(list(pair)), (1.0, u"a"), ([],), ([],)], "value")
+    assert data.count("R") == 1
+    assert [[1, u"a"]] * 2 + [[1.0, u"a"], [[]], [[]]] == readObjectString(data)
+    assert not "R" in write([pair, tuple(list(pair))], "identity")
+
     
 def deserializeTest():
     txt = """V t x00 x03 int
@@ -201,8 +971,213 @@ def deserializeTest():
       I x00 x00 x00 x03
       z"""      
     assert(readObjectString(parseData(txt)) == [0, 1, 3])
+    
+    txt = """V 
+      I x00 x00 x00 x05
+      z"""      
+    assert(readObjectString(parseData(txt)) == [5])
 
 
+def iterationTest():
+    class Output:
+        def __init__(self):
+            self.parts = []
+        def write(self, data):
+            self.parts.append(data)
+    
+    values = [u"row %d" % k for k in range(1000)]
+    out = Output()
+    ctx = hessian.BufferedWriteContext(out)
+    ctx.streaming = True
+    hessian.writeObject(ctx, (v for v in values), None)
+    ctx.flush()
+    assert len(out.parts) > 2 # sent while it was produced
+    data = "".join(out.parts)
+    assert data[1] != "l" # no length
+    assert values == hessian.readObject(hessian.BufferedParseContext(data))
+    
+    m = {1 : "one"}
+    loopBackTestTyped(hessian.Call, ("aaa", [], [iter([m, m]), xrange(3).__iter__(), m]),
+                      lambda call: ("aaa", [], [[m, m], [0, 1, 2], m]))
+
+
+def bufferedContextTest():
+    call = ("aaa", [("headerName", "headerValue")], 
+            [u"Пррревед", {"name" : "beaver", "value" : [987654321, 2, 3.0]},
+             "\x00" * 10000, None, True])
+    s = StringIO()
+    hessian.Call().write(WriteContext(s), call)
+    data = s.getvalue()
+    
+    def check(ctx):
+        assert hessian.Call().read(ctx, ctx.read(1)) == call
+        assert ctx.tell() == len(data)
+        assert ctx.read(1) == ""
+    
+    check(hessian.BufferedParseContext(data))
+    for window in [1, 3, 100, 2 ** 16]:
+        stream = StringIO(data)
+        ctx = hessian.BufferedParseContext(stream)
+        ctx.window_size = window
+        check(ctx)
+        # context must not read past message
+        stream = StringIO(data + "trailing garbage")
+        ctx = hessian.BufferedParseContext(stream, length=len(data))
+        ctx.window_size = window
+        check(ctx)
+        assert stream.read() == "trailing garbage"
+
+
+def bufferedWriteContextTest():
+    call = ("aaa", [("headerName", "headerValue")], 
+            [u"Пррревед", {"name" : "beaver", "value" : [987654321, 2, 3.0]},
+             "\x00" * 10000, None, True])
+    s = StringIO()
+    hessian.Call().write(WriteContext(s), call)
+    
+    class CountingStream:
+        def __init__(self):
+            self.writes = []
+        def write(self, data):
+            self.writes.append(data)
+    
+    stream = CountingStream()
+    ctx = hessian.BufferedWriteContext(stream)
+    hessian.Call().write(ctx, call)
+    assert stream.writes == []
+    assert ctx.getvalue() == s.getvalue()
+    ctx.flush()
+    assert stream.writes == [s.getvalue()]
+
+
+def incrementalParserTest():
+    from hessian.incremental import IncrementalParser
+    import random
+    a = [1, 2]
+    values = [None, True, 12343, 2403914806071207089L, 123.321,
+              u"Пррревед" * 1000, "\x00\xff" * 5000, [], [a, a], 
+              {"name" : "beaver", "value" : [987654321, 2, 3.0]},
+              hessian.XmlString(u"<hello who=\"Небольшой\"/>"),
+              hessian.RemoteReference("yo://yeshi/yama")]
+    calls = [("aaa", [], values),
+             ("bbb", [("headerName", "headerValue")], [])]
+    replies = [([], True, values), 
+               ([("headerName", "headerValue")], True, 1),
+               ([], False, {"code" : "value"}),
+               ([], True, None)]
+    
+    def encode(streamer, messages):
+        s = StringIO()
+        for m in messages:
+            streamer.write(WriteContext(s), m)
+        return s.getvalue()
+    
+    random.seed(1)
+    for kind, messages, data in [
+            ("value", values, encode(hessian.Array(), [[v] for v in values])),
+            ("call", calls, encode(hessian.Call(), calls)),
+            ("reply", replies, encode(hessian.Reply(), replies))]:
+        if kind == "value":
+            messages = [[v] for v in messages]
+        for fragment in [1, 2, 7, 100, 10000, len(data)]:
+            parser = IncrementalParser(kind)
+            result = []
+            pos = 0
+            while pos < len(data):
+                size = random.randint(1, fragment)
+                result += parser.feed(data[pos : pos + size])
+                pos += size
+            parser.close()
+            assert result == messages
+    
+    # incomplete messages wait for more data
+    parser = IncrementalParser("reply")
+    data = encode(hessian.Reply(), replies[:1])
+    assert parser.feed(data[:-1]) == []
+    assert parser.pending() == len(data) - 1
+    try:
+        parser.close()
+        assert False # should not get here
+    except hessian.HessianError:
+        pass
+    assert parser.feed(data[-1:]) == replies[:1]
+    
+
+def lazyTest():
+    from hessian import lazy
+    a = [1, u"Щ" * 5000, "\x00" * 5000]
+    a.append(a)
+    shared = {"x" : 1.5}
+    value = {"name" : u"beaver", 
+             "items" : range(100), 
+             "cycle" : a,
+             "one" : shared, "two" : shared,
+             "remote" : hessian.RemoteReference("yo://yeshi/yama"),
+             "nested" : [[{"deep" : [None, True]}]]}
+    s = StringIO()
+    hessian.writeObject(WriteContext(s), value, None)
+    data = s.getvalue()
+    
+    refs = []
+    assert lazy.skipObject(data, 0, refs) == len(data)
+    ctx = ParseContext(StringIO(data))
+    hessian.readObject(ctx)
+    assert len(refs) == len(ctx.referencedObjects)
+    
+    r = lazy.readObject(data)
+    assert r.values == {} # nothing is decoded yet
+    assert len(r) == len(value)
+    assert r["name"] == u"beaver"
+    assert r["items"][10] == 10
+    assert r["items"][-1] == 99
+    assert r["items"] == value["items"]
+    assert r["items"][2:5] == [2, 3, 4]
+    assert r["one"] is r["two"]
+    assert r["one"] == shared
+    assert r["cycle"][3] is r["cycle"]
+    assert r["cycle"][1] == a[1] and r["cycle"][2] == a[2]
+    assert r["remote"] == value["remote"]
+    assert r["nested"][0][0]["deep"] == [None, True]
+    assert sorted(r.keys()) == sorted(value.keys())
+    
+    s = StringIO()
+    hessian.Reply().write(WriteContext(s), ([("h", 1)], True, value["nested"]))
+    assert lazy.readReply(s.getvalue()) == ([("h", 1)], True, value["nested"])
+    s = StringIO()
+    hessian.Reply().write(WriteContext(s), ([], False, {"code" : "value"}))
+    assert lazy.readReply(s.getvalue()) == ([], False, {"code" : "value"})
+    
+    # registered classes are decoded as by readObject
+    from collections import namedtuple
+    Point = namedtuple("Point", "x y")
+    
+    class Node(object):
+        __slots__ = ("name", "parent", "items")
+    
+    registry = hessian.REGISTRY.copy()
+    registry.registerClass(Point, "com.example.Point")
+    registry.registerClass(Node, "com.example.Node")
+    n = Node()
+    n.name = u"root"
+    n.parent = n
+    n.items = [shared, [Point(1, 2)]]
+    value = [shared, Point(1, 2), n, n.items[1], {"other" : Point(3, 4)}]
+    s = StringIO()
+    hessian.writeObject(WriteContext(s, registry=registry), value, None)
+    data = s.getvalue()
+    r = lazy.readObject(data, registry=registry)
+    assert type(r[1]) == Point and r[1] == Point(1, 2)
+    node = r[2]
+    assert type(node) == Node and node.name == u"root" and node.parent is node
+    assert node.items[0] is r[0] and type(r[0]) == lazy.LazyMap
+    assert node.items[1] is r[3] and r[3][0] == Point(1, 2)
+    assert type(r[4]) == lazy.LazyMap and r[4]["other"] == Point(3, 4)
+    assert type(lazy.readObject(data)[1]) == lazy.LazyMap # not registered
+    s = StringIO()
+    hessian.Reply().write(WriteContext(s, registry=registry), ([], True, Point(5, 6)))
+    assert lazy.readReply(s.getvalue(), registry=registry) == ([], True, Point(5, 6))
+    
+
 # ---------------------------------------------------------
 # remote call tests
 
@@ -244,13 +1219,17 @@ class TestHandler(HessianHTTPRequestHandler):
     def sum(self, a, b):
         return a + b
     
+    def count(self, n):
+        return (k for k in xrange(n))
+    
     message_map = {
                    "nothing" : nothing,
                    "hello" : hello,
                    "askBitchy" : askBitchy,
                    "echo" : echo,
                    "redirect" : redirect,
-                   "sum" : sum }
+                   "sum" : sum,
+                   "count" : count }
 
 
 class TestServer(Thread):    
@@ -296,6 +1275,7 @@ def callTestLocal(url):
       
     msg = proxy.hello()
     assert SECRET_MESSAGE == msg
+    assert proxy.hello is proxy.hello # stub is cached
     
     try:
         proxy.askBitchy()
@@ -308,6 +1288,81 @@ def callTestLocal(url):
     assert padonkMessage == proxy.echo(padonkMessage)
     
     callBlobTest(proxy)
+    
+    m = {"name" : "beaver", "value" : [987654321, 2, 3.0] }
+    assert proxy.echo.lazy(m)["value"][2] == 3.0
+    
+    items = [m, 12, m, [u"x"] * 3]
+    result = proxy.echo.iter(items)
+    assert m == result.next()
+    assert items[1:] == list(result)
+    assert [] == list(proxy.echo.iter(None))
+    assert range(1000) == list(proxy.count.iter(1000))
+    assert range(10) == proxy.count(10)
+    try:
+        proxy.echo.iter(m)
+        assert False # should not get here
+    except hessian.HessianError:
+        pass
+    try:
+        proxy.askBitchy.iter()
+        assert False # should not get here
+    except Exception as e:
+        assert "Go away!" == e.testMessage 
+    
+    proxy2 = HessianProxy(url)
+    proxy2.protocolVersion = 2
+    assert m == proxy2.echo(m)
+    assert padonkMessage == proxy2.echo(padonkMessage)
+    assert range(300) == list(proxy2.count.iter(300))
+    assert range(10) == proxy2.count(10)
+    try:
+        proxy2.askBitchy()
+        assert False # should not get here
+    except Exception as e:
+        assert "Go away!" == e.testMessage 
+    
+    TestHandler.stream_replies = True
+    try:
+        big = [u"Пррревед" * 1000, "x" * 100000, m, m, range(1000)]
+        assert big == proxy.echo(big)
+        assert big == proxy2.echo(big)
+        assert range(10) == proxy.count(10) # not sized
+        try:
+            proxy.askBitchy()
+            assert False # should not get here
+        except Exception as e:
+            assert "Go away!" == e.testMessage 
+    finally:
+        TestHandler.stream_replies = False
+    
+    collected = []
+    TestHandler.collect_stats = True
+    TestHandler.statsCollected = lambda self, method, stats: collected.append((method, stats))
+    try:
+        for p in [proxy, proxy2]:
+            p.collectStats = True
+            del collected[:]
+            assert m == p.echo(m)
+            for _ in range(50): # hook is called after reply is sent
+                if collected:
+                    break
+                sleep(0.1)
+            method, stats = collected[0]
+            assert method == "echo"
+            # 2.0 method name is read as string, template is not accounted
+            assert set(p.lastStats["call"].types) <= set(stats["call"].types)
+            assert set(stats["reply"].types) == set(p.lastStats["reply"].types)
+            assert stats["reply"].depth == p.lastStats["reply"].depth == 2
+            p.collectStats = False
+        proxy.collectStats = True
+        assert m == proxy.echo.lazy(m)
+        assert proxy.lastStats["reply"] is None
+        proxy.collectStats = False
+    finally:
+        TestHandler.collect_stats = False
+        del TestHandler.statsCollected
+    
     redirectTest(proxy)
     
     if True:
@@ -385,12 +1440,32 @@ if __name__ == "__main__":
     try:
         runList([
                  deserializeTest,
+                 bufferedContextTest,
+                 bufferedWriteContextTest,
+                 incrementalParserTest,
+                 lazyTest,
+                 iterationTest,
                  loopbackTestTypes,
                  serializeCallTest,
                  testHessianTypes,
+                 chunkedTest,
+                 subclassTest,
+                 registryTest,
+                 typedObjectTest,
+                 hessian2Test,
+                 internTest,
+                 dateTest,
+                 binaryViewTest,
+                 recordsTest,
+                 sizingTest,
+                 deepTest,
+                 statsTest,
+                 numericListTest,
+                 ndarrayTest,
                  testDatetime,
                  serializeReplyAndFaultTest,
                  referenceTest,
+                 referencePolicyTest,
                  realWorldTest1,
                  lambda: callTestLocal("http://localhost:%d/" % TEST_PORT),
                  sslTest
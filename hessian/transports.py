@@ -71,6 +71,12 @@ class HessianTransport:
         " Send stream to server "
         raise HessianError("Hessian transport is incomplete:"
                            " Method is not implemented")
+
+    def open(self, outstream):
+        """ Send stream to server. Returns response stream that is 
+        not read yet, caller should close it. """
+        raise HessianError("Hessian transport is incomplete:"
+                           " Method is not implemented")
     
     
 class BasicUrlLibTransport(HessianTransport):
@@ -107,6 +113,12 @@ class BasicUrlLibTransport(HessianTransport):
     
   
     def request(self, outstream):
+        response = self.open(outstream)
+        result = StringIO(response.read())
+        response.close()
+        return result
+
+    def open(self, outstream):
         outstream.flush()
         req_data = outstream.read()        
         # print "request", map(lambda x : "%02x" % ord(x), req_data[:50]), "\n\t:", req_data[:50] # debug        
@@ -115,8 +127,5 @@ class BasicUrlLibTransport(HessianTransport):
         r.add_header("User-agent", "HessianPy/%s" % __version__)
         r.add_header("Content-type", "application/octet-stream")
         
-        response = self._opener.open(r)
-        result = StringIO(response.read())
-        response.close()
-        return result        
+        return self._opener.open(r)        
   